@@ -0,0 +1,101 @@
+import heapq
+import asyncio
+import logging
+import itertools
+
+logger = logging.getLogger(__name__)
+
+
+# Запрос отклонен: очередь переполнена или истекло время ожидания
+class Overloaded(Exception):
+    def __init__(self, priority_class: str, reason: str):
+        super().__init__(f"{priority_class}: {reason}")
+        self.priority_class = priority_class
+        self.reason = reason
+
+
+# Разбор строки вида "developer=60,private=20"
+def parse_class_waits(value: str, defaults: dict) -> dict:
+    waits = dict(defaults)
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        name, _, seconds = item.partition("=")
+        if name.strip() not in waits:
+            raise ValueError(f"Unknown priority class: {name}")
+        waits[name.strip()] = float(seconds)
+    return waits
+
+
+# Контроль допуска к LLM: ограниченное число одновременных запросов и ограниченная
+# очередь с классами приоритета. Каждый класс ждет не дольше своего max_wait,
+# после чего запрос отклоняется (Overloaded)
+class AdmissionController:
+    def __init__(self, capacity: int, max_queue: int, class_waits: dict):
+        # Порядок классов в class_waits задает приоритет: первый - самый важный
+        self.capacity = capacity
+        self.max_queue = max_queue
+        self.class_waits = dict(class_waits)
+        self.class_rank = {name: rank for rank, name in enumerate(class_waits)}
+        self.in_flight = 0
+        self._queue = []  # heap: (rank, seq, future, priority_class)
+        self._seq = itertools.count()
+        self.shed = {name: 0 for name in class_waits}
+
+    @property
+    def depth(self) -> int:
+        return sum(1 for entry in self._queue if not entry[2].done())
+
+    def _shed(self, priority_class: str, reason: str) -> Overloaded:
+        self.shed[priority_class] += 1
+        return Overloaded(priority_class, reason)
+
+    # Вытеснение наименее приоритетного ожидающего запроса ради более важного
+    def _evict_lowest(self, rank: int) -> bool:
+        waiting = [entry for entry in self._queue if not entry[2].done()]
+        if not waiting:
+            return False
+        victim = max(waiting, key=lambda entry: (entry[0], entry[1]))
+        if victim[0] <= rank:
+            return False
+        victim[2].set_exception(self._shed(victim[3], "evicted by higher priority"))
+        return True
+
+    async def acquire(self, priority_class: str) -> None:
+        rank = self.class_rank[priority_class]
+        if self.in_flight < self.capacity and not self.depth:
+            self.in_flight += 1
+            return
+
+        if self.depth >= self.max_queue and not self._evict_lowest(rank):
+            raise self._shed(priority_class, "queue full")
+
+        if len(self._queue) > 2 * self.max_queue:
+            # Убираем из кучи записи отмененных и отклоненных запросов
+            self._queue = [entry for entry in self._queue if not entry[2].done()]
+            heapq.heapify(self._queue)
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (rank, next(self._seq), future, priority_class))
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.class_waits[priority_class])
+        except asyncio.TimeoutError:
+            if future.done() and not future.exception():
+                # Слот выдан одновременно с истечением времени - возвращаем его
+                self.release()
+            else:
+                future.cancel()
+            raise self._shed(priority_class, "max wait exceeded")
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled() and not future.exception():
+                self.release()
+            else:
+                future.cancel()
+            raise
+
+    # Освобождение слота: он сразу передается самому приоритетному ожидающему
+    def release(self) -> None:
+        while self._queue:
+            _, _, future, _ = heapq.heappop(self._queue)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.in_flight -= 1
@@ -0,0 +1,136 @@
+# Микробенчмарк постобработки ответа LLM: clean_response / normalize_response,
+# format_paragraphs, complete_sentences и потоковый ThinkStripper на типичных
+# ответах deepseek-r1 (большой <think>-блок, несколько абзацев кириллицы).
+# Перед замером проверяется, что normalize_response дает побайтно тот же
+# результат, что прежняя многопроходная реализация.
+#
+#   python bench/bench_clean.py [--repeat N] [--json]
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+SENTENCES = [
+    "Привет! Я очень рада тебя видеть.",
+    "Сегодня отличный день, чтобы поговорить о чем-нибудь интересном.",
+    "*улыбается и поправляет волосы* Ну что, рассказывай, как у тебя дела?",
+    "Знаешь, иногда мне кажется, что самые простые вещи - самые важные…",
+    "А ты когда-нибудь задумывался, почему небо голубое?",
+    "Это из-за рассеяния света в атмосфере: короткие волны рассеиваются сильнее",
+]
+THINK = "Пользователь спрашивает о погоде. Нужно ответить дружелюбно, в образе Алисы, коротко и по делу. "
+
+
+# Прежняя реализация normalize_response - эталон для проверки идентичности
+def reference_normalize(response: str) -> str:
+    cleaned = re.sub(r'<think>.*?</think>', '', response, flags=re.DOTALL)
+    cleaned = cleaned.replace('<think>', '').replace('</think>', '')
+    cleaned = cleaned.replace('</s>', '').replace('<s>', '')
+
+    cleaned = main.format_actions(cleaned)
+    cleaned = re.sub(r'\n\s*\n', '\n\n', cleaned).strip()
+    if cleaned and not re.search(r'[.!?…]$', cleaned):
+        cleaned += '.'
+    paragraphs = []
+    for paragraph in cleaned.split('\n\n'):
+        if paragraph.strip():
+            paragraphs.append(re.sub(r'\s+', ' ', paragraph).strip())
+    return '\n\n'.join(paragraphs)
+
+
+def make_response(rng: random.Random, think_chars: int, paragraphs: int) -> str:
+    think = (THINK * (think_chars // len(THINK) + 1))[:think_chars]
+    body = []
+    for _ in range(paragraphs):
+        body.append(" ".join(rng.choice(SENTENCES) for _ in range(rng.randint(2, 5))))
+    separator = rng.choice(["\n\n", "\n \n", "\n\n\n", "\n  \t\n"])
+    return f"<think>\n{think}\n</think>\n\n" + separator.join(body) + rng.choice(["", "</s>", " ", "\n"])
+
+
+# Случайные строки из «опасных» фрагментов: вложенные и незакрытые теги, пробелы всех видов
+def make_fuzz(rng: random.Random) -> str:
+    pieces = ["<think>", "</think>", "<s>", "</s>", "<", ">", "s", "think", "\n", "\n\n", " ", "\t",
+              "\r", "\x0b", " ", " ", ".", "!", "?", "…", "*", "а", "Б", "word", "\x1c"]
+    return "".join(rng.choice(pieces) for _ in range(rng.randint(0, 40)))
+
+
+def check_identical(samples: list) -> int:
+    for text in samples:
+        expected = reference_normalize(text)
+        actual = main.normalize_response(text)
+        if actual != expected:
+            raise AssertionError(f"normalize_response differs for {text!r}: {actual!r} != {expected!r}")
+        expected_sentences = text + "." if text and not re.search(r'[.!?…]$', text) else text
+        if main.complete_sentences(text) != expected_sentences:
+            raise AssertionError(f"complete_sentences differs for {text!r}")
+    return len(samples)
+
+
+def timeit(function, inputs: list, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in inputs:
+            function(text)
+        best = min(best, time.perf_counter() - start)
+    return best / len(inputs) * 1e6
+
+
+def stream_chunks(text: str, size: int = 6) -> list:
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def stream_strip(chunks: list) -> str:
+    stripper = main.ThinkStripper()
+    visible = "".join(stripper.feed(chunk) for chunk in chunks)
+    return visible + stripper.flush()
+
+
+def main_bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--fuzz", type=int, default=50_000)
+    parser.add_argument("--json", action="store_true", help="вывод в формате JSON")
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    cases = {
+        "short": [make_response(rng, 0, 1).replace("<think>\n\n</think>\n\n", "") for _ in range(200)],
+        "r1_2k_think": [make_response(rng, 2_000, 3) for _ in range(200)],
+        "r1_20k_think": [make_response(rng, 20_000, 6) for _ in range(50)],
+    }
+    checked = check_identical([text for inputs in cases.values() for text in inputs]
+                              + [make_fuzz(rng) for _ in range(args.fuzz)])
+
+    results = []
+    for case, inputs in cases.items():
+        chunks = [stream_chunks(text) for text in inputs]
+        cleaned = [main.normalize_response(text) for text in inputs]
+        for name, function, data in (
+            ("reference_normalize", reference_normalize, inputs),
+            ("normalize_response", main.normalize_response, inputs),
+            ("clean_response", main.clean_response, inputs),
+            ("format_paragraphs", main.format_paragraphs, inputs),
+            ("complete_sentences", main.complete_sentences, inputs),
+            ("think_stripper_stream", stream_strip, chunks),
+            ("visible_stream_text", main.visible_stream_text, cleaned),
+        ):
+            results.append({"case": case, "function": name, "us_per_call": round(timeit(function, data, args.repeat), 2)})
+
+    if args.json:
+        print(json.dumps({"benchmark": "clean", "identical_checked": checked, "results": results}))
+        return
+    print(f"normalize_response identical to reference on {checked} inputs")
+    for r in results:
+        print(f"{r['case']:>13} {r['function']:>22}: {r['us_per_call']:>10.2f} us/call")
+
+
+if __name__ == "__main__":
+    main_bench()
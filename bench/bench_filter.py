@@ -0,0 +1,82 @@
+# Бенчмарк фильтра addressed_to_bot: сколько групповых сообщений в секунду
+# отсеивается до запуска handle_message.
+#
+#   python bench/bench_filter.py [--messages N] [--json]
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Chat, Message, Update, User
+
+import main
+
+BOT = User(id=1, first_name="Алиса", is_bot=True, username="aliceneyrobot")
+GROUP = Chat(id=-100123, type=Chat.SUPERGROUP)
+PRIVATE = Chat(id=42, type=Chat.PRIVATE)
+TEXTS = [
+    "всем привет, кто идет сегодня гулять?",
+    "Ну и погода... опять дождь весь день",
+    "скиньте ссылку на вчерашний стрим пожалуйста",
+    "@aliceneyrobot привет, как дела?",
+    "aliceneyrobot, что думаешь?",
+]
+
+
+def make_updates(count: int, addressed_share: float) -> list:
+    date = datetime.now(timezone.utc)
+    updates = []
+    for i in range(count):
+        user = User(id=1000 + i % 500, first_name=f"User{i % 500}", is_bot=False)
+        if random.random() < addressed_share:
+            text = random.choice(TEXTS[3:])
+        else:
+            text = random.choice(TEXTS[:3])
+        reply = None
+        if random.random() < 0.05:
+            reply = Message(message_id=i, date=date, chat=GROUP, from_user=BOT, text="ответ")
+        message = Message(message_id=i, date=date, chat=GROUP, from_user=user, text=text, reply_to_message=reply)
+        updates.append(Update(update_id=i, message=message))
+    return updates
+
+
+def bench(updates: list, message_filter) -> dict:
+    start = time.perf_counter()
+    passed = sum(1 for update in updates if message_filter.check_update(update))
+    elapsed = time.perf_counter() - start
+    return {
+        "messages": len(updates),
+        "passed": passed,
+        "messages_per_second": round(len(updates) / elapsed),
+    }
+
+
+def main_bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=200_000)
+    parser.add_argument("--addressed-share", type=float, default=0.02)
+    parser.add_argument("--json", action="store_true", help="вывод в формате JSON")
+    args = parser.parse_args()
+
+    main.bot_user = BOT
+    updates = make_updates(args.messages, args.addressed_share)
+    full_filter = main.filters.TEXT & ~main.filters.COMMAND & main.addressed_to_bot
+    results = {
+        "addressed_to_bot": bench(updates, main.addressed_to_bot),
+        "handler_filter": bench(updates, full_filter),
+    }
+
+    if args.json:
+        print(json.dumps({"benchmark": "filter", "results": results}))
+        return
+    for name, r in results.items():
+        print(f"{name:>18}: {r['messages_per_second']:>10} msg/s ({r['passed']}/{r['messages']} passed)")
+
+
+if __name__ == "__main__":
+    main_bench()
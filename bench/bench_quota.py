@@ -0,0 +1,75 @@
+# Микробенчмарк QuotaEngine: стоимость одной проверки лимита (и одного списания
+# токенов в режиме tokens) в зависимости от числа отслеживаемых пользователей.
+#
+#   python bench/bench_quota.py [--checks N] [--mode messages|tokens] [--json]
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from quota import MODE_MESSAGES, MODE_TOKENS, QuotaEngine, SECONDS_PER_DAY
+
+USER_COUNTS = [1_000, 10_000, 100_000, 1_000_000]
+MODES = [MODE_MESSAGES, MODE_TOKENS]
+
+
+def bench(users: int, checks: int, mode: str) -> dict:
+    now = [1_700_000_000.0]
+    referrals = {user_id: 1 for user_id in range(0, users, 7)}
+    engine = QuotaEngine(35, 3, lambda user_id: referrals.get(user_id, 0), clock=lambda: now[0], mode=mode)
+
+    # Заполняем счетчики для всех пользователей
+    for user_id in range(users):
+        engine.check_and_consume(user_id)
+
+    ids = [random.randrange(users) for _ in range(checks)]
+    start = time.perf_counter()
+    for user_id in ids:
+        engine.check_and_consume(user_id)
+    check_ns = (time.perf_counter() - start) / checks * 1e9
+
+    # Токены списываются только в режиме tokens
+    charge_ns = None
+    if mode == MODE_TOKENS:
+        tokens = [random.randint(300, 2500) for _ in range(checks)]
+        start = time.perf_counter()
+        for user_id, used in zip(ids, tokens):
+            engine.charge_tokens(user_id, used)
+        charge_ns = (time.perf_counter() - start) / checks * 1e9
+
+    # Смена суток
+    now[0] += SECONDS_PER_DAY
+    start = time.perf_counter()
+    engine.check_and_consume(0)
+    rollover_ms = (time.perf_counter() - start) * 1e3
+
+    result = {"mode": mode, "users": users, "checks": checks, "ns_per_check": round(check_ns, 1),
+              "rollover_ms": round(rollover_ms, 3)}
+    if charge_ns is not None:
+        result["ns_per_charge"] = round(charge_ns, 1)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checks", type=int, default=200_000)
+    parser.add_argument("--mode", choices=MODES, help="только один режим лимита (по умолчанию оба)")
+    parser.add_argument("--json", action="store_true", help="вывод в формате JSON")
+    args = parser.parse_args()
+
+    modes = [args.mode] if args.mode else MODES
+    results = [bench(users, args.checks, mode) for mode in modes for users in USER_COUNTS]
+    if args.json:
+        print(json.dumps({"benchmark": "quota", "results": results}))
+        return
+    for r in results:
+        charge = f", {r['ns_per_charge']:>8.1f} ns/charge" if "ns_per_charge" in r else ""
+        print(f"{r['mode']:>8} {r['users']:>9} users: {r['ns_per_check']:>8.1f} ns/check{charge}, rollover {r['rollover_ms']:.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# Запуск всех микробенчмарков и сохранение результатов в один JSON-файл
+# с хешем коммита, чтобы сравнивать их между коммитами.
+#
+#   python bench/run_all.py [--output bench.json] [--compare previous.json]
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCHMARKS = ["bench_clean.py", "bench_filter.py", "bench_quota.py"]
+
+# Метрики, где меньше - лучше; для остальных (msg/s) лучше больше
+LOWER_IS_BETTER = ("us_per_call", "ns_per_check", "ns_per_charge", "rollover_ms")
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run(script: str) -> dict:
+    output = subprocess.check_output([sys.executable, os.path.join(BENCH_DIR, script), "--json"], text=True)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+# Плоский список значений вида "clean/r1_20k_think/normalize_response/us_per_call"
+def flatten(report: dict) -> dict:
+    values = {}
+    for bench in report["benchmarks"]:
+        results = bench["results"]
+        items = results.items() if isinstance(results, dict) else enumerate(results)
+        for key, result in items:
+            labels = [str(v) for k, v in result.items() if isinstance(v, str)]
+            if "users" in result:
+                labels.append(str(result["users"]))
+            labels = labels or [str(key)]
+            for metric, value in result.items():
+                if isinstance(value, (int, float)) and metric not in ("users", "checks", "messages", "passed"):
+                    values["/".join([bench["benchmark"], *labels, metric])] = value
+    return values
+
+
+def compare(current: dict, previous: dict) -> None:
+    old = flatten(previous)
+    for name, value in flatten(current).items():
+        if name not in old or not old[name]:
+            continue
+        change = (value - old[name]) / old[name] * 100
+        better = change < 0 if name.endswith(LOWER_IS_BETTER) else change > 0
+        print(f"{name:<70} {old[name]:>12} -> {value:>12} ({change:+.1f}%{'' if abs(change) < 5 else ' better' if better else ' WORSE'})")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", default="")
+    parser.add_argument("--compare", default="")
+    args = parser.parse_args()
+
+    report = {"commit": git_commit(), "python": sys.version.split()[0],
+              "benchmarks": [run(script) for script in BENCHMARKS]}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
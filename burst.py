@@ -0,0 +1,82 @@
+import re
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Маркер ответа на сообщение пачки в тексте модели: "[2] ..." в начале строки
+REPLY_MARKER = re.compile(r'^[ \t]*\[(\d+)\][ \t]*', re.MULTILINE)
+
+
+# Пачка сообщений одного ключа, собираемая в пределах окна
+class _Burst:
+    def __init__(self):
+        self.items = []
+        self.full = asyncio.Event()
+        self.done = asyncio.get_running_loop().create_future()
+
+
+# Сбор сообщений одного ключа (чата), пришедших в пределах окна, в одну пачку.
+# Первое сообщение открывает окно; по его истечении или после max_items сообщений
+# пачка целиком передается в flush(key, items). add() возвращается, когда пачка обработана
+class BurstCollector:
+    def __init__(self, window: float, flush, max_items: int = 8, on_flush=None):
+        self.window = window
+        self.flush = flush
+        self.max_items = max_items
+        self.on_flush = on_flush
+        self.tasks = set()
+        self._open = {}
+
+    def __len__(self):
+        return len(self._open)
+
+    async def add(self, key, item) -> None:
+        burst = self._open.get(key)
+        if burst is None:
+            burst = self._open[key] = _Burst()
+            task = asyncio.get_running_loop().create_task(self._run(key, burst))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        burst.items.append(item)
+        if len(burst.items) >= self.max_items:
+            self._close(key, burst)
+            burst.full.set()
+        # Отмена ожидающего обработчика не прерывает обработку всей пачки
+        await asyncio.shield(burst.done)
+
+    def _close(self, key, burst: _Burst) -> None:
+        if self._open.get(key) is burst:
+            del self._open[key]
+
+    async def _run(self, key, burst: _Burst) -> None:
+        try:
+            await asyncio.wait_for(burst.full.wait(), self.window)
+        except asyncio.TimeoutError:
+            pass
+        self._close(key, burst)
+        if self.on_flush:
+            self.on_flush(len(burst.items))
+        try:
+            await self.flush(key, burst.items)
+        except BaseException as e:
+            burst.done.set_exception(e)
+            # Исключение получают ожидающие add(); помечаем его полученным на случай их отмены
+            burst.done.exception()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        else:
+            burst.done.set_result(None)
+
+
+# Разбор ответа на пачку: номер сообщения (с нуля) -> текст ответа ему.
+# Текст до первого маркера и маркеры с номерами вне пачки отбрасываются
+def split_replies(text: str, count: int) -> dict:
+    parts = REPLY_MARKER.split(text)
+    replies = {}
+    for number, part in zip(parts[1::2], parts[2::2]):
+        index = int(number) - 1
+        part = part.strip()
+        if 0 <= index < count and part:
+            replies[index] = f"{replies[index]}\n\n{part}" if index in replies else part
+    return replies
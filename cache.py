@@ -0,0 +1,85 @@
+import re
+import sys
+import time
+import hashlib
+from collections import OrderedDict
+
+# Подстановка имени пользователя в сохраненных ответах
+NAME_MARKER = "\x00name\x00"
+# Более короткие имена не подставляются: их легко спутать с обычными словами ("Я", "Ан")
+MIN_NAME_LENGTH = 3
+
+PUNCTUATION = re.compile(r"[^\w\s]+")
+WHITESPACE = re.compile(r"\s+")
+
+
+# Нормализация текста сообщения: регистр, упоминания бота, пунктуация и пробелы
+def normalize_prompt(text: str, bot_username: str = "") -> str:
+    text = text.lower()
+    if bot_username:
+        text = text.replace("@" + bot_username.lower(), " ").replace(bot_username.lower(), " ")
+    text = PUNCTUATION.sub(" ", text)
+    return WHITESPACE.sub(" ", text).strip()
+
+
+# Отпечаток запроса: версия персонажа, маршрут, последние реплики истории и текст
+def prompt_fingerprint(persona_version: str, route_name: str, history: list, normalized_text: str) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (persona_version, route_name, *(m["content"] for m in history), normalized_text):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\x1f")
+    return digest.hexdigest()
+
+
+# Кэш ответов с вытеснением по LRU и времени жизни и ограничением памяти
+class ResponseCache:
+    def __init__(self, max_bytes: int, ttl: float, clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()  # fingerprint -> (text, expires_at, size)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _remove(self, key) -> None:
+        _, _, size = self._entries.pop(key)
+        self.bytes -= size
+
+    def get(self, key: str, name: str = ""):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        text, expires_at, _ = entry
+        if expires_at <= self.clock():
+            self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return text.replace(NAME_MARKER, name) if name else text
+
+    # Имя пользователя в ответе заменяется маркером, чтобы ответ подходил другим пользователям.
+    # Заменяются только отдельные слова; если имя осталось в тексте (короткое имя, часть
+    # другого слова, другой падеж), ответ не кэшируется
+    def put(self, key: str, text: str, names: tuple = ()) -> None:
+        for name in names:
+            if not name:
+                continue
+            if len(name) >= MIN_NAME_LENGTH:
+                text = re.sub(rf"(?<!\w){re.escape(name)}(?!\w)", NAME_MARKER, text)
+            if name in text:
+                return
+        size = sys.getsizeof(text) + sys.getsizeof(key) + 64
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (text, self.clock() + self.ttl, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
@@ -0,0 +1,511 @@
+import sys
+import time
+import logging
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+# Примерное число символов на токен (кириллица и латиница вперемешку)
+CHARS_PER_TOKEN = 3
+# Служебные токены на каждое сообщение чата
+MESSAGE_OVERHEAD_TOKENS = 4
+# Сколько символов каждой реплики попадает в краткое содержание
+SUMMARY_LINE_CHARS = 160
+# Примерный размер пустой истории в памяти, байты
+CONVERSATION_OVERHEAD_BYTES = 200
+
+SUMMARY_HEADER = "Краткое содержание более ранней переписки с этим пользователем:\n"
+
+ROLES = ("user", "assistant")
+
+
+# Оценка числа токенов без токенизатора
+def estimate_tokens(text: str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def message_tokens(message: dict) -> int:
+    return estimate_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+
+def text_tokens(text: str) -> int:
+    return estimate_tokens(text) + MESSAGE_OVERHEAD_TOKENS
+
+
+# Последние строки, укладывающиеся в бюджет токенов, в исходном порядке
+def lines_within(lines: list, budget: int) -> list:
+    selected = []
+    for line in reversed(lines):
+        budget -= estimate_tokens(line) + 1
+        if budget < 0:
+            break
+        selected.append(line)
+    selected.reverse()
+    return selected
+
+
+# Сжатие реплики в одну строку краткого содержания
+def summarize_text(role: str, text: str) -> str:
+    text = " ".join(text.split())
+    if len(text) > SUMMARY_LINE_CHARS:
+        text = text[:SUMMARY_LINE_CHARS].rstrip() + "…"
+    if role == "assistant":
+        return f"Алиса: {text}"
+    return text
+
+
+# История диалога одного ключа (chat_id, user_id).
+# Реплики хранятся строками по очереди: пользователь, ассистент, пользователь, ...
+class Conversation:
+    __slots__ = ("texts", "history_tokens", "summary_lines", "summary_tokens", "size", "last_access")
+
+    def __init__(self):
+        self.texts = []
+        self.history_tokens = 0
+        self.summary_lines = []
+        self.summary_tokens = 0
+        self.size = CONVERSATION_OVERHEAD_BYTES
+        self.last_access = time.monotonic()
+
+    @property
+    def history(self) -> list:
+        return [{"role": ROLES[i % 2], "content": text} for i, text in enumerate(self.texts)]
+
+    def add_text(self, text: str) -> None:
+        self.texts.append(text)
+        self.history_tokens += text_tokens(text)
+        self.size += sys.getsizeof(text)
+
+    def pop_text(self) -> str:
+        text = self.texts.pop(0)
+        self.history_tokens -= text_tokens(text)
+        self.size -= sys.getsizeof(text)
+        return text
+
+    def add_summary_line(self, line: str) -> None:
+        self.summary_lines.append(line)
+        self.summary_tokens += estimate_tokens(line) + 1
+        self.size += sys.getsizeof(line)
+
+    def pop_summary_line(self) -> None:
+        line = self.summary_lines.pop(0)
+        self.summary_tokens -= estimate_tokens(line) + 1
+        self.size -= sys.getsizeof(line)
+
+    def to_dict(self) -> dict:
+        return {"texts": self.texts, "summary": self.summary_lines}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Conversation":
+        conversation = cls()
+        texts = data.get("texts")
+        if texts is None:
+            # Старый формат: список словарей {"role", "content"}
+            texts = [m["content"] for m in data.get("history", [])]
+        for text in texts:
+            conversation.add_text(text)
+        for line in data.get("summary", []):
+            conversation.add_summary_line(line)
+        return conversation
+
+
+# Менеджер контекста: история по бюджету токенов, скользящее краткое содержание
+# и ограничение занимаемой памяти (вытеснение по LRU и времени простоя)
+class ContextManager:
+    def __init__(self, system_prompt: str, history_budget: int, summary_budget: int, backend=None,
+                 memory_limit: int = 64 * 1024 * 1024, idle_ttl: float = 6 * 3600):
+        # Системный промпт не меняется между запросами, чтобы работало кэширование префикса
+        self.system_message = {"role": "system", "content": system_prompt}
+        self.system_tokens = message_tokens(self.system_message)
+        self.history_budget = history_budget
+        self.summary_budget = summary_budget
+        # Порядок ключей - от давно неиспользуемых к недавним
+        self.contexts = OrderedDict()
+        # Вторичный индекс: user_id -> число ключей этого пользователя в памяти
+        self.user_index = {}
+        self.memory_bytes = 0
+        self.memory_limit = memory_limit
+        self.idle_ttl = idle_ttl
+        self.evictions = 0
+        # Хранилище для сохранения истории между перезапусками (storage.StateBackend).
+        # История пишется в хранилище сразу, поэтому вытесненные из памяти ключи
+        # подгружаются оттуда при следующем обращении
+        self.backend = backend
+
+    # Замена системного промпта (перечитанный персонаж) для следующих запросов
+    def set_system_prompt(self, system_prompt: str) -> None:
+        self.system_message = {"role": "system", "content": system_prompt}
+        self.system_tokens = message_tokens(self.system_message)
+
+    def _insert(self, key, conversation: Conversation) -> None:
+        self.contexts[key] = conversation
+        self.memory_bytes += conversation.size
+        self.user_index[key[1]] = self.user_index.get(key[1], 0) + 1
+
+    def _remove(self, key):
+        conversation = self.contexts.pop(key, None)
+        if conversation is None:
+            return None
+        self.memory_bytes -= conversation.size
+        count = self.user_index[key[1]] - 1
+        if count:
+            self.user_index[key[1]] = count
+        else:
+            del self.user_index[key[1]]
+        return conversation
+
+    # Вытеснение простаивающих и самых старых историй сверх лимита памяти
+    def _evict(self) -> None:
+        deadline = time.monotonic() - self.idle_ttl
+        while self.contexts:
+            key, conversation = next(iter(self.contexts.items()))
+            expired = conversation.last_access < deadline
+            over_limit = self.memory_bytes > self.memory_limit and len(self.contexts) > 1
+            if not expired and not over_limit:
+                break
+            self._remove(key)
+            self.evictions += 1
+
+    # История из памяти, при промахе - из хранилища
+    def _get(self, key):
+        conversation = self.contexts.get(key)
+        if conversation is not None:
+            self.contexts.move_to_end(key)
+        elif self.backend is not None:
+            data = self.backend.load_context(key)
+            if data is not None:
+                conversation = Conversation.from_dict(data)
+                self._insert(key, conversation)
+        if conversation is not None:
+            conversation.last_access = time.monotonic()
+        return conversation
+
+    def build_messages(self, key, user_message: dict):
+        conversation = self._get(key)
+        messages = [self.system_message]
+        prompt_tokens = self.system_tokens + message_tokens(user_message)
+
+        if conversation is not None:
+            if conversation.summary_lines:
+                summary = SUMMARY_HEADER + "\n".join(conversation.summary_lines)
+                messages.append({"role": "system", "content": summary})
+                prompt_tokens += estimate_tokens(summary) + MESSAGE_OVERHEAD_TOKENS
+            messages.extend(conversation.history)
+            prompt_tokens += conversation.history_tokens
+
+        messages.append(user_message)
+        return messages, prompt_tokens
+
+    # История ключа строками (краткое содержание, затем реплики) для общего промпта пачки
+    def history_lines(self, key) -> list:
+        conversation = self._get(key)
+        if conversation is None:
+            return []
+        texts = [summarize_text(ROLES[i % 2], text) for i, text in enumerate(conversation.texts)]
+        return conversation.summary_lines + texts
+
+    def append_turn(self, key, user_message: dict, assistant_message: dict):
+        conversation = self._get(key)
+        if conversation is None:
+            conversation = Conversation()
+            self._insert(key, conversation)
+
+        size_before = conversation.size
+        conversation.add_text(user_message["content"])
+        conversation.add_text(assistant_message["content"])
+
+        # Старые пары реплик сворачиваем в краткое содержание, последняя пара остается всегда
+        while conversation.history_tokens > self.history_budget and len(conversation.texts) > 2:
+            for role in ROLES:
+                self._fold_into_summary(conversation, role, conversation.pop_text())
+
+        self.memory_bytes += conversation.size - size_before
+        if self.backend is not None:
+            self.backend.save_context(key, conversation.to_dict())
+        self._evict()
+
+    def _fold_into_summary(self, conversation: Conversation, role: str, text: str):
+        conversation.add_summary_line(summarize_text(role, text))
+        while conversation.summary_tokens > self.summary_budget and conversation.summary_lines:
+            conversation.pop_summary_line()
+
+    # Есть ли у пользователя история хотя бы в одном чате, за O(1)
+    def has_context(self, user_id: int) -> bool:
+        if user_id in self.user_index:
+            return True
+        return self.backend is not None and self.backend.has_context(user_id)
+
+    def clear(self, key) -> bool:
+        existed = self._get(key) is not None
+        self._remove(key)
+        if existed and self.backend is not None:
+            self.backend.delete_context(key)
+        return existed
+
+
+# Номер пользователя в ключе хранилища для общей истории группы: (chat_id, GROUP_USER_ID)
+GROUP_USER_ID = 0
+
+GROUP_HEADER = "Недавняя переписка в группе (другие участники и твои ответы им):\n"
+# Примерный размер записи общей истории без текста, байты
+ENTRY_OVERHEAD_BYTES = 120
+
+
+# Реплика общей истории группы: сообщение участника или ответ ему.
+# Одна запись может входить и в общую ленту, и в хвост участника - память учитывается один раз
+class GroupEntry:
+    __slots__ = ("user_id", "name", "role", "text", "size", "refs")
+
+    def __init__(self, user_id: int, name: str, role: str, text: str):
+        self.user_id = user_id
+        self.name = name
+        self.role = role
+        self.text = text
+        self.size = ENTRY_OVERHEAD_BYTES + sys.getsizeof(text)
+        self.refs = 0
+
+    # Строка для общей ленты; текст участника уже начинается с его имени
+    def line(self) -> str:
+        if self.role == "assistant":
+            return f"Алиса (для {self.name}): {self.text}"
+        return self.text
+
+
+# История одной группы: общая лента реплик всех участников и короткий хвост
+# последних пар реплик каждого участника с ботом (хвосты - от давно писавших к недавним).
+# Запись участника входит только в его хвост, tail_bytes - объем всех хвостов
+class GroupConversation:
+    __slots__ = ("ring", "tails", "size", "tail_bytes", "last_access")
+
+    def __init__(self):
+        self.ring = deque()
+        self.tails = OrderedDict()
+        self.size = CONVERSATION_OVERHEAD_BYTES
+        self.tail_bytes = 0
+        self.last_access = time.monotonic()
+
+    def _ref(self, entry: GroupEntry) -> None:
+        if not entry.refs:
+            self.size += entry.size
+        entry.refs += 1
+
+    def _unref(self, entry: GroupEntry) -> None:
+        entry.refs -= 1
+        if not entry.refs:
+            self.size -= entry.size
+
+    def add(self, entry: GroupEntry, tail_entries: int) -> None:
+        self.ring.append(entry)
+        self._ref(entry)
+        tail = self.tails.get(entry.user_id)
+        if tail is None:
+            tail = self.tails[entry.user_id] = deque()
+        self.tails.move_to_end(entry.user_id)
+        self._tail_append(tail, entry)
+        while len(tail) > tail_entries:
+            self._tail_popleft(tail)
+
+    def _tail_append(self, tail: deque, entry: GroupEntry) -> None:
+        tail.append(entry)
+        self.tail_bytes += entry.size
+        self._ref(entry)
+
+    def _tail_popleft(self, tail: deque) -> None:
+        entry = tail.popleft()
+        self.tail_bytes -= entry.size
+        self._unref(entry)
+
+    # Соблюдение потолка памяти. Хвосты занимают не больше половины потолка: сверх
+    # этого удаляются хвосты давно писавших участников (кроме keep_user). Затем из ленты
+    # удаляются самые старые записи, не входящие ни в один хвост, - только они
+    # освобождают память. Возвращает участников, чьи хвосты удалены
+    def trim(self, max_bytes: int, keep_user: int) -> list:
+        dropped = []
+        for user_id in list(self.tails):
+            if self.tail_bytes <= max_bytes // 2:
+                break
+            if user_id != keep_user:
+                self.drop_tail(user_id)
+                dropped.append(user_id)
+        if self.size > max_bytes:
+            kept = deque()
+            while self.ring and self.size > max_bytes:
+                entry = self.ring.popleft()
+                if entry.refs > 1:
+                    kept.append(entry)
+                else:
+                    self._unref(entry)
+            kept.extend(self.ring)
+            self.ring = kept
+        return dropped
+
+    def drop_tail(self, user_id: int) -> bool:
+        tail = self.tails.pop(user_id, None)
+        if tail is None:
+            return False
+        while tail:
+            self._tail_popleft(tail)
+        return True
+
+    def to_dict(self) -> dict:
+        entries = list(dict.fromkeys([*self.ring, *(e for tail in self.tails.values() for e in tail)]))
+        index = {id(entry): i for i, entry in enumerate(entries)}
+        return {
+            "entries": [[e.user_id, e.name, e.role, e.text] for e in entries],
+            "ring": [index[id(e)] for e in self.ring],
+            "tails": [[user_id, [index[id(e)] for e in tail]] for user_id, tail in self.tails.items()],
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "GroupConversation":
+        conversation = cls()
+        entries = [GroupEntry(*item) for item in data.get("entries", [])]
+        for i in data.get("ring", []):
+            conversation.ring.append(entries[i])
+            conversation._ref(entries[i])
+        for user_id, indices in data.get("tails", []):
+            tail = conversation.tails[user_id] = deque()
+            for i in indices:
+                conversation._tail_append(tail, entries[i])
+        return conversation
+
+
+# Общая история групп: одна ограниченная по памяти лента на чат вместо копии
+# переписки у каждого участника. В промпт попадают лента (одним системным
+# сообщением) и хвост переписки текущего участника с ботом
+class GroupContextManager:
+    def __init__(self, system_prompt: str, max_bytes: int, user_turns: int = 2, backend=None,
+                 memory_limit: int = 64 * 1024 * 1024, idle_ttl: float = 6 * 3600):
+        self.system_message = {"role": "system", "content": system_prompt}
+        self.system_tokens = message_tokens(self.system_message)
+        self.max_bytes = max_bytes
+        self.tail_entries = 2 * user_turns
+        self.contexts = OrderedDict()  # chat_id -> GroupConversation, от давно активных к недавним
+        # Вторичный индекс: user_id -> число групп в памяти, где у пользователя есть хвост
+        self.user_index = {}
+        self.memory_bytes = 0
+        self.memory_limit = memory_limit
+        self.idle_ttl = idle_ttl
+        self.evictions = 0
+        self.backend = backend
+
+    def set_system_prompt(self, system_prompt: str) -> None:
+        self.system_message = {"role": "system", "content": system_prompt}
+        self.system_tokens = message_tokens(self.system_message)
+
+    def _index_add(self, user_id: int) -> None:
+        self.user_index[user_id] = self.user_index.get(user_id, 0) + 1
+
+    def _index_remove(self, user_id: int) -> None:
+        count = self.user_index[user_id] - 1
+        if count:
+            self.user_index[user_id] = count
+        else:
+            del self.user_index[user_id]
+
+    def _evict(self) -> None:
+        deadline = time.monotonic() - self.idle_ttl
+        while self.contexts:
+            chat_id, conversation = next(iter(self.contexts.items()))
+            expired = conversation.last_access < deadline
+            over_limit = self.memory_bytes > self.memory_limit and len(self.contexts) > 1
+            if not expired and not over_limit:
+                break
+            del self.contexts[chat_id]
+            self.memory_bytes -= conversation.size
+            for user_id in conversation.tails:
+                self._index_remove(user_id)
+            self.evictions += 1
+
+    def _get(self, chat_id: int):
+        conversation = self.contexts.get(chat_id)
+        if conversation is not None:
+            self.contexts.move_to_end(chat_id)
+        elif self.backend is not None:
+            data = self.backend.load_context((chat_id, GROUP_USER_ID))
+            if data is not None:
+                conversation = self.contexts[chat_id] = GroupConversation.from_dict(data)
+                self.memory_bytes += conversation.size
+                for user_id in conversation.tails:
+                    self._index_add(user_id)
+        if conversation is not None:
+            conversation.last_access = time.monotonic()
+        return conversation
+
+    def build_messages(self, key, user_message: dict):
+        chat_id, user_id = key
+        conversation = self._get(chat_id)
+        messages = [self.system_message]
+        prompt_tokens = self.system_tokens + message_tokens(user_message)
+
+        if conversation is not None:
+            tail = conversation.tails.get(user_id, ())
+            own = {id(entry) for entry in tail}
+            lines = [entry.line() for entry in conversation.ring if id(entry) not in own]
+            if lines:
+                group = GROUP_HEADER + "\n".join(lines)
+                messages.append({"role": "system", "content": group})
+                prompt_tokens += text_tokens(group)
+            for entry in tail:
+                messages.append({"role": entry.role, "content": entry.text})
+                prompt_tokens += text_tokens(entry.text)
+
+        messages.append(user_message)
+        return messages, prompt_tokens
+
+    # Общая лента группы строками; хвосты участников в нее уже входят
+    def history_lines(self, key) -> list:
+        conversation = self._get(key[0])
+        if conversation is None:
+            return []
+        return [entry.line() for entry in conversation.ring]
+
+    def append_turn(self, key, user_message: dict, assistant_message: dict):
+        chat_id, user_id = key
+        # Сообщение участника имеет вид "Имя: текст", имя подписывает ответ бота в ленте
+        name = user_message["content"].partition(": ")[0]
+        conversation = self._get(chat_id)
+        if conversation is None:
+            conversation = self.contexts[chat_id] = GroupConversation()
+            self.memory_bytes += conversation.size
+
+        size_before = conversation.size
+        joined = user_id not in conversation.tails
+        conversation.add(GroupEntry(user_id, name, "user", user_message["content"]), self.tail_entries)
+        conversation.add(GroupEntry(user_id, name, "assistant", assistant_message["content"]), self.tail_entries)
+        dropped = conversation.trim(self.max_bytes, user_id)
+
+        self.memory_bytes += conversation.size - size_before
+        if joined:
+            self._index_add(user_id)
+        for member in dropped:
+            self._index_remove(member)
+        if self.backend is not None:
+            self.backend.save_context((chat_id, GROUP_USER_ID), conversation.to_dict())
+            if joined:
+                self.backend.save_group_member(chat_id, user_id)
+            for member in dropped:
+                self.backend.delete_group_member(chat_id, member)
+        self._evict()
+
+    # Есть ли у пользователя хвост переписки хотя бы в одной группе, за O(1)
+    def has_context(self, user_id: int) -> bool:
+        if user_id in self.user_index:
+            return True
+        return self.backend is not None and self.backend.has_context(user_id)
+
+    # Очистка переписки участника с ботом; общая лента группы остается
+    def clear(self, key) -> bool:
+        chat_id, user_id = key
+        conversation = self._get(chat_id)
+        if conversation is None:
+            return False
+        size_before = conversation.size
+        existed = conversation.drop_tail(user_id)
+        self.memory_bytes += conversation.size - size_before
+        if existed:
+            self._index_remove(user_id)
+        if existed and self.backend is not None:
+            self.backend.save_context((chat_id, GROUP_USER_ID), conversation.to_dict())
+            self.backend.delete_group_member(chat_id, user_id)
+        return existed
@@ -0,0 +1,91 @@
+# Проверка ограничителя исходящих запросов против заглушки Bot API с 429:
+# ни одно сообщение не должно потеряться, повторные sendChatAction склеиваются.
+#
+#   python loadtest/check_sender.py [--chats N] [--messages N] [--flood-rate 0.1] [--json]
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram.ext import ExtBot
+
+from outbound import OutboundLimiter
+from fake_telegram import FakeBotAPI
+
+
+async def run(args) -> dict:
+    api = FakeBotAPI(port=args.port, flood_rate=args.flood_rate, retry_after=1,
+                     chat_limit=(args.chat_limit, 1.0), seed=1)
+    await api.start()
+    counters = {"waits": 0, "retry_after": 0, "merged": 0, "dropped": 0}
+    limiter = OutboundLimiter(
+        args.global_rate, args.private_rate, args.group_rate, burst=3, max_retries=5,
+        on_wait=lambda method, delay: counters.__setitem__("waits", counters["waits"] + 1),
+        on_retry_after=lambda method, delay: counters.__setitem__("retry_after", counters["retry_after"] + 1),
+        on_merged=lambda: counters.__setitem__("merged", counters["merged"] + 1),
+        on_dropped=lambda method: counters.__setitem__("dropped", counters["dropped"] + 1),
+    )
+    bot = ExtBot(api.token, base_url=api.base_url, rate_limiter=limiter)
+    chats = [1000 + i for i in range(args.chats // 2)] + [-100000 - i for i in range(args.chats - args.chats // 2)]
+    failures = []
+
+    async def chat_traffic(chat_id: int):
+        for i in range(args.messages):
+            # Как handle_message: индикатор набора перед каждым ответом
+            await asyncio.gather(*(bot.send_chat_action(chat_id, "typing") for _ in range(3)))
+            try:
+                await bot.send_message(chat_id, f"message {i}")
+            except Exception as e:
+                failures.append(f"{chat_id}: {type(e).__name__}: {e}")
+
+    try:
+        await bot.initialize()
+        started = time.perf_counter()
+        await asyncio.gather(*(chat_traffic(chat_id) for chat_id in chats))
+        elapsed = time.perf_counter() - started
+    finally:
+        await bot.shutdown()
+        await api.stop()
+
+    expected = len(chats) * args.messages
+    delivered = sum(1 for _, method, _, _ in api.sent if method == "sendMessage")
+    return {
+        "expected": expected,
+        "delivered": delivered,
+        "failures": len(failures),
+        "failure_samples": failures[:5],
+        "seconds": round(elapsed, 2),
+        "server_floods": sum(api.floods.values()),
+        "chat_actions_sent": api.calls["sendChatAction"],
+        "limiter": counters,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8091)
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=5)
+    parser.add_argument("--flood-rate", type=float, default=0.1)
+    parser.add_argument("--chat-limit", type=int, default=3, help="sends per chat per second before the stub answers 429")
+    parser.add_argument("--global-rate", type=float, default=30)
+    parser.add_argument("--private-rate", type=float, default=1)
+    parser.add_argument("--group-rate", type=float, default=1)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(result))
+    else:
+        for name, value in result.items():
+            print(f"{name:>20}: {value}")
+    sys.exit(0 if result["delivered"] == result["expected"] and not result["failures"] else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+# Локальная заглушка OpenAI-совместимого API: /chat/completions (обычный и потоковый
+# режим) и /models. Задержка до первого токена берется из заданного распределения,
+# ответ может начинаться с блока <think>, как у deepseek-r1.
+#
+#   python loadtest/fake_llm.py [--port 8082] [--latency lognormal:1.5,0.5] [--think-words 40]
+import os
+import re
+import sys
+import json
+import math
+import time
+import random
+import asyncio
+import argparse
+import itertools
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from webserver import HTTPServer, Response, StreamingResponse
+
+WORDS = (
+    "привет как дела я рада тебя видеть сегодня хороший день чтобы поговорить о чем угодно "
+    "расскажи что нового у тебя произошло за неделю мне правда интересно"
+).split()
+THINK_WORDS = "пользователь спрашивает нужно ответить дружелюбно коротко и по делу".split()
+# Номера сообщений в запросе на пачку сообщений группы: "[1] Имя: текст"
+BURST_NUMBER = re.compile(r'^\[(\d+)\] ', re.MULTILINE)
+
+
+# Распределение задержки из строки: "fixed:1.0", "uniform:0.5,3", "lognormal:median,sigma"
+def parse_latency(spec: str):
+    kind, _, params = spec.partition(":")
+    values = [float(v) for v in params.split(",") if v]
+    if kind == "fixed":
+        return lambda rng: values[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "lognormal":
+        mu = math.log(values[0])
+        return lambda rng: rng.lognormvariate(mu, values[1])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+class FakeLLM:
+    def __init__(self, host: str = "127.0.0.1", port: int = 8082, latency: str = "fixed:0.5",
+                 token_delay: float = 0.01, answer_words: int = 40, think_words: int = 20,
+                 error_rate: float = 0.0, seed: int = None):
+        self.host = host
+        self.port = port
+        self.latency = parse_latency(latency)
+        self.token_delay = token_delay
+        self.answer_words = answer_words
+        self.think_words = think_words
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.ids = itertools.count(1)
+        self.requests = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.server = HTTPServer(host, port)
+        self.server.route("POST", "/v1/chat/completions", self.chat_completions)
+        self.server.route("GET", "/v1/models", self.models)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1"
+
+    async def start(self) -> None:
+        await self.server.start()
+
+    async def stop(self) -> None:
+        await self.server.stop()
+
+    # На пачку сообщений отвечаем каждому номеру отдельно, как просит бот
+    def _tokens(self, payload: dict) -> list:
+        messages = payload.get("messages") or [{}]
+        numbers = BURST_NUMBER.findall(messages[-1].get("content", ""))
+        tokens = []
+        if self.think_words:
+            thought = " ".join(self.random.choice(THINK_WORDS) for _ in range(self.think_words))
+            tokens.extend(["<think>"] + [word + " " for word in thought.split()] + ["</think>\n\n"])
+        for number in numbers or [None]:
+            if number is not None:
+                tokens.append(f"\n[{number}] ")
+            words = [self.random.choice(WORDS) for _ in range(self.answer_words)]
+            for i, word in enumerate(words):
+                tokens.append(word + ("." if i % 8 == 7 else "") + " ")
+            tokens[-1] = tokens[-1].rstrip(" .") + "."
+        return tokens
+
+    def _usage(self, payload: dict, tokens: list) -> dict:
+        prompt = sum(len(m.get("content", "")) for m in payload.get("messages", [])) // 4
+        self.prompt_tokens += prompt
+        return {"prompt_tokens": prompt, "completion_tokens": len(tokens), "total_tokens": prompt + len(tokens)}
+
+    async def models(self, request) -> Response:
+        return Response(200, json.dumps({"object": "list", "data": [{"id": "fake", "object": "model"}]}), "application/json")
+
+    async def chat_completions(self, request) -> Response:
+        self.requests += 1
+        payload = request.json()
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.errors += 1
+            await asyncio.sleep(self.latency(self.random) / 4)
+            error = {"error": {"message": "upstream overloaded", "type": "server_error"}}
+            return Response(503, json.dumps(error), "application/json")
+
+        tokens = self._tokens(payload)
+        if payload.get("stream"):
+            return StreamingResponse(self._stream(payload, tokens))
+
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency(self.random) + self.token_delay * len(tokens))
+        finally:
+            self.in_flight -= 1
+        body = {
+            "id": f"chatcmpl-{next(self.ids)}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": payload.get("model", "fake"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(tokens)},
+                "finish_reason": "stop",
+            }],
+            "usage": self._usage(payload, tokens),
+        }
+        return Response(200, json.dumps(body), "application/json")
+
+    async def _stream(self, payload: dict, tokens: list):
+        completion_id = f"chatcmpl-{next(self.ids)}"
+        base = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": payload.get("model", "fake"),
+        }
+
+        def event(choices: list, usage: dict = None) -> str:
+            chunk = dict(base, choices=choices)
+            if usage is not None:
+                chunk["usage"] = usage
+            return f"data: {json.dumps(chunk)}\n\n"
+
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency(self.random))
+            yield event([{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}])
+            for token in tokens:
+                await asyncio.sleep(self.token_delay)
+                yield event([{"index": 0, "delta": {"content": token}, "finish_reason": None}])
+            yield event([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            if (payload.get("stream_options") or {}).get("include_usage"):
+                yield event([], self._usage(payload, tokens))
+            yield "data: [DONE]\n\n"
+        finally:
+            self.in_flight -= 1
+
+    def stats(self) -> dict:
+        return {"requests": self.requests, "errors": self.errors, "prompt_tokens": self.prompt_tokens,
+                "max_in_flight": self.max_in_flight}
+
+
+async def serve(args) -> None:
+    llm = FakeLLM(args.host, args.port, args.latency, args.token_delay, args.answer_words,
+                  args.think_words, args.error_rate)
+    await llm.start()
+    print(f"Fake LLM on {llm.base_url}", flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await llm.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--latency", default="lognormal:1.5,0.5")
+    parser.add_argument("--token-delay", type=float, default=0.01)
+    parser.add_argument("--answer-words", type=int, default=40)
+    parser.add_argument("--think-words", type=int, default=20)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,217 @@
+# Локальная заглушка Bot API для нагрузочных проверок: getMe, getUpdates,
+# sendMessage, editMessageText, sendChatAction и служебные методы.
+# Умеет отвечать 429 (Retry-After) случайно и при превышении лимита чата.
+#
+#   python loadtest/fake_telegram.py [--port 8081] [--flood-rate 0.05]
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import itertools
+from collections import defaultdict, deque
+from urllib.parse import parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from webserver import HTTPServer, Response
+
+TOKEN = "123456:loadtest"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Алиса", "username": "aliceneyrobot"}
+
+# Методы, которые создают или меняют сообщения и подпадают под лимиты Telegram
+SEND_METHODS = {"sendMessage", "editMessageText", "sendChatAction"}
+
+
+def _parse_params(request) -> dict:
+    if not request.body:
+        return dict(request.query)
+    if request.headers.get("content-type", "").startswith("application/json"):
+        return request.json()
+    params = {k: v[-1] for k, v in parse_qs(request.body.decode("utf-8")).items()}
+    # PTB передает вложенные объекты и числа в виде JSON-строк
+    for name, value in params.items():
+        if value[:1] in ("{", "[") or value.lstrip("-").isdigit():
+            try:
+                params[name] = json.loads(value)
+            except ValueError:
+                pass
+    return params
+
+
+def _ok(result) -> Response:
+    return Response(200, json.dumps({"ok": True, "result": result}), "application/json")
+
+
+def _flood(retry_after: int) -> Response:
+    body = {
+        "ok": False,
+        "error_code": 429,
+        "description": f"Too Many Requests: retry after {retry_after}",
+        "parameters": {"retry_after": retry_after},
+    }
+    return Response(429, json.dumps(body), "application/json")
+
+
+# Заглушка Bot API. chat_limit=(N, window) отвечает 429 на N+1-ю отправку в чат
+# за window секунд, flood_rate - доля случайных 429
+class FakeBotAPI:
+    def __init__(self, host: str = "127.0.0.1", port: int = 8081, token: str = TOKEN,
+                 flood_rate: float = 0.0, retry_after: int = 1, chat_limit: tuple = None,
+                 seed: int = None):
+        self.host = host
+        self.port = port
+        self.token = token
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.chat_limit = chat_limit
+        self.random = random.Random(seed)
+        self.server = HTTPServer(host, port)
+        self.updates = asyncio.Queue()
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.chat_sends = defaultdict(deque)   # chat_id -> время последних отправок
+        self.calls = defaultdict(int)          # метод -> число вызовов
+        self.floods = defaultdict(int)         # метод -> число ответов 429
+        self.sent = []                         # (время, метод, chat_id, текст)
+        self.listeners = []                    # callback(method, params) для каждой отправки
+        for method, handler in (
+            ("getMe", self.get_me),
+            ("getUpdates", self.get_updates),
+            ("sendMessage", self.send_message),
+            ("editMessageText", self.edit_message_text),
+            ("sendChatAction", self.send_chat_action),
+        ):
+            self.server.route("POST", f"/bot{token}/{method}", self._wrap(method, handler))
+        for method in ("setMyCommands", "deleteWebhook", "setWebhook", "answerCallbackQuery", "close"):
+            self.server.route("POST", f"/bot{token}/{method}", self._wrap(method, self.accept))
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/bot"
+
+    async def start(self) -> None:
+        await self.server.start()
+
+    async def stop(self) -> None:
+        await self.server.stop()
+
+    def _wrap(self, method: str, handler):
+        async def endpoint(request):
+            self.calls[method] += 1
+            params = _parse_params(request)
+            if method in SEND_METHODS:
+                flood = self._check_flood(params.get("chat_id"))
+                if flood:
+                    self.floods[method] += 1
+                    return _flood(flood)
+                self.sent.append((time.monotonic(), method, params.get("chat_id"), params.get("text")))
+                for listener in self.listeners:
+                    listener(method, params)
+            return await handler(params)
+        return endpoint
+
+    def _check_flood(self, chat_id) -> int:
+        if self.flood_rate and self.random.random() < self.flood_rate:
+            return self.retry_after
+        if self.chat_limit is None:
+            return 0
+        limit, window = self.chat_limit
+        now = time.monotonic()
+        sends = self.chat_sends[chat_id]
+        while sends and now - sends[0] > window:
+            sends.popleft()
+        if len(sends) >= limit:
+            return max(1, int(window - (now - sends[0])) + 1)
+        sends.append(now)
+        return 0
+
+    def _message(self, chat_id, text: str, message_id: int = None) -> dict:
+        chat_id = int(chat_id)
+        chat_type = "private" if chat_id > 0 else "supergroup"
+        return {
+            "message_id": message_id or next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": chat_type},
+            "from": BOT_USER,
+            "text": text,
+        }
+
+    # Входящее сообщение пользователя для getUpdates; reply_to_bot - ответ на сообщение бота.
+    # Возвращает message_id, по которому бот отвечает в группах
+    def push_message(self, chat_id: int, user_id: int, first_name: str, text: str,
+                     reply_to_bot: bool = False) -> int:
+        update_id = next(self.update_ids)
+        chat = {"id": chat_id, "type": "private"} if chat_id > 0 else {"id": chat_id, "type": "supergroup", "title": "loadtest"}
+        message = {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": chat,
+            "from": {"id": user_id, "is_bot": False, "first_name": first_name},
+            "text": text,
+        }
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        if reply_to_bot:
+            message["reply_to_message"] = self._message(chat_id, "...")
+        self.updates.put_nowait({"update_id": update_id, "message": message})
+        return message["message_id"]
+
+    async def get_me(self, params: dict) -> Response:
+        return _ok(BOT_USER)
+
+    async def get_updates(self, params: dict) -> Response:
+        timeout = float(params.get("timeout") or 0)
+        limit = int(params.get("limit") or 100)
+        batch = []
+        try:
+            batch.append(await asyncio.wait_for(self.updates.get(), timeout) if timeout else self.updates.get_nowait())
+        except (asyncio.TimeoutError, asyncio.QueueEmpty):
+            return _ok([])
+        while len(batch) < limit and not self.updates.empty():
+            batch.append(self.updates.get_nowait())
+        return _ok(batch)
+
+    async def send_message(self, params: dict) -> Response:
+        return _ok(self._message(params["chat_id"], params.get("text", "")))
+
+    async def edit_message_text(self, params: dict) -> Response:
+        return _ok(self._message(params["chat_id"], params.get("text", ""), int(params["message_id"])))
+
+    async def send_chat_action(self, params: dict) -> Response:
+        return _ok(True)
+
+    async def accept(self, params: dict) -> Response:
+        return _ok(True)
+
+    def stats(self) -> dict:
+        return {
+            "calls": dict(self.calls),
+            "floods": dict(self.floods),
+            "delivered": len(self.sent),
+        }
+
+
+async def serve(args) -> None:
+    api = FakeBotAPI(args.host, args.port, flood_rate=args.flood_rate, retry_after=args.retry_after)
+    await api.start()
+    print(f"Fake Bot API on {api.base_url}{api.token}/", flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await api.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--flood-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
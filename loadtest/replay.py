@@ -0,0 +1,272 @@
+# Нагрузочный прогон бота целиком на локальных заглушках: бот из main.py работает в
+# режиме polling против fake_telegram, запросы к LLM уходят в fake_llm.
+# Виртуальные пользователи пишут в личку и в группы (часть групповых сообщений
+# не адресована боту), каждый ждет ответа перед следующим сообщением.
+# Отчет: пропускная способность, p50/p95/p99 времени до ответа, рост памяти.
+#
+#   python loadtest/replay.py [--users 200] [--messages 5] [--json]
+#   python loadtest/replay.py --save-baseline baseline.json
+#   python loadtest/replay.py --baseline baseline.json [--tolerance 0.15]   # код 1 при регрессии
+#
+# Цена логгирования в потоке событий: сравнить loop_cpu_ms_per_message при
+#   LOG_ASYNC=0 python loadtest/replay.py --log-level INFO
+#   LOG_ASYNC=1 python loadtest/replay.py --log-level INFO
+#
+# Объединение сообщений групп: сравнить llm.requests и llm.prompt_tokens при
+#   python loadtest/replay.py --group-share 1 --burst-window 0
+#   python loadtest/replay.py --group-share 1 --burst-window 1.5
+#
+# Общая история групп: сравнить context_memory_kb и prompt_tokens при
+#   python loadtest/replay.py --group-share 1
+#   python loadtest/replay.py --group-share 1 --group-context
+#
+# Масштабирование по процессам: сравнить throughput_rps при --workers 1, 2, 4
+# (память и процессорное время в отчете - только процесса-приемника)
+import os
+import sys
+import json
+import math
+import time
+import random
+import asyncio
+import logging
+import argparse
+import contextlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_telegram import FakeBotAPI, BOT_USER
+from fake_llm import FakeLLM
+
+GROUP_NOISE = ["всем привет", "кто идет гулять?", "скиньте ссылку", "ахаха", "ну и погода"]
+PROMPTS = ["привет, как дела?", "что посоветуешь посмотреть вечером?", "расскажи что-нибудь",
+           "почему небо голубое?", "как прошел твой день?", "ты кто?"]
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(values: list, q: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))
+    return round(ordered[index], 4)
+
+
+# Настройки бота для прогона; STATE_BACKEND и STREAM_REPLIES можно задать в окружении
+def configure_bot(args, api: FakeBotAPI, llm: FakeLLM) -> None:
+    os.environ.update({
+        "TG_TOKEN": api.token,
+        "TELEGRAM_BASE_URL": api.base_url,
+        "NOVITA_API_KEY": "loadtest",
+        "NOVITA_BASE_URL": llm.base_url,
+        "BOT_USERNAME": "@" + BOT_USER["username"],
+        "BOT_MODE": "polling",
+        "PORT": str(args.health_port),
+        "WORKERS": str(args.workers),
+        "GROUP_BURST_WINDOW": str(args.burst_window),
+        "GROUP_CONTEXT": "1" if args.group_context else "0",
+    })
+    os.environ.setdefault("STATE_BACKEND", "memory")
+    os.environ.setdefault("STREAM_REPLIES", "1" if args.stream else "0")
+    os.chdir(ROOT)
+
+
+class Replayer:
+    def __init__(self, args, api: FakeBotAPI):
+        self.args = args
+        self.api = api
+        self.random = random.Random(args.seed)
+        self.by_chat = {}       # chat_id личного чата -> Future ответа
+        self.by_message = {}    # message_id группового сообщения -> Future ответа
+        self.latencies = []
+        self.timeouts = 0
+        self.noise = 0
+        api.listeners.append(self.on_send)
+
+    def on_send(self, method: str, params: dict) -> None:
+        if method != "sendMessage":
+            return
+        future = self.by_message.pop(params.get("reply_to_message_id"), None)
+        if future is None:
+            future = self.by_chat.pop(params.get("chat_id"), None)
+        if future is not None and not future.done():
+            future.set_result(time.perf_counter())
+
+    async def user(self, index: int) -> None:
+        args = self.args
+        in_group = index < args.users * args.group_share
+        chat_id = -1000 - index % args.groups if in_group else 10000 + index
+        user_id = 10000 + index
+        name = f"User{index}"
+        loop = asyncio.get_running_loop()
+        await asyncio.sleep(self.random.uniform(0, args.ramp))
+
+        for _ in range(args.messages):
+            if in_group:
+                for _ in range(args.noise):
+                    self.api.push_message(chat_id, user_id, name, self.random.choice(GROUP_NOISE))
+                    self.noise += 1
+                text = f"@{BOT_USER['username']} {self.random.choice(PROMPTS)}"
+            else:
+                text = self.random.choice(PROMPTS)
+
+            future = loop.create_future()
+            started = time.perf_counter()
+            message_id = self.api.push_message(chat_id, user_id, name, text)
+            if in_group:
+                self.by_message[message_id] = future
+            else:
+                self.by_chat[chat_id] = future
+            try:
+                replied = await asyncio.wait_for(future, args.timeout)
+                self.latencies.append(replied - started)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                self.by_message.pop(message_id, None)
+                self.by_chat.pop(chat_id, None)
+            await asyncio.sleep(self.random.expovariate(1 / args.think) if args.think else 0)
+
+
+async def run(args) -> dict:
+    api = FakeBotAPI(port=args.telegram_port, flood_rate=args.flood_rate, seed=args.seed)
+    llm = FakeLLM(port=args.llm_port, latency=args.latency, token_delay=args.token_delay,
+                  think_words=args.think_words, error_rate=args.error_rate, seed=args.seed)
+    await api.start()
+    await llm.start()
+    configure_bot(args, api, llm)
+
+    import main
+    logging.getLogger().setLevel(args.log_level)
+
+    bot_task = asyncio.create_task(main.run_bot(main.build_application()))
+    replayer = Replayer(args, api)
+    memory = []
+    try:
+        deadline = time.monotonic() + 30
+        while not main.ready():
+            if bot_task.done() or time.monotonic() > deadline:
+                bot_task.result()
+                raise RuntimeError("bot did not become ready")
+            await asyncio.sleep(0.05)
+
+        memory.append(rss_mb())
+        started = time.perf_counter()
+        # Процессорное время потока событий (бот и заглушки работают в нем же)
+        loop_cpu = time.thread_time()
+        users = asyncio.gather(*(replayer.user(i) for i in range(args.users)))
+        while not users.done():
+            await asyncio.wait([users], timeout=1)
+            memory.append(rss_mb())
+        await users
+        elapsed = time.perf_counter() - started
+        loop_cpu = time.thread_time() - loop_cpu
+    finally:
+        bot_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await bot_task
+        await llm.stop()
+        await api.stop()
+
+    replied = len(replayer.latencies)
+    return {
+        "users": args.users,
+        "workers": args.workers,
+        "messages": args.users * args.messages,
+        "replied": replied,
+        "timeouts": replayer.timeouts,
+        "group_noise": replayer.noise,
+        "seconds": round(elapsed, 2),
+        "throughput_rps": round(replied / elapsed, 2) if elapsed else 0,
+        "latency_p50": percentile(replayer.latencies, 0.50),
+        "latency_p95": percentile(replayer.latencies, 0.95),
+        "latency_p99": percentile(replayer.latencies, 0.99),
+        "handler_p95_bucket": main.MESSAGE_LATENCY.quantile(0.95),
+        "loop_cpu_seconds": round(loop_cpu, 2),
+        "loop_cpu_ms_per_message": round(loop_cpu / max(1, replied + replayer.noise) * 1e3, 3),
+        "rss_start_mb": round(memory[0], 1),
+        "rss_peak_mb": round(max(memory), 1),
+        "rss_growth_mb": round(memory[-1] - memory[0], 1),
+        "contexts": len(main.user_contexts) + len(main.group_contexts.contexts),
+        "context_memory_kb": round((main.context_manager.memory_bytes + main.group_contexts.memory_bytes) / 1024, 1),
+        "llm": llm.stats(),
+        "telegram": api.stats(),
+    }
+
+
+# Сравнение с сохраненным прогоном: снижение пропускной способности или рост задержки
+# и памяти больше чем на tolerance считается регрессией
+def compare(result: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    if result["throughput_rps"] < baseline["throughput_rps"] * (1 - tolerance):
+        regressions.append(f"throughput {result['throughput_rps']} < baseline {baseline['throughput_rps']}")
+    for name in ("latency_p50", "latency_p95", "latency_p99"):
+        if baseline.get(name) and result.get(name) and result[name] > baseline[name] * (1 + tolerance):
+            regressions.append(f"{name} {result[name]} > baseline {baseline[name]}")
+    # Небольшой абсолютный запас: рост памяти в пределах пары мегабайт - шум аллокатора
+    if result["rss_growth_mb"] > baseline["rss_growth_mb"] * (1 + tolerance) + 2:
+        regressions.append(f"rss_growth_mb {result['rss_growth_mb']} > baseline {baseline['rss_growth_mb']}")
+    if result["timeouts"] > baseline["timeouts"]:
+        regressions.append(f"timeouts {result['timeouts']} > baseline {baseline['timeouts']}")
+    return regressions
+
+
+def main_replay():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=5, help="addressed messages per user")
+    parser.add_argument("--group-share", type=float, default=0.4)
+    parser.add_argument("--groups", type=int, default=10)
+    parser.add_argument("--noise", type=int, default=3, help="unaddressed group messages per addressed one")
+    parser.add_argument("--think", type=float, default=1.0, help="mean pause between a reply and the next message")
+    parser.add_argument("--ramp", type=float, default=5.0)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--latency", default="lognormal:1.5,0.5", help="LLM time to first token distribution")
+    parser.add_argument("--token-delay", type=float, default=0.01)
+    parser.add_argument("--think-words", type=int, default=20)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--flood-rate", type=float, default=0.0)
+    parser.add_argument("--group-context", action="store_true", help="GROUP_CONTEXT=1")
+    parser.add_argument("--burst-window", type=float, default=0.0, help="GROUP_BURST_WINDOW, seconds")
+    parser.add_argument("--workers", type=int, default=1, help="bot worker processes (WORKERS)")
+    parser.add_argument("--telegram-port", type=int, default=8081)
+    parser.add_argument("--llm-port", type=int, default=8082)
+    parser.add_argument("--health-port", type=int, default=8083)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--baseline")
+    parser.add_argument("--save-baseline")
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(result))
+    else:
+        for name, value in result.items():
+            print(f"{name:>20}: {value}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main_replay()
@@ -0,0 +1,121 @@
+import json
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+
+# Структурированные поля записи лога: logger.info("...", extra=log_fields(chat_id=..., user_id=...))
+FIELDS = "fields"
+
+# Поля с текстом пользователей и модели, которые по умолчанию не попадают в лог
+REDACTED_FIELDS = ("text", "response")
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+
+def log_fields(**fields) -> dict:
+    return {FIELDS: fields}
+
+
+# Логгер одного сообщения: общие поля (chat_id, user_id) добавляются к каждой записи,
+# дополнительные передаются через fields=. Если сообщение не попало в выборку,
+# записи ниже WARNING не создаются вовсе
+class MessageLog(logging.LoggerAdapter):
+    def __init__(self, logger: logging.Logger, sampled: bool = True, **fields):
+        super().__init__(logger, fields)
+        self.sampled = sampled
+
+    def isEnabledFor(self, level: int) -> bool:
+        if not self.sampled and level < logging.WARNING:
+            return False
+        return self.logger.isEnabledFor(level)
+
+    def process(self, msg, kwargs):
+        fields = kwargs.pop(FIELDS, None)
+        kwargs["extra"] = {FIELDS: {**self.extra, **fields} if fields else self.extra}
+        return msg, kwargs
+
+
+def sample(rate: float) -> bool:
+    return rate >= 1 or random.random() < rate
+
+
+# Форматирование в фоновом потоке: сообщение, затем поля key=value или JSON.
+# Тексты сообщений заменяются их длиной, если redact включен
+class StructuredFormatter(logging.Formatter):
+    def __init__(self, json_output: bool = False, redact: bool = True):
+        super().__init__(TEXT_FORMAT)
+        self.json_output = json_output
+        self.redact = redact
+
+    def _fields(self, record: logging.LogRecord) -> dict:
+        fields = getattr(record, FIELDS, None)
+        if not fields:
+            return {}
+        if self.redact:
+            fields = {
+                name: f"<{len(value)} chars>" if name in REDACTED_FIELDS and isinstance(value, str) else value
+                for name, value in fields.items()
+            }
+        return fields
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = self._fields(record)
+        if self.json_output:
+            entry = {
+                "time": self.formatTime(record),
+                "logger": record.name,
+                "level": record.levelname,
+                "message": record.getMessage(),
+                **fields,
+            }
+            if record.exc_info:
+                entry["exception"] = self.formatException(record.exc_info)
+            return json.dumps(entry, ensure_ascii=False, default=str)
+        line = super().format(record)
+        if fields:
+            line += " " + " ".join(f"{name}={value}" for name, value in fields.items())
+        return line
+
+
+# Обработчик, который только кладет запись в очередь: форматирование и вывод
+# выполняет QueueListener в своем потоке. При переполнении очереди запись теряется
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    # Стандартный prepare форматирует запись в вызывающем потоке - здесь это не нужно
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+# Настройка логгирования: корневой логгер пишет в очередь, поток-слушатель форматирует
+# и выводит записи. Возвращает обработчик очереди (None в синхронном режиме)
+def setup_logging(level=logging.INFO, json_output: bool = False, redact: bool = True,
+                  queue_size: int = 10000, asynchronous: bool = True):
+    output = logging.StreamHandler()
+    output.setFormatter(StructuredFormatter(json_output, redact))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+
+    if not asynchronous:
+        root.addHandler(output)
+        return None
+
+    handler = NonBlockingQueueHandler(queue.Queue(queue_size))
+    listener = logging.handlers.QueueListener(handler.queue, output, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    root.addHandler(handler)
+    return handler
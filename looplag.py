@@ -0,0 +1,130 @@
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+
+# Стек указанного потока в текстовом виде
+def thread_stack(thread_id: int) -> str:
+    frame = sys._current_frames().get(thread_id)
+    if frame is None:
+        return "<thread not found>"
+    return "".join(traceback.format_stack(frame))
+
+
+# Сторож цикла событий: задача в цикле каждые interval секунд отмечается и замеряет
+# задержку своего пробуждения, отдельный поток следит за отметками. Если цикл не
+# отмечался дольше threshold, в лог один раз за зависание пишется стек потока цикла
+class LoopWatchdog:
+    def __init__(self, threshold: float, interval: float = 0.25, on_lag=None, on_stall=None):
+        self.threshold = threshold
+        self.interval = interval
+        self.on_lag = on_lag
+        self.on_stall = on_stall
+        self.last_beat = time.monotonic()
+        self.max_lag = 0.0
+        self.stalls = 0
+        self._loop_thread = None
+        self._task = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self) -> None:
+        self._loop_thread = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.get_running_loop().create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    async def stop(self) -> None:
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._thread is not None:
+            await asyncio.to_thread(self._thread.join)
+            self._thread = None
+
+    async def _heartbeat(self) -> None:
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            self.last_beat = now
+            self.max_lag = max(self.max_lag, lag)
+            if self.on_lag is not None:
+                self.on_lag(lag)
+
+    def _watch(self) -> None:
+        stalled_since = None
+        while not self._stopped.wait(self.interval / 2):
+            silence = time.monotonic() - self.last_beat - self.interval
+            if silence > self.threshold:
+                if stalled_since is None:
+                    stalled_since = self.last_beat
+                    self.stalls += 1
+                    if self.on_stall is not None:
+                        self.on_stall()
+                    logger.warning(
+                        f"Event loop blocked for {silence:.2f}s, loop thread stack:\n"
+                        f"{thread_stack(self._loop_thread)}"
+                    )
+            elif stalled_since is not None:
+                logger.warning(f"Event loop recovered after {time.monotonic() - stalled_since:.2f}s")
+                stalled_since = None
+
+
+# Выборочный профилировщик: в течение duration секунд с шагом interval снимает стек
+# потока (по умолчанию - всех потоков, кроме своего) и считает частоту строк кода.
+# Собственное время - строка на вершине стека, общее - строка где угодно в стеке.
+# Снимок делается, когда поток профилировщика получает GIL, поэтому ожидание ввода-вывода
+# немного переоценивается, а код, долго держащий GIL (то, что блокирует цикл), виден хорошо
+def sample_profile(duration: float, interval: float = 0.005, thread_id: int = None) -> dict:
+    own = threading.get_ident()
+    self_counts = Counter()
+    total_counts = Counter()
+    samples = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        frames = sys._current_frames()
+        for ident, frame in frames.items():
+            if ident == own or (thread_id is not None and ident != thread_id):
+                continue
+            samples += 1
+            seen = set()
+            leaf = True
+            while frame is not None:
+                code = frame.f_code
+                key = (code.co_filename, frame.f_lineno, code.co_name)
+                if leaf:
+                    self_counts[key] += 1
+                    leaf = False
+                if key not in seen:
+                    total_counts[key] += 1
+                    seen.add(key)
+                frame = frame.f_back
+        del frames
+        time.sleep(interval)
+    return {"samples": samples, "self": self_counts, "total": total_counts}
+
+
+def format_profile(profile: dict, top: int = 20) -> str:
+    samples = profile["samples"] or 1
+    lines = [f"Samples: {profile['samples']}"]
+    for title, counts in (("Self", profile["self"]), ("Total", profile["total"])):
+        lines.append(f"\n{title}:")
+        for (filename, lineno, name), count in counts.most_common(top):
+            short = "/".join(filename.rsplit("/", 2)[-2:])
+            lines.append(f"{count / samples * 100:5.1f}% {name} ({short}:{lineno})")
+    return "\n".join(lines)
@@ -1,14 +1,36 @@
 import os
 import logging
 import asyncio
-import threading
+import signal
 import time
 import re
 import random
-import json
-from datetime import datetime, timedelta
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from openai import OpenAI
+import io
+import hashlib
+import hmac
+import functools
+import threading
+import contextlib
+from collections import deque
+import httpx
+from openai import AsyncOpenAI
+from contexts import GROUP_HEADER, GROUP_USER_ID, ContextManager, GroupContextManager, lines_within
+from storage import StateBackend, create_backend
+from quota import MODE_TOKENS, QuotaEngine, ReferralBook
+from shared import LocalState, RemoteState
+from sharding import ShardConnection, ShardIngress, WorkerPool
+from webserver import HTTPServer, Response
+from metrics import REGISTRY, counter, gauge, histogram
+from admission import AdmissionController, Overloaded, parse_class_waits
+from resilience import CircuitBreaker, LLMUnavailable, ResilientCaller
+from router import ModelRouter, Route, parse_keywords
+from cache import ResponseCache, normalize_prompt, prompt_fingerprint
+from outbound import OutboundLimiter, SendDropped
+from settings import load_settings
+from logs import MessageLog, log_fields, sample, setup_logging
+from burst import BurstCollector, split_replies
+from looplag import LoopWatchdog, format_profile, sample_profile
+from think import ThinkStripper
 from telegram import (
     Update, 
     InlineKeyboardButton, 
@@ -16,6 +38,7 @@ from telegram import (
     BotCommand,
     constants
 )
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -23,20 +46,166 @@ from telegram.ext import (
     ContextTypes,
     filters,
     ConversationHandler,
-    CallbackQueryHandler
+    CallbackQueryHandler,
+    TypeHandler
 )
 
-# Настройка логгирования
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO
+# Настройка логгирования: записи пишет фоновый поток, тексты сообщений скрыты,
+# подробные записи по сообщениям ведутся для доли LOG_SAMPLE_RATE сообщений
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_ASYNC = os.getenv("LOG_ASYNC", "1") == "1"
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 1.0))
+LOG_MESSAGE_BODIES = os.getenv("LOG_MESSAGE_BODIES", "0") == "1"
+log_handler = setup_logging(
+    LOG_LEVEL,
+    json_output=LOG_FORMAT == "json",
+    redact=not LOG_MESSAGE_BODIES,
+    queue_size=LOG_QUEUE_SIZE,
+    asynchronous=LOG_ASYNC
 )
 logger = logging.getLogger(__name__)
+message_logger = logging.getLogger("bot.messages")
+
+# Метрики обработки сообщений
+STAGE_LATENCY = histogram(
+    "bot_stage_latency_seconds", "Latency of message pipeline stages", ("stage",)
+)
+MESSAGE_LATENCY = histogram(
+    "bot_message_latency_seconds", "End-to-end latency of handle_message"
+)
+STREAM_FIRST_TEXT = histogram(
+    "bot_stream_first_text_seconds", "Time from LLM request to the first visible streamed text"
+)
+FILTER_DECISIONS = counter(
+    "bot_filter_decisions_total", "Group messages checked by the addressed_to_bot filter", ("result",)
+)
+LIMIT_REJECTIONS = counter(
+    "bot_limit_rejections_total", "Messages rejected by the daily limit"
+)
+LLM_ERRORS = counter(
+    "bot_llm_errors_total", "Failed LLM requests", ("error",)
+)
+LLM_TOKENS = counter(
+    "bot_llm_tokens_total", "Tokens reported by the LLM provider", ("kind", "route")
+)
+CACHE_LOOKUPS = counter(
+    "bot_response_cache_lookups_total", "Response cache lookups", ("result",)
+)
+CACHE_BYTES = gauge(
+    "bot_response_cache_bytes", "Approximate memory used by the response cache"
+)
+CACHE_ENTRIES = gauge(
+    "bot_response_cache_entries", "Entries in the response cache"
+)
+HANDLER_ERRORS = counter(
+    "bot_handler_errors_total", "Unhandled errors in handle_message"
+)
+LLM_IN_FLIGHT = gauge(
+    "bot_llm_in_flight", "LLM requests currently in flight"
+)
+USER_QUEUE_DROPPED = counter(
+    "bot_user_queue_dropped_updates_total", "Updates dropped because the user's queue was full"
+)
+LLM_ATTEMPT_LATENCY = histogram(
+    "bot_llm_attempt_seconds", "Latency of a single LLM attempt (to the first chunk when streaming)", ("mode", "route")
+)
+ROUTE_LATENCY = histogram(
+    "bot_route_latency_seconds", "Total LLM latency per route", ("route",)
+)
+GROUP_BURST_SIZE = histogram(
+    "bot_group_burst_size", "Addressed group messages answered by one LLM call",
+    buckets=(1, 2, 3, 4, 6, 8, 12)
+)
+ROUTE_DECISIONS = counter(
+    "bot_route_decisions_total", "Messages routed to each model route", ("route",)
+)
+LLM_RETRIES = counter(
+    "bot_llm_retries_total", "LLM attempts retried after a retryable error", ("model",)
+)
+LLM_HEDGES = counter(
+    "bot_llm_hedges_total", "Hedged second LLM attempts started"
+)
+LLM_FALLBACKS = counter(
+    "bot_llm_fallbacks_total", "LLM requests sent to the fallback model while the circuit was open"
+)
+LLM_CIRCUIT_STATE = gauge(
+    "bot_llm_circuit_state", "Circuit breaker state per model (0 closed, 1 half-open, 2 open)", ("model",)
+)
+LLM_QUEUE_DEPTH = gauge(
+    "bot_llm_queue_depth", "LLM requests waiting for admission"
+)
+LLM_SHED = counter(
+    "bot_llm_shed_total", "LLM requests shed by admission control", ("priority", "reason")
+)
+LOOP_LAG = histogram(
+    "bot_event_loop_lag_seconds", "Scheduling delay of the event loop heartbeat"
+)
+LOOP_STALLS = counter(
+    "bot_event_loop_stalls_total", "Times the event loop was blocked longer than LOOP_LAG_THRESHOLD"
+)
+LOG_DROPPED = gauge(
+    "bot_log_records_dropped", "Log records dropped because the log queue was full"
+)
+if log_handler is not None:
+    LOG_DROPPED.set_function(lambda: log_handler.dropped)
+SHARD_WORKERS_CONNECTED = gauge(
+    "bot_shard_workers_connected", "Worker processes connected to the shard ingress"
+)
+SHARD_FORWARDED = gauge(
+    "bot_shard_forwarded_updates", "Updates forwarded by the shard ingress", ("worker",)
+)
+SHARD_WORKER_RESTARTS = gauge(
+    "bot_shard_worker_restarts", "Worker processes restarted after an unexpected exit"
+)
+CONTEXT_MEMORY = gauge(
+    "bot_context_memory_bytes", "Approximate memory held by dialog histories", ("kind",)
+)
+SETTINGS_RELOADS = counter(
+    "bot_settings_reloads_total", "Persona and settings reloads", ("result",)
+)
+IN_FLIGHT_MESSAGES = gauge(
+    "bot_in_flight_messages", "Messages currently being handled"
+)
+OUTBOUND_WAITS = histogram(
+    "bot_outbound_wait_seconds", "Time outgoing Bot API requests waited for rate limits", ("method",)
+)
+OUTBOUND_RETRY_AFTER = counter(
+    "bot_outbound_retry_after_total", "Flood limit (429) responses from the Bot API", ("method",)
+)
+OUTBOUND_MERGED = counter(
+    "bot_outbound_chat_actions_merged_total", "Repeated chat actions merged into an earlier one"
+)
+OUTBOUND_DROPPED = counter(
+    "bot_outbound_dropped_total", "Optional outgoing requests dropped by rate limits", ("method",)
+)
 
 # Загрузка конфигурации
 TOKEN = os.getenv("TG_TOKEN")
 NOVITA_API_KEY = os.getenv("NOVITA_API_KEY")
 BOT_USERNAME = os.getenv("BOT_USERNAME", "@aliceneyrobot")
+NOVITA_BASE_URL = os.getenv("NOVITA_BASE_URL", "https://api.novita.ai/v3/openai")
+# Адрес Bot API (для локального сервера Bot API или нагрузочного стенда)
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL", "")
+LLM_MODEL = os.getenv("LLM_MODEL", "deepseek/deepseek-r1-0528")
+LLM_MAX_TOKENS = int(os.getenv("LLM_MAX_TOKENS", 600))
+LLM_TEMPERATURE = float(os.getenv("LLM_TEMPERATURE", 0.7))
+
+# Маршрутизация: короткие простые сообщения - быстрой модели без рассуждений
+# (пустой ROUTER_FAST_MODEL отключает маршрутизацию)
+ROUTER_FAST_MODEL = os.getenv("ROUTER_FAST_MODEL", "deepseek/deepseek-v3-0324")
+ROUTER_FAST_MAX_TOKENS = int(os.getenv("ROUTER_FAST_MAX_TOKENS", 300))
+ROUTER_FAST_MAX_CHARS = int(os.getenv("ROUTER_FAST_MAX_CHARS", 80))
+ROUTER_FAST_MAX_QUESTIONS = int(os.getenv("ROUTER_FAST_MAX_QUESTIONS", 1))
+ROUTER_COMPLEX_KEYWORDS = parse_keywords(os.getenv("ROUTER_COMPLEX_KEYWORDS", ""))
+
+# Параметры пула соединений с Novita API
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", 100))
+LLM_MAX_KEEPALIVE = int(os.getenv("LLM_MAX_KEEPALIVE", 20))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", 60))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", 10))
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", 120))
 
 # Идентификатор разработчика
 DEVELOPER_ID = 1040929628
@@ -44,60 +213,272 @@ DEVELOPER_ID = 1040929628
 # Идентификатор чата без ограничений
 UNLIMITED_CHAT_ID = -1001481824277
 
+# Режим получения обновлений: polling или webhook (по умолчанию webhook, если задан WEBHOOK_URL)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+BOT_MODE = os.getenv("BOT_MODE", "webhook" if WEBHOOK_URL else "polling")
+
+# Потоковая выдача ответов: первое сообщение отправляется сразу, затем редактируется
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", 1.5))
+
+# Бюджет токенов для истории диалога и краткого содержания вытесненных реплик
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", 1500))
+SUMMARY_TOKEN_BUDGET = int(os.getenv("SUMMARY_TOKEN_BUDGET", 300))
+
+# Ограничение памяти под истории диалогов и время простоя до вытеснения
+CONTEXT_MEMORY_LIMIT_MB = int(os.getenv("CONTEXT_MEMORY_LIMIT_MB", 64))
+CONTEXT_IDLE_TTL = float(os.getenv("CONTEXT_IDLE_TTL", 6 * 3600))
+
+# Общая история групп: одна лента реплик на чат с потолком памяти и короткий хвост
+# переписки каждого участника вместо отдельной истории у каждого (по умолчанию выключено)
+GROUP_CONTEXT = os.getenv("GROUP_CONTEXT", "0") == "1"
+GROUP_CONTEXT_MAX_KB = float(os.getenv("GROUP_CONTEXT_MAX_KB", 8))
+GROUP_CONTEXT_USER_TURNS = int(os.getenv("GROUP_CONTEXT_USER_TURNS", 2))
+
+# Хранилище состояния: sqlite (по умолчанию) или memory
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "state.db")
+
+# Кэш ответов на повторяющиеся запросы (по умолчанию выключен)
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "0") == "1"
+RESPONSE_CACHE_MAX_MB = float(os.getenv("RESPONSE_CACHE_MAX_MB", 16))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 600))
+# Сколько последних пар реплик истории допускается в кэшируемом запросе
+RESPONSE_CACHE_HISTORY_TURNS = int(os.getenv("RESPONSE_CACHE_HISTORY_TURNS", 0))
+
+# Объединение адресованных боту сообщений группы, пришедших в пределах окна (секунды),
+# в один запрос к LLM с ответом каждому отправителю (0 - выключено)
+GROUP_BURST_WINDOW = float(os.getenv("GROUP_BURST_WINDOW", 0))
+GROUP_BURST_MAX = int(os.getenv("GROUP_BURST_MAX", 6))
+
+# Файлы персонажа и настроек, перечитываемых без перезапуска (SIGHUP или /dev reload)
+PERSONA_FILE = os.getenv("PERSONA_FILE", "persona.txt")
+SETTINGS_FILE = os.getenv("SETTINGS_FILE", "settings.json")
+
+# Остановка: сколько ждать завершения обрабатываемых сообщений, секунды; отбрасывать ли
+# накопившиеся у Telegram обновления при запуске
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", 30))
+DROP_PENDING_UPDATES = os.getenv("DROP_PENDING_UPDATES", "0") == "1"
+
+# Лимиты исходящих запросов к Telegram: общий, на личный чат и на группу (сообщений в секунду)
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", 30))
+OUTBOUND_PRIVATE_RATE = float(os.getenv("OUTBOUND_PRIVATE_RATE", 1))
+OUTBOUND_GROUP_RATE = float(os.getenv("OUTBOUND_GROUP_RATE", 20 / 60))
+OUTBOUND_BURST = float(os.getenv("OUTBOUND_BURST", 3))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", 2))
+
+# Горизонтальное масштабирование: при WORKERS > 1 этот процесс только принимает обновления
+# и раздает их воркерам по chat_id, а лимиты и рефералы хранит у себя
+WORKERS = int(os.getenv("WORKERS", 1))
+SHARD_SOCKET = os.getenv("SHARD_SOCKET", f"/tmp/aliceneyrobot-shards-{os.getpid()}.sock")
+SHARD_STOP_TIMEOUT = float(os.getenv("SHARD_STOP_TIMEOUT", 30))
+
+# Сторож цикла событий: стек блокирующего кода пишется в лог, если цикл не отвечает дольше порога
+LOOP_WATCHDOG = os.getenv("LOOP_WATCHDOG", "1") == "1"
+LOOP_LAG_THRESHOLD = float(os.getenv("LOOP_LAG_THRESHOLD", 1.0))
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", 0.25))
+
+# Длительность профилирования через /dev profile, секунды
+PROFILE_DEFAULT_SECONDS = 10
+PROFILE_MAX_SECONDS = 120
+
+# Максимальная длина сообщения Telegram
+MAX_MESSAGE_LENGTH = 4096
+
+# Очередь запросов к Novita API: размер, классы приоритета (по убыванию важности)
+# и максимальное время ожидания каждого класса, секунды
+LLM_QUEUE_SIZE = int(os.getenv("LLM_QUEUE_SIZE", 200))
+LLM_CLASS_WAITS = parse_class_waits(
+    os.getenv("LLM_CLASS_WAITS", ""),
+    {"developer": 120, "private": 30, "unlimited": 20, "group": 15}
+)
+
+# Одновременные запросы к Novita API ограничены размером пула соединений
+llm_admission = AdmissionController(LLM_MAX_CONNECTIONS, LLM_QUEUE_SIZE, LLM_CLASS_WAITS)
+LLM_QUEUE_DEPTH.set_function(lambda: llm_admission.depth)
+
+# Повторы, хеджирование и автоматический выключатель для запросов к Novita API
+LLM_RETRIES_MAX = int(os.getenv("LLM_RETRIES", 2))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", 0.5))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", 8))
+LLM_HEDGE = os.getenv("LLM_HEDGE", "1") == "1"
+LLM_HEDGE_QUANTILE = float(os.getenv("LLM_HEDGE_QUANTILE", 0.95))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", 50))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", 5))
+LLM_BREAKER_RECOVERY = float(os.getenv("LLM_BREAKER_RECOVERY", 30))
+LLM_FALLBACK_MODEL = os.getenv("LLM_FALLBACK_MODEL", "")
+
+model_router = ModelRouter(
+    Route("reasoning", LLM_MODEL, LLM_MAX_TOKENS, LLM_TEMPERATURE),
+    Route("fast", ROUTER_FAST_MODEL, ROUTER_FAST_MAX_TOKENS, LLM_TEMPERATURE) if ROUTER_FAST_MODEL else None,
+    fast_max_chars=ROUTER_FAST_MAX_CHARS,
+    fast_max_questions=ROUTER_FAST_MAX_QUESTIONS,
+    complex_keywords=ROUTER_COMPLEX_KEYWORDS
+)
+
+llm_caller = ResilientCaller(
+    LLM_RETRIES_MAX,
+    LLM_RETRY_BASE_DELAY,
+    LLM_RETRY_MAX_DELAY,
+    LLM_BREAKER_FAILURES,
+    LLM_BREAKER_RECOVERY,
+    fallback_model=LLM_FALLBACK_MODEL,
+    on_retry=lambda model, error: LLM_RETRIES.inc(model=model),
+    on_hedge=lambda: LLM_HEDGES.inc(),
+    on_fallback=lambda model, fallback: LLM_FALLBACKS.inc()
+)
+CIRCUIT_STATES = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+for _model in filter(None, (LLM_MODEL, ROUTER_FAST_MODEL, LLM_FALLBACK_MODEL)):
+    LLM_CIRCUIT_STATE.set_function(
+        lambda m=_model: CIRCUIT_STATES[llm_caller.breaker(m).state], model=_model
+    )
+
+ERROR_REPLY = "Произошла ошибка при обработке запроса. Попробуйте позже."
+BUSY_REPLY = "Алиса сейчас слишком занята и не успевает всем ответить. Напиши ещё раз чуть позже."
+
+# Максимальное число одновременно обрабатываемых обновлений
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", 64))
+# Сколько обновлений одного пользователя в одном чате может ждать обработки
+USER_QUEUE_LIMIT = int(os.getenv("USER_QUEUE_LIMIT", 20))
+
+# Дневной лимит сообщений и бонус за каждого приглашенного пользователя
+BASE_DAILY_LIMIT = 35
+REFERRAL_BONUS = 3
+
+# Режим лимита: messages - по числу сообщений, tokens - по токенам запросов к LLM
+# (prompt + completion); каждое доступное сообщение дает QUOTA_TOKENS_PER_MESSAGE токенов
+QUOTA_MODE = os.getenv("QUOTA_MODE", "messages")
+QUOTA_TOKENS_PER_MESSAGE = int(os.getenv("QUOTA_TOKENS_PER_MESSAGE", 1500))
+
 # Состояния для ConversationHandler разработчика
 SELECT_USER, SELECT_ACTION, INPUT_AMOUNT = range(3)
 
 # Глобальные переменные
-user_contexts = {}
-daily_message_counters = {}  # Формат: {(user_id, date): count}
-user_bonus_messages = {}    # Формат: {(user_id, date): bonus_count}
-user_referrals = {}         # Формат: {referrer_id: count}
-user_invited_by = {}        # Формат: {invited_user_id: referrer_id}
-last_cleanup_time = time.time()
-
-# Путь к файлу реферальных данных
+loop_watchdog = None        # Сторож цикла событий, запускается в run_bot
+llm_client = None           # Общий клиент Novita API, создается в post_init
+state_store = StateBackend()  # Хранилище состояния, заменяется в init_state_store
+bot_user = None             # Данные бота из get_me, запрашиваются один раз при запуске
+is_ready = False            # Бот запущен и принимает обновления
+shard_ingress = None        # Раздача обновлений воркерам (только при WORKERS > 1)
+shard_worker_index = None   # Номер воркера в процессе-воркере
+active_messages = set()     # Задачи обрабатываемых сообщений, дожидаются при остановке
+handler_tasks = set()       # Задачи обработчиков PTB, отменяются, если не завершились к сроку остановки
+reload_tasks = set()        # Задачи перезагрузки настроек по SIGHUP
+
+# Путь к файлу реферальных данных (переносится в хранилище один раз)
 REF_DATA_FILE = "ref_data.json"
 
 # Список эмодзи для использования
 EMOJI_LIST = ["😊", "😂", "😍", "🤔", "😎", "👍", "❤️", "✨", "🎉", "💔"]
 
-# Загрузка реферальных данных
-def load_ref_data():
-    global user_referrals, user_invited_by
-    try:
-        if os.path.exists(REF_DATA_FILE):
-            with open(REF_DATA_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                user_referrals = data.get("user_referrals", {})
-                user_invited_by = data.get("user_invited_by", {})
-                # Преобразование ключей в int (JSON сохраняет ключи как строки)
-                user_referrals = {int(k): v for k, v in user_referrals.items()}
-                user_invited_by = {int(k): int(v) for k, v in user_invited_by.items()}
-            logger.info("Ref data loaded successfully")
-    except Exception as e:
-        logger.error(f"Error loading ref data: {e}")
+# Последовательная обработка обновлений с одним ключом: у каждого ключа своя очередь
+# и одна задача, которая разбирает ее по порядку. Слот обработки (limit на все ключи)
+# занимает только обновление, которое обрабатывается сейчас, поэтому ожидающие своей
+# очереди обновления одного ключа не мешают остальным чатам
+class KeyedQueues:
+    def __init__(self, limit: int, max_pending: int):
+        self._queues = {}
+        self._slots = asyncio.Semaphore(limit)
+        self.max_pending = max_pending
+        self.tasks = set()
+
+    # Постановка задачи в очередь ключа; spawn запускает обработчик очереди.
+    # False - очередь ключа переполнена, задача отброшена
+    def submit(self, key, job, spawn) -> bool:
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque([job])
+            task = spawn(self._run(key, queue))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+            return True
+        if len(queue) >= self.max_pending:
+            return False
+        queue.append(job)
+        return True
 
-# Сохранение реферальных данных
-def save_ref_data():
+    async def _run(self, key, queue) -> None:
+        try:
+            while queue:
+                async with self._slots:
+                    try:
+                        await queue[0]()
+                    except Exception as e:
+                        logger.error("Ordered handler failed", extra=log_fields(
+                            chat_id=key[0], user_id=key[1], error=repr(e)
+                        ))
+                queue.popleft()
+        finally:
+            if self._queues.get(key) is queue:
+                del self._queues[key]
+
+    def __len__(self):
+        return len(self._queues)
+
+# Обновления одного пользователя в одном чате обрабатываются строго по порядку,
+# обновления разных чатов и пользователей - параллельно, не более MAX_CONCURRENT_UPDATES
+user_queues = KeyedQueues(MAX_CONCURRENT_UPDATES, USER_QUEUE_LIMIT)
+
+def per_user_ordered(handler):
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        message = update.effective_message
+        user = update.effective_user
+        if message is None or user is None:
+            return await handler(update, context)
+        # Обработчик PTB сразу возвращается, обновление ждет своей очереди без слота PTB;
+        # задачи через application.create_task дожидаются при остановке
+        key = (message.chat_id, user.id)
+        queued = user_queues.submit(
+            key,
+            functools.partial(handler, update, context),
+            lambda coro: context.application.create_task(coro, update=update)
+        )
+        if not queued:
+            USER_QUEUE_DROPPED.inc()
+            logger.warning("Update dropped, too many queued updates", extra=log_fields(
+                chat_id=key[0], user_id=key[1]
+            ))
+    return wrapper
+
+# Открытие хранилища состояния и однократный перенос ref_data.json
+def init_state_store():
+    global state_store
     try:
-        data = {
-            "user_referrals": user_referrals,
-            "user_invited_by": user_invited_by
-        }
-        with open(REF_DATA_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        logger.info("Ref data saved successfully")
+        state_store = create_backend(STATE_BACKEND, STATE_DB_PATH, REF_DATA_FILE)
     except Exception as e:
-        logger.error(f"Error saving ref data: {e}")
+        logger.error(f"Error opening state store, falling back to memory: {e}")
+        state_store = StateBackend()
+    context_manager.backend = state_store
+    group_contexts.backend = state_store
+    quota.backend = state_store
+    referrals.backend = state_store
+
+# Реферальные связи и дневные лимиты сообщений
+referrals = ReferralBook(day=lambda: quota.day)
+quota = QuotaEngine(
+    BASE_DAILY_LIMIT, REFERRAL_BONUS, referrals.count, mode=QUOTA_MODE, tokens_per_message=QUOTA_TOKENS_PER_MESSAGE
+)
+
+# Общее состояние пользователей: в этом процессе или, в воркере, у процесса-приемника
+shared_state = LocalState(quota, referrals)
+
+# Правила общения, добавляемые к персонажу из файла
+PERSONA_RULES = "\n\nТы общаешься в чате с разными пользователями. Обращайся к ним по именам. " \
+                "Учитывай историю переписки с каждым пользователем отдельно. " \
+                "Всегда завершай сообщение полностью. " \
+                "Форматируй ответы с абзацами и отступами, где это уместно."
+
+# Чтение персонажа из файла; ошибка чтения - исключение
+def read_persona(path: str) -> str:
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read().strip() + PERSONA_RULES
 
 # Загрузка персонажа
 try:
-    with open("persona.txt", "r", encoding="utf-8") as f:
-        PERSONA = f.read().strip()
-    PERSONA += "\n\nТы общаешься в чате с разными пользователями. Обращайся к ним по именам. " \
-               "Учитывай историю переписки с каждым пользователем отдельно. " \
-               "Всегда завершай сообщение полностью. " \
-               "Форматируй ответы с абзацами и отступами, где это уместно."
+    PERSONA = read_persona(PERSONA_FILE)
 except Exception as e:
     logger.error(f"Error loading persona: {e}")
     PERSONA = "Ты девушка, тебе 18 лет, тебя зовут Алиса Двачевская, у тебя грубый характер но ранимая натура. " \
@@ -108,75 +489,124 @@ except Exception as e:
               "Всегда завершай сообщение полностью. " \
               "Форматируй ответы с абзацами и отступами, где это уместно."
 
-# Функция очистки устаревших счетчиков
-def cleanup_old_counters():
-    global daily_message_counters, user_bonus_messages, last_cleanup_time
-    current_time = time.time()
-    
-    # Проверяем каждые 30 минут
-    if current_time - last_cleanup_time > 1800:
-        logger.info("Starting cleanup of old message counters")
-        today = datetime.utcnow().date()
-        keys_to_delete = []
-        
-        # Очистка daily_message_counters
-        for key in list(daily_message_counters.keys()):
-            user_id, date_str = key
-            try:
-                record_date = datetime.strptime(date_str, "%Y-%m-%d").date()
-                if (today - record_date).days > 1:
-                    keys_to_delete.append(key)
-                    del daily_message_counters[key]
-            except ValueError:
-                # Удаляем невалидные ключи
-                del daily_message_counters[key]
-                logger.warning(f"Removed invalid key: {key}")
-        
-        # Очистка user_bonus_messages
-        for key in list(user_bonus_messages.keys()):
-            user_id, date_str = key
-            try:
-                record_date = datetime.strptime(date_str, "%Y-%m-%d").date()
-                if (today - record_date).days > 1:
-                    if key not in keys_to_delete:
-                        keys_to_delete.append(key)
-                    del user_bonus_messages[key]
-            except ValueError:
-                del user_bonus_messages[key]
-                logger.warning(f"Removed invalid key: {key}")
-        
-        last_cleanup_time = current_time
-        logger.info(f"Cleanup completed. Removed {len(keys_to_delete)} old counters")
+# Менеджер контекста диалогов, ключ - (chat_id, user_id)
+context_manager = ContextManager(
+    PERSONA,
+    HISTORY_TOKEN_BUDGET,
+    SUMMARY_TOKEN_BUDGET,
+    memory_limit=CONTEXT_MEMORY_LIMIT_MB * 1024 * 1024,
+    idle_ttl=CONTEXT_IDLE_TTL
+)
+user_contexts = context_manager.contexts
 
-# Функция проверки лимита сообщений
-def check_message_limit(user_id: int) -> bool:
-    today = datetime.utcnow().strftime("%Y-%m-%d")
-    key = (user_id, today)
-    
-    # Очистка старых записей перед проверкой
-    cleanup_old_counters()
-    
-    # Базовый лимит
-    base_limit = 35
-    
-    # Бонус за рефералов
-    referral_bonus = user_referrals.get(user_id, 0) * 3
-    
-    # Бонусные сообщения от разработчика
-    bonus_messages = user_bonus_messages.get(key, 0)
-    
-    # Общий доступный лимит
-    total_limit = base_limit + referral_bonus + bonus_messages
-    
-    # Инициализация счетчика
-    if key not in daily_message_counters:
-        daily_message_counters[key] = 0
+# Общие истории групп (используются при GROUP_CONTEXT)
+group_contexts = GroupContextManager(
+    PERSONA,
+    int(GROUP_CONTEXT_MAX_KB * 1024),
+    GROUP_CONTEXT_USER_TURNS,
+    memory_limit=CONTEXT_MEMORY_LIMIT_MB * 1024 * 1024,
+    idle_ttl=CONTEXT_IDLE_TTL
+)
+CONTEXT_MEMORY.set_function(lambda: context_manager.memory_bytes, kind="user")
+CONTEXT_MEMORY.set_function(lambda: group_contexts.memory_bytes, kind="group")
+
+# Менеджер истории для чата: в группах при GROUP_CONTEXT - общая история группы
+def contexts_for(chat):
+    if GROUP_CONTEXT and chat.type != constants.ChatType.PRIVATE:
+        return group_contexts
+    return context_manager
+
+# Версия персонажа для ключей кэша ответов
+PERSONA_VERSION = hashlib.sha1(PERSONA.encode("utf-8")).hexdigest()[:12]
+
+# Указание модели для ответа на пачку сообщений группы (см. answer_group_burst)
+GROUP_BURST_INSTRUCTION = "Сейчас тебе пришло сразу несколько сообщений от разных людей в группе, " \
+                          "каждое со своим номером в квадратных скобках. Ответь каждому отдельно и коротко. " \
+                          "Каждый ответ начинай с новой строки с номера сообщения в квадратных скобках, " \
+                          "например: [1] текст ответа."
+
+# Кэш ответов на повторяющиеся запросы
+response_cache = ResponseCache(int(RESPONSE_CACHE_MAX_MB * 1024 * 1024), RESPONSE_CACHE_TTL)
+CACHE_BYTES.set_function(lambda: response_cache.bytes)
+CACHE_ENTRIES.set_function(lambda: len(response_cache))
+
+# Значения перечитываемых настроек из переменных окружения и констант
+def settings_defaults() -> dict:
+    return {
+        "base_daily_limit": BASE_DAILY_LIMIT,
+        "referral_bonus": REFERRAL_BONUS,
+        "tokens_per_message": QUOTA_TOKENS_PER_MESSAGE,
+        "llm_model": LLM_MODEL,
+        "llm_temperature": LLM_TEMPERATURE,
+        "llm_max_tokens": LLM_MAX_TOKENS,
+        "fast_model": ROUTER_FAST_MODEL,
+        "fast_max_tokens": ROUTER_FAST_MAX_TOKENS,
+    }
+
+# Применение персонажа и настроек. Выполняется синхронно в цикле событий, поэтому
+# каждый запрос видит либо старые, либо новые значения целиком; уже начатые запросы
+# завершаются со старыми
+def apply_settings(persona: str, settings: dict) -> None:
+    global PERSONA, PERSONA_VERSION, runtime_settings
+    PERSONA = persona
+    PERSONA_VERSION = hashlib.sha1(PERSONA.encode("utf-8")).hexdigest()[:12]
+    context_manager.set_system_prompt(persona)
+    group_contexts.set_system_prompt(persona)
     
-    # Проверка лимита
-    if daily_message_counters[key] >= total_limit:
-        return False
+    quota.base_limit = settings["base_daily_limit"]
+    quota.per_referral = settings["referral_bonus"]
+    quota.tokens_per_message = settings["tokens_per_message"]
     
-    return True
+    model_router.reasoning = Route(
+        "reasoning", settings["llm_model"], settings["llm_max_tokens"], settings["llm_temperature"]
+    )
+    model_router.fast = Route(
+        "fast", settings["fast_model"], settings["fast_max_tokens"], settings["llm_temperature"]
+    ) if settings["fast_model"] else None
+    for model in filter(None, (settings["llm_model"], settings["fast_model"])):
+        LLM_CIRCUIT_STATE.set_function(
+            lambda m=model: CIRCUIT_STATES[llm_caller.breaker(m).state], model=model
+        )
+    runtime_settings = settings
+
+# Перечитывание persona.txt и файла настроек (SIGHUP или /dev reload).
+# При ошибке остаются прежние значения; возвращает список изменившихся параметров
+async def reload_settings() -> list:
+    try:
+        persona = await asyncio.to_thread(read_persona, PERSONA_FILE)
+        settings = await asyncio.to_thread(load_settings, SETTINGS_FILE, settings_defaults())
+    except (OSError, ValueError) as e:
+        SETTINGS_RELOADS.inc(result="error")
+        logger.error(f"Settings reload failed, keeping current settings: {e}")
+        raise
+    changed = [name for name, value in settings.items() if runtime_settings[name] != value]
+    if persona != PERSONA:
+        changed.append("persona")
+    apply_settings(persona, settings)
+    SETTINGS_RELOADS.inc(result="ok")
+    logger.info(f"Settings reloaded, changed: {', '.join(changed) or 'nothing'}")
+    return changed
+
+# Настройки при запуске: ошибочный файл настроек не мешает старту
+try:
+    runtime_settings = load_settings(SETTINGS_FILE, settings_defaults())
+except (OSError, ValueError) as e:
+    logger.error(f"Error loading {SETTINGS_FILE}, using defaults: {e}")
+    runtime_settings = settings_defaults()
+apply_settings(PERSONA, runtime_settings)
+
+# Ключ кэша для запроса или None, если запрос уникален из-за истории диалога
+def response_cache_key(messages: list, text: str, route: Route):
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+    history = messages[1:-1]
+    if len(history) > 2 * RESPONSE_CACHE_HISTORY_TURNS:
+        return None
+    bot_username = bot_user.username if bot_user else BOT_USERNAME.lstrip("@")
+    normalized = normalize_prompt(text, bot_username)
+    if not normalized:
+        return None
+    return prompt_fingerprint(PERSONA_VERSION, f"{route.name}/{route.model}", history, normalized)
 
 # Функция для форматирования действий
 def format_actions(text: str) -> str:
@@ -194,12 +624,37 @@ def add_emojis(text: str) -> str:
             return text + selected_emoji
     return text
 
+# Предварительно скомпилированные шаблоны очистки ответа
+SENTENCE_END = re.compile(r'[.!?…]$')
+WHITESPACE_RUN = re.compile(r'\s+')
+PARAGRAPH_BREAK = re.compile(r'\n\s*\n')
+
+# Удаление блоков <think>...</think>: то же, что re.sub(r'<think>.*?</think>', '', text, flags=re.DOTALL),
+# но через str.find - ленивый шаблон на длинных рассуждениях R1 в десятки раз медленнее
+def strip_think_blocks(text: str) -> str:
+    parts = []
+    position = 0
+    while True:
+        start = text.find('<think>', position)
+        if start < 0:
+            break
+        end = text.find('</think>', start + 7)
+        if end < 0:
+            break
+        parts.append(text[position:start])
+        position = end + 8
+    if not parts:
+        return text
+    parts.append(text[position:])
+    return ''.join(parts)
+
 # Функция для завершения незаконченных предложений
 def complete_sentences(text: str) -> str:
     if not text:
         return text
     
-    if not re.search(r'[.!?…]$', text):
+    # '$' совпадает только в конце текста или перед последним '\n' - проверяем два последних символа
+    if not SENTENCE_END.search(text, max(0, len(text) - 2)):
         text += '.'
     
     return text
@@ -210,63 +665,333 @@ def format_paragraphs(text: str) -> str:
     formatted = []
     for paragraph in paragraphs:
         if paragraph.strip():
-            cleaned = re.sub(r'\s+', ' ', paragraph).strip()
+            cleaned = WHITESPACE_RUN.sub(' ', paragraph).strip()
             formatted.append(cleaned)
     
     return '\n\n'.join(formatted)
 
-# Функция для очистки ответа
-def clean_response(response: str) -> str:
-    cleaned = re.sub(r'<think>.*?</think>', '', response, flags=re.DOTALL)
-    cleaned = cleaned.replace('<think>', '').replace('</think>', '')
-    cleaned = cleaned.replace('</s>', '').replace('<s>', '')
+# Функция для очистки ответа без случайных эмодзи (результат можно кэшировать).
+# Дает тот же результат, что последовательность: удаление <think>-блоков и служебных
+# тегов, format_actions, схлопывание пустых строк, complete_sentences, format_paragraphs -
+# но абзацы разбираются за один проход
+def normalize_response(response: str) -> str:
+    cleaned = response
+    if '<' in cleaned:
+        cleaned = strip_think_blocks(cleaned)
+        cleaned = cleaned.replace('<think>', '').replace('</think>', '')
+        cleaned = cleaned.replace('</s>', '').replace('<s>', '')
     
     cleaned = format_actions(cleaned)
-    cleaned = re.sub(r'\n\s*\n', '\n\n', cleaned).strip()
-    cleaned = complete_sentences(cleaned)
-    cleaned = format_paragraphs(cleaned)
-    cleaned = add_emojis(cleaned)
+    
+    # Абзацы разделены пустыми строками; внутри абзаца любые пробелы схлопываются в один
+    paragraphs = [' '.join(paragraph.split()) for paragraph in PARAGRAPH_BREAK.split(cleaned)]
+    cleaned = '\n\n'.join(paragraph for paragraph in paragraphs if paragraph)
+    if cleaned and cleaned[-1] not in '.!?…':
+        cleaned += '.'
     
     return cleaned
 
-# HTTP-сервер для проверки работоспособности
-class HealthHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
-        self.end_headers()
-        self.wfile.write(b'Service is alive')
-    
-    def do_HEAD(self):
-        self.send_response(200)
-        self.end_headers()
-
-def run_http_server(port=8080):
-    server_address = ('', port)
-    httpd = HTTPServer(server_address, HealthHandler)
-    logger.info(f"Starting HTTP health check server on port {port}")
-    httpd.serve_forever()
-
-# Запрос к DeepSeek через Novita API
-def query_chat(messages: list) -> str:
-    try:
-        client = OpenAI(
-            base_url="https://api.novita.ai/v3/openai",
-            api_key=NOVITA_API_KEY,
-        )
+# Функция для очистки ответа
+def clean_response(response: str) -> str:
+    return add_emojis(normalize_response(response))
+
+# Фильтр сообщений, адресованных боту, без обращений к Bot API.
+# В личных чатах пропускаются все сообщения, в группах - только:
+# 1. Ответы на сообщения бота
+# 2. Сообщения с упоминанием бота (@username)
+# 3. Сообщения с именем бота в тексте (без @)
+class AddressedToBotFilter(filters.MessageFilter):
+    __slots__ = ()
+
+    def filter(self, message) -> bool:
+        if message.chat.type == constants.ChatType.PRIVATE:
+            return True
         
-        response = client.chat.completions.create(
-            model="deepseek/deepseek-r1-0528",
-            messages=messages,
-            temperature=0.7,
-            max_tokens=600,
-            stream=False,
-            response_format={"type": "text"}
+        with STAGE_LATENCY.time(stage="filter"):
+            addressed = self._is_addressed(message)
+        FILTER_DECISIONS.inc(result="passed" if addressed else "rejected")
+        return addressed
+
+    @staticmethod
+    def _is_addressed(message) -> bool:
+        text = message.text
+        if not text:
+            return False
+        
+        bot_username = bot_user.username if bot_user else BOT_USERNAME.lstrip("@")
+        reply = message.reply_to_message
+        if reply and reply.from_user and reply.from_user.username == bot_username:
+            return True
+        return f"@{bot_username}" in text or bot_username.lower() in text.lower()
+
+addressed_to_bot = AddressedToBotFilter(name="addressed_to_bot")
+
+# Проверка работоспособности (liveness): процесс жив и event loop отвечает
+async def health(request) -> Response:
+    return Response(200, "Service is alive")
+
+# Бот инициализирован и принимает обновления; при шардировании - и все воркеры подключены
+def ready() -> bool:
+    return is_ready and (shard_ingress is None or shard_ingress.connected() == WORKERS)
+
+# Проверка готовности (readiness)
+async def readiness(request) -> Response:
+    if ready():
+        return Response(200, "Ready")
+    return Response(503, "Not ready")
+
+# Метрики в текстовом формате Prometheus
+async def metrics_endpoint(request) -> Response:
+    return Response(200, REGISTRY.render(), "text/plain; version=0.0.4; charset=utf-8")
+
+# Прием обновлений Telegram через вебхук
+def webhook_handler(application: Application):
+    async def handle(request) -> Response:
+        # При остановке новые обновления не принимаются: Telegram повторит доставку позже
+        if not is_ready:
+            return Response(503, "Shutting down")
+        secret = request.headers.get("x-telegram-bot-api-secret-token", "")
+        if WEBHOOK_SECRET and not hmac.compare_digest(secret.encode(), WEBHOOK_SECRET.encode()):
+            logger.warning("Webhook request with invalid secret token")
+            return Response(403, "Forbidden")
+        try:
+            update = Update.de_json(request.json(), application.bot)
+        except ValueError as e:
+            logger.warning("Invalid webhook payload", extra=log_fields(error=repr(e)))
+            return Response(400, "Bad Request")
+        await application.update_queue.put(update)
+        return Response(200, "OK")
+    return handle
+
+# Создание общего клиента Novita API с пулом keep-alive соединений
+def create_llm_client() -> AsyncOpenAI:
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_MAX_KEEPALIVE,
+            keepalive_expiry=LLM_KEEPALIVE_EXPIRY
+        ),
+        timeout=httpx.Timeout(LLM_READ_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)
+    )
+    # Повторы выполняет ResilientCaller, встроенные повторы клиента отключены
+    return AsyncOpenAI(
+        base_url=NOVITA_BASE_URL,
+        api_key=NOVITA_API_KEY,
+        http_client=http_client,
+        max_retries=0
+    )
+
+# Логирование расхода токенов по данным провайдера
+def log_usage(usage, route: Route) -> None:
+    if usage is None:
+        return
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) if details else None
+    logger.info("Token usage", extra=log_fields(
+        route=route.name,
+        prompt_tokens=usage.prompt_tokens,
+        completion_tokens=usage.completion_tokens,
+        cached_tokens=cached if cached is not None else "n/a"
+    ))
+    LLM_TOKENS.inc(usage.prompt_tokens or 0, kind="prompt", route=route.name)
+    LLM_TOKENS.inc(usage.completion_tokens or 0, kind="completion", route=route.name)
+    if cached:
+        LLM_TOKENS.inc(cached, kind="cached", route=route.name)
+
+# Токены запроса для лимита пользователя
+def usage_tokens(usage) -> int:
+    if usage is None:
+        return 0
+    return (usage.prompt_tokens or 0) + (usage.completion_tokens or 0)
+
+# Класс приоритета запроса к Novita API
+def llm_priority(user_id: int, chat_id: int, is_private: bool) -> str:
+    if user_id == DEVELOPER_ID:
+        return "developer"
+    if chat_id == UNLIMITED_CHAT_ID:
+        return "unlimited"
+    if is_private:
+        return "private"
+    return "group"
+
+# Слот для запроса к Novita API с замером времени ожидания; при перегрузке - Overloaded
+@contextlib.asynccontextmanager
+async def llm_slot(priority: str):
+    try:
+        with STAGE_LATENCY.time(stage="llm_queue_wait"):
+            await llm_admission.acquire(priority)
+    except Overloaded as e:
+        LLM_SHED.inc(priority=e.priority_class, reason=e.reason)
+        raise
+    LLM_IN_FLIGHT.inc()
+    try:
+        yield
+    finally:
+        LLM_IN_FLIGHT.dec()
+        llm_admission.release()
+
+# Задержка запуска хеджированной попытки: квантиль задержки успешных попыток
+def hedge_delay(mode: str, route: Route):
+    if not LLM_HEDGE or LLM_ATTEMPT_LATENCY.count(mode=mode, route=route.name) < LLM_HEDGE_MIN_SAMPLES:
+        return None
+    return LLM_ATTEMPT_LATENCY.quantile(LLM_HEDGE_QUANTILE, mode=mode, route=route.name)
+
+# Одна попытка запроса к Novita API
+async def request_completion(messages: list, model: str, route: Route):
+    started = time.perf_counter()
+    response = await llm_client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=route.temperature,
+        max_tokens=route.max_tokens,
+        stream=False,
+        response_format={"type": "text"}
+    )
+    LLM_ATTEMPT_LATENCY.observe(time.perf_counter() - started, mode="complete", route=route.name)
+    return response
+
+# Запрос к Novita API по выбранному маршруту; при недоступности - LLMUnavailable.
+# on_usage получает usage ответа
+async def query_chat(messages: list, route: Route, on_usage=None) -> str:
+    try:
+        with STAGE_LATENCY.time(stage="llm"), ROUTE_LATENCY.time(route=route.name):
+            response = await llm_caller.call(
+                route.model,
+                lambda model: request_completion(messages, model, route),
+                hedge_delay=hedge_delay("complete", route)
+            )
+    except LLMUnavailable as e:
+        logger.error("Novita API error", extra=log_fields(route=route.name, error=repr(e)))
+        LLM_ERRORS.inc(error=type(e.__cause__ or e).__name__)
+        raise
+    log_usage(response.usage, route)
+    if on_usage is not None and response.usage is not None:
+        on_usage(response.usage)
+    return response.choices[0].message.content
+
+# Одна попытка открытия потока: возвращается после получения первого чанка
+async def open_chat_stream(messages: list, model: str, route: Route):
+    started = time.perf_counter()
+    stream = await llm_client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=route.temperature,
+        max_tokens=route.max_tokens,
+        stream=True,
+        stream_options={"include_usage": True},
+        response_format={"type": "text"}
+    )
+    iterator = stream.__aiter__()
+    try:
+        first_chunk = await iterator.__anext__()
+    except StopAsyncIteration:
+        first_chunk = None
+    except BaseException:
+        await stream.close()
+        raise
+    LLM_ATTEMPT_LATENCY.observe(time.perf_counter() - started, mode="stream", route=route.name)
+    return stream, first_chunk, iterator
+
+async def close_chat_stream(opened) -> None:
+    await opened[0].close()
+
+# Потоковый запрос к Novita API; повторы возможны только до первого чанка
+async def query_chat_stream(messages: list, route: Route, on_usage=None):
+    try:
+        stream, chunk, iterator = await llm_caller.call(
+            route.model,
+            lambda model: open_chat_stream(messages, model, route),
+            discard=close_chat_stream,
+            hedge_delay=hedge_delay("stream", route)
         )
-        return response.choices[0].message.content
-    except Exception as e:
-        logger.error(f"Novita API error: {e}")
-        return "Произошла ошибка при обработке запроса. Попробуйте позже."
+    except LLMUnavailable as e:
+        logger.error("Novita API error", extra=log_fields(route=route.name, error=repr(e)))
+        LLM_ERRORS.inc(error=type(e.__cause__ or e).__name__)
+        raise
+    
+    try:
+        while chunk is not None:
+            if getattr(chunk, "usage", None):
+                log_usage(chunk.usage, route)
+                if on_usage is not None:
+                    on_usage(chunk.usage)
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            try:
+                chunk = await iterator.__anext__()
+            except StopAsyncIteration:
+                break
+    finally:
+        await stream.close()
+
+# Поток ответа оборвался после того, как часть текста уже была отправлена
+class StreamInterrupted(LLMUnavailable):
+    def __init__(self, message: str, sent_message):
+        super().__init__(message)
+        self.sent_message = sent_message
+
+# Видимая часть ответа во время потоковой выдачи
+def visible_stream_text(text: str) -> str:
+    return text.replace('</s>', '').replace('<s>', '').strip()[:MAX_MESSAGE_LENGTH]
+
+# Потоковый ответ: отправляем сообщение при первых видимых токенах и периодически его редактируем
+async def stream_reply(message, messages: list, route: Route, on_usage=None):
+    stripper = ThinkStripper()
+    raw_chunks = []
+    visible = ""
+    sent_message = None
+    shown_text = ""
+    last_edit = 0.0
+    
+    chunks = query_chat_stream(messages, route, on_usage)
+    try:
+        started = time.perf_counter()
+        with STAGE_LATENCY.time(stage="llm"), ROUTE_LATENCY.time(route=route.name):
+            while True:
+                # Ошибкой потока считается только ошибка LLM; ошибки Telegram при отправке
+                # и правке сообщения обрабатывает вызывающий код
+                try:
+                    chunk = await chunks.__anext__()
+                except StopAsyncIteration:
+                    break
+                except LLMUnavailable:
+                    raise
+                except Exception as e:
+                    logger.error("Novita API streaming error", extra=log_fields(route=route.name, error=repr(e)))
+                    LLM_ERRORS.inc(error=type(e).__name__)
+                    raise StreamInterrupted(str(e), sent_message) from e
+                
+                raw_chunks.append(chunk)
+                visible += stripper.feed(chunk)
+                text = visible_stream_text(visible)
+                if not text:
+                    continue
+                
+                now = time.monotonic()
+                if sent_message is None:
+                    STREAM_FIRST_TEXT.observe(time.perf_counter() - started)
+                    sent_message = await message.reply_text(text)
+                    shown_text = text
+                    last_edit = now
+                elif now - last_edit >= STREAM_EDIT_INTERVAL and text != shown_text:
+                    try:
+                        sent_message = await message.get_bot().edit_message_text(
+                            text,
+                            chat_id=sent_message.chat_id,
+                            message_id=sent_message.message_id,
+                            rate_limit_args={"droppable": True}
+                        )
+                        shown_text = text
+                    except SendDropped:
+                        # Промежуточная правка пропущена, текст обновится следующей
+                        pass
+                    except BadRequest as e:
+                        logger.warning("Stream edit failed", extra=log_fields(chat_id=message.chat_id, error=repr(e)))
+                    last_edit = now
+    finally:
+        await chunks.aclose()
+    
+    return "".join(raw_chunks), sent_message
 
 # Обработчики команд
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -274,11 +999,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if context.args and context.args[0].isdigit():
         referrer_id = int(context.args[0])
-        if referrer_id != user.id and user.id not in user_invited_by:
-            user_invited_by[user.id] = referrer_id
-            user_referrals[referrer_id] = user_referrals.get(referrer_id, 0) + 1
+        if await shared_state.register_referral(user.id, referrer_id):
             logger.info(f"New referral: user {user.id} invited by {referrer_id}")
-            save_ref_data()  # Сохраняем изменения
     
     await update.message.reply_text(
         "Привет, меня зовут Алиса, если посмеешь относиться ко мне неуважительно то получишь пару крепких ударов!\n\n"
@@ -301,23 +1023,19 @@ async def info(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def ref_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
-    bot_username = (await context.bot.get_me()).username
+    bot_username = bot_user.username
     ref_link = f"https://t.me/{bot_username}?start={user.id}"
-    count = user_referrals.get(user.id, 0)
     
     # Рассчитать общий доступный лимит для пользователя
-    today = datetime.utcnow().strftime("%Y-%m-%d")
-    key = (user.id, today)
-    base_limit = 35
-    referral_bonus = count * 3
-    bonus_messages = user_bonus_messages.get(key, 0)
-    total_limit = base_limit + referral_bonus + bonus_messages
+    status = await shared_state.status(user.id)
+    count = status.referrals
+    total_limit = status.total
     
     await update.message.reply_text(
         f"👥 <b>Ваша реферальная программа</b>\n\n"
         f"• Ваша ссылка: <code>{ref_link}</code>\n"
         f"• Приглашено пользователей: {count}\n"
-        f"• Каждый приглашенный пользователь увеличивает ваш дневной лимит на +3 сообщения\n"
+        f"• Каждый приглашенный пользователь увеличивает ваш дневной лимит на +{quota.per_referral} сообщения\n"
         f"• Текущий доступный лимит: <b>{total_limit}</b> сообщений в день\n\n"
         f"Поделитесь своей ссылкой с друзьями, чтобы увеличить количество доступных сообщений!",
         parse_mode="HTML"
@@ -328,43 +1046,44 @@ async def clear_context(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
     key = (chat_id, user.id)
     
-    if key in user_contexts:
-        del user_contexts[key]
-        logger.info(f"Context cleared for user {user.full_name} in chat {chat_id}")
+    if contexts_for(update.message.chat).clear(key):
+        logger.info("Context cleared", extra=log_fields(chat_id=chat_id, user_id=user.id))
         await update.message.reply_text("История диалога очищена. Начнем заново!")
     else:
         await update.message.reply_text("У тебя еще нет истории диалога со мной!")
 
 async def stat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
-    today = datetime.utcnow().strftime("%Y-%m-%d")
-    key = (user.id, today)
-    
-    has_context = any(ctx_key[1] == user.id for ctx_key in user_contexts.keys())
     
-    used_messages = daily_message_counters.get(key, 0)
+    has_context = context_manager.has_context(user.id) or group_contexts.has_context(user.id)
     
-    base_limit = 35
-    referral_count = user_referrals.get(user.id, 0)
-    referral_bonus = referral_count * 3
-    bonus_messages = user_bonus_messages.get(key, 0)
-    total_limit = base_limit + referral_bonus + bonus_messages
-    remaining = max(0, total_limit - used_messages)
+    status = await shared_state.status(user.id)
     
     # Проверяем, является ли чат безлимитным
     is_unlimited = update.message.chat_id == UNLIMITED_CHAT_ID
     
     unlimited_info = "\n• Вы находитесь в безлимитном чате" if is_unlimited else ""
     
+    # В режиме tokens лимит определяют токены, сообщения показываются для справки
+    token_info = ""
+    if QUOTA_MODE == MODE_TOKENS:
+        token_info = (
+            f"\n• Токенов на сегодня: {status.tokens_total} "
+            f"({status.tokens_per_message} за каждое доступное сообщение)\n"
+            f"• Использовано токенов: {status.tokens_used}\n"
+            f"• Осталось токенов: <b>{status.tokens_remaining}</b>\n"
+        )
+    
     message = (
         f"📊 <b>Ваш статус:</b>\n"
         f"{unlimited_info}\n\n"
-        f"• Базовый лимит: {base_limit}\n"
-        f"• Бонус за рефералов: +{referral_bonus} (приглашено: {referral_count})\n"
-        f"• Бонусные сообщения: +{bonus_messages}\n"
-        f"• Итого доступно: <b>{total_limit}</b>\n"
-        f"• Использовано: {used_messages}\n"
-        f"• Осталось: <b>{remaining}</b>\n\n"
+        f"• Базовый лимит: {status.base}\n"
+        f"• Бонус за рефералов: +{status.referral_bonus} (приглашено: {status.referrals})\n"
+        f"• Бонусные сообщения: +{status.bonus}\n"
+        f"• Итого доступно: <b>{status.total}</b>\n"
+        f"• Использовано: {status.used}\n"
+        f"• Осталось: <b>{status.remaining}</b>\n"
+        f"{token_info}\n"
         f"• История диалога: {'сохранена' if has_context else 'отсутствует'}\n\n"
         f"💡 Для сброса истории используйте /clear\n"
         f"👥 Приглашайте друзей: /ref"
@@ -381,6 +1100,14 @@ async def dev(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("У вас нет прав для использования этой команды.")
         return
     
+    if context.args and context.args[0] == "profile":
+        await dev_profile(update, context)
+        return ConversationHandler.END
+    
+    if context.args and context.args[0] == "reload":
+        await dev_reload(update, context)
+        return ConversationHandler.END
+    
     await update.message.reply_text(
         "🔧 <b>Режим разработчика</b>\n\n"
         "Введите ID пользователя, с которым хотите работать:",
@@ -389,6 +1116,43 @@ async def dev(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     return SELECT_USER
 
+# /dev profile [секунды] - выборочное профилирование работающего бота
+async def dev_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    seconds = PROFILE_DEFAULT_SECONDS
+    if len(context.args) > 1:
+        if not context.args[1].isdigit():
+            await update.message.reply_text("❌ Длительность должна быть числом секунд.")
+            return
+        seconds = max(1, min(PROFILE_MAX_SECONDS, int(context.args[1])))
+    
+    await update.message.reply_text(f"⏱ Профилирование {seconds} с...")
+    # Профилируем поток цикла событий: именно он обрабатывает обновления
+    loop_thread = threading.get_ident()
+    profile = await asyncio.to_thread(sample_profile, seconds, 0.005, loop_thread)
+    
+    lag = ""
+    if loop_watchdog is not None:
+        lag = f"Max loop lag: {loop_watchdog.max_lag * 1000:.0f} ms, stalls: {loop_watchdog.stalls}\n"
+    summary = lag + format_profile(profile, top=15)
+    await update.message.reply_text(summary[:MAX_MESSAGE_LENGTH])
+    report = io.BytesIO((lag + format_profile(profile, top=100)).encode("utf-8"))
+    await update.message.reply_document(report, filename=f"profile-{int(time.time())}.txt")
+
+# /dev reload - перечитать persona.txt и файл настроек без перезапуска
+async def dev_reload(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if shard_worker_index is not None:
+        # Лимиты хранит приемник: он перечитывает настройки и пересылает сигнал всем воркерам
+        os.kill(os.getppid(), signal.SIGHUP)
+        await update.message.reply_text("🔄 Перезагрузка настроек запрошена во всех процессах.")
+        return
+    
+    try:
+        changed = await reload_settings()
+    except (OSError, ValueError) as e:
+        await update.message.reply_text(f"❌ Настройки не изменены: {e}")
+        return
+    await update.message.reply_text(f"✅ Настройки перезагружены. Изменено: {', '.join(changed) or 'ничего'}")
+
 # Обработка введенного ID пользователя
 async def select_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_input = update.message.text.strip()
@@ -441,23 +1205,19 @@ async def input_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
     amount = int(user_input)
     target_user_id = context.user_data['target_user_id']
     action = context.user_data['action']
-    today = datetime.utcnow().strftime("%Y-%m-%d")
-    key = (target_user_id, today)
-    
-    if key not in user_bonus_messages:
-        user_bonus_messages[key] = 0
     
     if action == "add_messages":
-        user_bonus_messages[key] += amount
+        await shared_state.add_bonus(target_user_id, amount)
         action_result = "добавлены"
     else:
-        user_bonus_messages[key] = max(0, user_bonus_messages[key] - amount)
+        await shared_state.add_bonus(target_user_id, -amount)
         action_result = "убраны"
     
-    current_bonus = user_bonus_messages[key]
-    base_limit = 35
-    referral_bonus = user_referrals.get(target_user_id, 0) * 3
-    total_limit = base_limit + referral_bonus + current_bonus
+    status = await shared_state.status(target_user_id)
+    current_bonus = status.bonus
+    base_limit = status.base
+    referral_bonus = status.referral_bonus
+    total_limit = status.total
     
     report = (
         f"✅ Успешно!\n\n"
@@ -466,6 +1226,8 @@ async def input_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"• Текущие бонусные сообщения: {current_bonus}\n"
         f"• Общий доступный лимит: {total_limit} ({base_limit} базовых + {referral_bonus} реферальных + {current_bonus} бонусных)"
     )
+    if QUOTA_MODE == MODE_TOKENS:
+        report += f"\n• Токены: {status.tokens_used} из {status.tokens_total}"
     
     await update.message.reply_text(report)
     return ConversationHandler.END
@@ -475,103 +1237,370 @@ async def cancel_dev(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("❌ Операция отменена.")
     return ConversationHandler.END
 
+# Учет задач обработчиков: при concurrent_updates каждое обновление обрабатывается
+# в своей задаче, все группы обработчиков - в ней же
+async def track_handler_task(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    task = asyncio.current_task()
+    handler_tasks.add(task)
+    task.add_done_callback(handler_tasks.discard)
+
 # Обработка сообщений с учетом лимитов
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.message
+    log = MessageLog(
+        message_logger,
+        sample(LOG_SAMPLE_RATE),
+        chat_id=message.chat_id,
+        user_id=message.from_user.id if message.from_user else None
+    )
+    started = time.perf_counter()
+    task = asyncio.current_task()
+    active_messages.add(task)
+    IN_FLIGHT_MESSAGES.inc()
+    try:
+        with MESSAGE_LATENCY.time():
+            await process_message(update, context, log)
+    finally:
+        active_messages.discard(task)
+        IN_FLIGHT_MESSAGES.dec()
+        log.info("Message handled", fields={"stage": "total", "latency": round(time.perf_counter() - started, 3)})
+
+async def process_message(update: Update, context: ContextTypes.DEFAULT_TYPE, log: MessageLog):
     message = update.message
     user = message.from_user
     chat_id = message.chat_id
-    key = (chat_id, user.id)
     
     if not message.text:
         return
     
-    # Улучшенная обработка групповых чатов
-    bot_username = (await context.bot.get_me()).username
-    is_private = message.chat.type == "private"
+    # Сообщения в группах, не адресованные боту, отсеяны фильтром addressed_to_bot
     is_unlimited = chat_id == UNLIMITED_CHAT_ID
-    bot_mention = f"@{bot_username}"
-    
-    # Проверка, является ли сообщение адресованным боту
-    is_reply_to_bot = (
-        message.reply_to_message and 
-        message.reply_to_message.from_user.username == bot_username
-    )
-    is_mention = bot_mention in message.text
-    is_bot_name_in_text = bot_username in message.text.lower()
-    
-    # Для групповых чатов реагируем только на:
-    # 1. Ответы на сообщения бота
-    # 2. Сообщения с упоминанием бота (@username)
-    # 3. Сообщения с именем бота в тексте (без @)
-    is_addressed_to_bot = is_reply_to_bot or is_mention or is_bot_name_in_text
-    
-    # В групповых чатах (не приватных) игнорируем сообщения не адресованные боту
-    if not is_private and not is_addressed_to_bot:
-        return
     
     # Проверка лимита сообщений (только для обычных чатов)
     if not is_unlimited:
-        # Проверяем лимит перед увеличением счетчика
-        if not check_message_limit(user.id):
-            logger.warning(f"User {user.full_name} ({user.id}) exceeded daily message limit")
+        # Проверяем лимит и списываем сообщение одной операцией
+        with STAGE_LATENCY.time(stage="quota"):
+            allowed = await shared_state.check_and_consume(user.id)
+        if not allowed:
+            LIMIT_REJECTIONS.inc()
+            log.warning("Daily message limit exceeded")
             
-            today = datetime.utcnow().strftime("%Y-%m-%d")
-            user_key = (user.id, today)
-            
-            base_limit = 35
-            referral_bonus = user_referrals.get(user.id, 0) * 3
-            bonus_messages = user_bonus_messages.get(user_key, 0)
-            total_limit = base_limit + referral_bonus + bonus_messages
+            status = await shared_state.status(user.id)
+            if QUOTA_MODE == MODE_TOKENS:
+                limit_text = f"{status.tokens_total} токенов"
+            else:
+                limit_text = f"{status.total} сообщений"
             
             await message.reply_text(
-                f"❗️Вы достигли ежедневного лимита на общение с Алисой ({total_limit} сообщений).\n"
+                f"❗️Вы достигли ежедневного лимита на общение с Алисой ({limit_text}).\n"
                 "Возвращайтесь завтра или продолжите безлимитно ей пользоваться в чате - "
                 "https://t.me/freedom346\n\n"
                 "Или вы можете увеличить число ваших дневных запросов, если пригласите людей по вашей реферальной ссылке.\n"
                 "/ref - узнать подробнее."
             )
             return
-        
-        # Увеличиваем счетчик сообщений только если лимит не превышен
-        today = datetime.utcnow().strftime("%Y-%m-%d")
-        counter_key = (user.id, today)
-        daily_message_counters[counter_key] = daily_message_counters.get(counter_key, 0) + 1
     
-    logger.info(f"Обработка сообщения от {user.full_name} в чате {chat_id}: {message.text}")
+    log.info("Message received", fields={"chat_type": message.chat.type, "text": message.text})
     
-    await context.bot.send_chat_action(chat_id=chat_id, action=constants.ChatAction.TYPING)
+    if GROUP_BURST_WINDOW > 0 and message.chat.type != constants.ChatType.PRIVATE:
+        await group_bursts.add(chat_id, (message, context, log))
+        return
+    await answer_message(message, context, log)
+
+# Списание токенов отправленного ответа (только в режиме tokens). Ответ уже отправлен,
+# поэтому ошибка списания только записывается в лог
+async def charge_usage(user_id: int, tokens: int) -> None:
+    if QUOTA_MODE != MODE_TOKENS:
+        return
+    try:
+        await shared_state.charge_tokens(user_id, tokens)
+    except Exception as e:
+        logger.error("Token charge failed", extra=log_fields(user_id=user_id, tokens=tokens, error=repr(e)))
+
+# Ответ на одно сообщение; лимит уже проверен и списан
+async def answer_message(message, context: ContextTypes.DEFAULT_TYPE, log: MessageLog):
+    user = message.from_user
+    chat_id = message.chat_id
+    key = (chat_id, user.id)
+    is_unlimited = chat_id == UNLIMITED_CHAT_ID
+    
+    with STAGE_LATENCY.time(stage="send_chat_action"):
+        await context.bot.send_chat_action(chat_id=chat_id, action=constants.ChatAction.TYPING)
     
     try:
-        history = user_contexts.get(key, [])
         user_message_content = f"{user.full_name}: {message.text}"
         user_message = {"role": "user", "content": user_message_content}
         
-        messages = [{"role": "system", "content": PERSONA}]
-        messages.extend(history)
-        messages.append(user_message)
+        messages, prompt_tokens = contexts_for(message.chat).build_messages(key, user_message)
+        log.info("Prompt built", fields={"prompt_tokens": prompt_tokens, "messages": len(messages)})
         
-        loop = asyncio.get_running_loop()
-        response = await loop.run_in_executor(None, query_chat, messages)
-        cleaned_response = clean_response(response)
+        route = model_router.choose(message.text)
+        ROUTE_DECISIONS.inc(route=route.name)
+        log.info("Route chosen", fields={"route": route.name, "model": route.model, "max_tokens": route.max_tokens})
         
-        if not cleaned_response.strip():
-            cleaned_response = "Я обдумываю твой вопрос... Попробуй спросить по-другому."
+        sent_message = None
+        cache_key = response_cache_key(messages, message.text, route)
+        cached_response = None
+        if cache_key is not None:
+            cached_response = response_cache.get(cache_key, user.first_name)
+            CACHE_LOOKUPS.inc(result="hit" if cached_response is not None else "miss")
+        else:
+            CACHE_LOOKUPS.inc(result="bypass")
         
-        history.append(user_message)
-        history.append({"role": "assistant", "content": cleaned_response})
+        priority = llm_priority(user.id, chat_id, message.chat.type == constants.ChatType.PRIVATE)
+        usages = []
+        llm_started = time.perf_counter()
+        try:
+            if cached_response is not None:
+                log.info("Response cache hit")
+                response = cached_response
+            else:
+                async with llm_slot(priority):
+                    if STREAM_REPLIES:
+                        response, sent_message = await stream_reply(message, messages, route, usages.append)
+                    else:
+                        response = await query_chat(messages, route, usages.append)
+        except Overloaded as e:
+            # Запрос отклонен до обращения к LLM: сообщение не списываем, историю не трогаем
+            log.warning("LLM request shed", fields={"priority": e.priority_class, "reason": e.reason})
+            if not is_unlimited:
+                await shared_state.refund(user.id)
+            await message.reply_text(BUSY_REPLY)
+            return
+        except LLMUnavailable as e:
+            # Неудачный запрос не списывается с лимита и не попадает в историю
+            if not is_unlimited:
+                await shared_state.refund(user.id)
+            sent_message = getattr(e, "sent_message", None)
+            if sent_message is None:
+                await message.reply_text(ERROR_REPLY)
+            else:
+                try:
+                    await sent_message.edit_text(f"{sent_message.text}…\n\n{ERROR_REPLY}")
+                except BadRequest as edit_error:
+                    log.warning("Stream error edit failed", fields={"error": repr(edit_error)})
+            return
+        
+        log.info("LLM response", fields={
+            "stage": "llm",
+            "route": route.name,
+            "cached": cached_response is not None,
+            "latency": round(time.perf_counter() - llm_started, 3),
+            "response": response
+        })
         
-        if len(history) > 10:
-            history = history[-10:]
+        with STAGE_LATENCY.time(stage="clean_response"):
+            normalized_response = normalize_response(response)
+        
+        if normalized_response.strip():
+            if cache_key is not None and cached_response is None:
+                response_cache.put(cache_key, normalized_response, (user.full_name, user.first_name))
+            # Эмодзи добавляются после кэша, чтобы одинаковые ответы немного различались
+            cleaned_response = add_emojis(normalized_response)
+        else:
+            cleaned_response = "Я обдумываю твой вопрос... Попробуй спросить по-другому."
         
-        user_contexts[key] = history
+        contexts_for(message.chat).append_turn(key, user_message, {"role": "assistant", "content": cleaned_response})
         
         # Отправляем ответ без форматирования Markdown
-        await message.reply_text(cleaned_response)
+        with STAGE_LATENCY.time(stage="reply_text"):
+            if sent_message is None:
+                await message.reply_text(cleaned_response)
+            elif sent_message.text != cleaned_response:
+                try:
+                    await sent_message.edit_text(cleaned_response)
+                except BadRequest as e:
+                    log.warning("Final stream edit failed", fields={"error": repr(e)})
+        
+        # Ответ из кэша токенов не стоит и не списывается
+        if usages and not is_unlimited:
+            await charge_usage(user.id, sum(usage_tokens(usage) for usage in usages))
             
+    except RetryAfter as e:
+        # Ответ в этот чат сейчас невозможен, сообщение об ошибке тоже не дойдет
+        HANDLER_ERRORS.inc()
+        log.error("Flood limit, reply dropped", fields={"retry_after": e.retry_after})
     except Exception as e:
-        logger.error(f"Ошибка обработки сообщения: {e}")
+        HANDLER_ERRORS.inc()
+        log.error("Message handling failed", fields={"error": repr(e)})
         await message.reply_text("Что-то пошло не так. Попробуйте еще раз.")
 
+# Недавняя переписка для промпта пачки в пределах HISTORY_TOKEN_BUDGET: общая лента
+# группы или, без нее, последние реплики каждого отправителя (бюджет делится поровну)
+def burst_history(chat_id: int, burst_messages: list) -> str:
+    contexts = contexts_for(burst_messages[0].chat)
+    if contexts is group_contexts:
+        lines = lines_within(contexts.history_lines((chat_id, GROUP_USER_ID)), HISTORY_TOKEN_BUDGET)
+    else:
+        senders = list(dict.fromkeys(message.from_user.id for message in burst_messages))
+        budget = HISTORY_TOKEN_BUDGET // len(senders)
+        lines = []
+        for user_id in senders:
+            lines.extend(lines_within(contexts.history_lines((chat_id, user_id)), budget))
+    return GROUP_HEADER + "\n".join(lines) if lines else ""
+
+# Ответ на пачку сообщений группы одним запросом к LLM: модель отвечает каждому
+# отправителю отдельной частью с его номером, части отправляются ответами на сообщения.
+# Сообщения, которым модель не ответила, получают отдельный ответ. Лимит уже списан
+# с каждого отправителя; при ошибке LLM он возвращается всем
+async def answer_group_burst(chat_id: int, items: list) -> None:
+    GROUP_BURST_SIZE.observe(len(items))
+    if len(items) == 1:
+        await answer_message(*items[0])
+        return
+    
+    burst_messages = [message for message, _, _ in items]
+    context = items[0][1]
+    is_unlimited = chat_id == UNLIMITED_CHAT_ID
+    for message, _, log in items:
+        log.info("Group burst", fields={"burst_size": len(items)})
+    
+    async def refund_all():
+        if not is_unlimited:
+            for message in burst_messages:
+                await shared_state.refund(message.from_user.id)
+    
+    # Номера сообщений, получивших ответ (или переданных в answer_message)
+    answered = set()
+    
+    async def reply_all(text: str):
+        for index, message in enumerate(burst_messages):
+            if index not in answered:
+                await message.reply_text(text)
+    
+    with STAGE_LATENCY.time(stage="send_chat_action"):
+        await context.bot.send_chat_action(chat_id=chat_id, action=constants.ChatAction.TYPING)
+    
+    try:
+        user_messages = [
+            {"role": "user", "content": f"{message.from_user.full_name}: {message.text}"}
+            for message in burst_messages
+        ]
+        messages = [{"role": "system", "content": f"{PERSONA}\n\n{GROUP_BURST_INSTRUCTION}"}]
+        history = burst_history(chat_id, burst_messages)
+        if history:
+            messages.append({"role": "system", "content": history})
+        messages.append(
+            {"role": "user", "content": "\n".join(
+                f"[{number}] {user_message['content']}" for number, user_message in enumerate(user_messages, 1)
+            )}
+        )
+        route = model_router.choose("\n".join(message.text for message in burst_messages))
+        ROUTE_DECISIONS.inc(route=route.name)
+        priority = min(
+            (llm_priority(message.from_user.id, chat_id, False) for message in burst_messages),
+            key=llm_admission.class_rank.__getitem__
+        )
+        
+        usages = []
+        llm_started = time.perf_counter()
+        try:
+            async with llm_slot(priority):
+                response = await query_chat(messages, route, usages.append)
+        except Overloaded as e:
+            logger.warning("LLM request shed", extra=log_fields(
+                chat_id=chat_id, priority=e.priority_class, reason=e.reason, burst_size=len(items)
+            ))
+            await refund_all()
+            await reply_all(BUSY_REPLY)
+            return
+        except LLMUnavailable:
+            await refund_all()
+            await reply_all(ERROR_REPLY)
+            return
+        
+        message_logger.info("LLM response", extra=log_fields(
+            chat_id=chat_id,
+            stage="llm",
+            route=route.name,
+            burst_size=len(items),
+            latency=round(time.perf_counter() - llm_started, 3),
+            response=response
+        ))
+        
+        with STAGE_LATENCY.time(stage="clean_response"):
+            replies = split_replies(strip_think_blocks(response), len(items))
+            replies = {index: normalize_response(reply) for index, reply in replies.items()}
+            replies = {index: reply for index, reply in replies.items() if reply.strip()}
+        
+        with STAGE_LATENCY.time(stage="reply_text"):
+            for index, (message, user_message) in enumerate(zip(burst_messages, user_messages)):
+                if index not in replies:
+                    continue
+                cleaned_response = add_emojis(replies[index])
+                contexts_for(message.chat).append_turn(
+                    (chat_id, message.from_user.id), user_message, {"role": "assistant", "content": cleaned_response}
+                )
+                await message.reply_text(cleaned_response)
+                answered.add(index)
+        
+        # Без своей части ответа (модель пропустила номер или не разметила ответ)
+        # сообщение обрабатывается отдельно, как вне пачки
+        replied = sorted(answered)
+        missing = [index for index in range(len(items)) if index not in answered]
+        if missing:
+            for message, _, log in (items[index] for index in missing):
+                log.info("Burst reply missing, answering separately")
+            answered.update(missing)
+            await asyncio.gather(*(answer_message(*items[index]) for index in missing))
+        
+        # Токены общего запроса делятся поровну между получившими из него ответ;
+        # отвеченные отдельно оплачивают свой запрос в answer_message
+        if usages and replied and not is_unlimited:
+            share = -(-sum(usage_tokens(usage) for usage in usages) // len(replied))
+            for index in replied:
+                await charge_usage(burst_messages[index].from_user.id, share)
+    
+    except RetryAfter as e:
+        HANDLER_ERRORS.inc()
+        logger.error("Flood limit, burst replies dropped", extra=log_fields(chat_id=chat_id, retry_after=e.retry_after))
+    except Exception as e:
+        HANDLER_ERRORS.inc()
+        logger.error("Group burst handling failed", extra=log_fields(chat_id=chat_id, error=repr(e)))
+        await reply_all("Что-то пошло не так. Попробуйте еще раз.")
+
+group_bursts = BurstCollector(GROUP_BURST_WINDOW, answer_group_burst, GROUP_BURST_MAX)
+
+# Создание клиента Novita API и установка первого соединения
+async def warm_llm_client() -> None:
+    global llm_client
+    llm_client = create_llm_client()
+    logger.info(
+        f"LLM client created (max_connections={LLM_MAX_CONNECTIONS}, "
+        f"keepalive={LLM_MAX_KEEPALIVE})"
+    )
+    try:
+        await asyncio.wait_for(llm_client.models.list(), LLM_CONNECT_TIMEOUT)
+    except Exception as e:
+        logger.warning(f"LLM client warm-up failed: {e}")
+
+# Инициализация бота: get_me выполняется один раз, данные бота кэшируются
+async def init_bot(application: Application, commands: bool = True) -> None:
+    global bot_user
+    await application.initialize()
+    bot_user = application.bot.bot
+    logger.info(f"Bot identity: @{bot_user.username} ({bot_user.id})")
+    if commands:
+        await post_init(application)
+
+# Параллельный запуск: хранилище, клиент Novita API и инициализация бота.
+# Процессу-приемнику клиент Novita API не нужен, воркерам - установка меню команд
+async def startup(application: Application, llm: bool = True, commands: bool = True) -> None:
+    async def timed(phase: str, coro):
+        started = time.monotonic()
+        await coro
+        logger.info(f"Startup phase '{phase}' completed in {time.monotonic() - started:.2f}s")
+    
+    started = time.monotonic()
+    phases = [
+        timed("state", asyncio.to_thread(init_state_store)),
+        timed("bot", init_bot(application, commands))
+    ]
+    if llm:
+        phases.append(timed("llm", warm_llm_client()))
+    await asyncio.gather(*phases)
+    logger.info(f"Startup completed in {time.monotonic() - started:.2f}s")
+
 async def post_init(application: Application) -> None:
     commands = [
         BotCommand("start", "Начало работы с ботом"),
@@ -583,32 +1612,52 @@ async def post_init(application: Application) -> None:
     await application.bot.set_my_commands(commands)
     logger.info("Меню команд бота установлено")
 
-def main():
-    if not TOKEN:
-        logger.error("TG_TOKEN environment variable is missing!")
-        return
-    if not NOVITA_API_KEY:
-        logger.error("NOVITA_API_KEY environment variable is missing!")
-        return
-
-    # Загружаем реферальные данные
-    load_ref_data()
-
-    # Запуск HTTP-сервера
-    port = int(os.getenv('PORT', 8080))
-    http_thread = threading.Thread(target=run_http_server, args=(port,), daemon=True)
-    http_thread.start()
+async def post_shutdown(application: Application) -> None:
+    global llm_client
+    if llm_client is not None:
+        await llm_client.close()
+        llm_client = None
+        logger.info("LLM client closed")
+    
+    # Дописываем отложенные изменения состояния
+    await asyncio.to_thread(state_store.close)
 
-    logger.info("Ожидание 45 секунд перед запуском бота...")
-    time.sleep(45)
+# Ограничитель исходящих запросов: все отправки бота, включая команды, проходят через него
+# (общий лимит делится между воркерами поровну)
+def create_outbound_limiter() -> OutboundLimiter:
+    return OutboundLimiter(
+        OUTBOUND_GLOBAL_RATE / max(1, WORKERS),
+        OUTBOUND_PRIVATE_RATE,
+        OUTBOUND_GROUP_RATE,
+        burst=OUTBOUND_BURST,
+        max_retries=OUTBOUND_MAX_RETRIES,
+        on_wait=lambda method, delay: OUTBOUND_WAITS.observe(delay, method=method),
+        on_retry_after=lambda method, delay: OUTBOUND_RETRY_AFTER.inc(method=method),
+        on_merged=lambda: OUTBOUND_MERGED.inc(),
+        on_dropped=lambda method: OUTBOUND_DROPPED.inc(method=method)
+    )
 
-    application = Application.builder().token(TOKEN).post_init(post_init).build()
+def build_application() -> Application:
+    # Обновления разных чатов обрабатываются параллельно, но не более MAX_CONCURRENT_UPDATES одновременно
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(MAX_CONCURRENT_UPDATES)
+        .rate_limiter(create_outbound_limiter())
+    )
+    if TELEGRAM_BASE_URL:
+        builder = builder.base_url(TELEGRAM_BASE_URL)
+    application = builder.build()
+    logger.info(f"Concurrent updates limit: {MAX_CONCURRENT_UPDATES}")
+    
+    # Задачи всех обновлений учитываются для отмены при остановке
+    application.add_handler(TypeHandler(object, track_handler_task), group=-1)
     
     # Регистрация обработчиков команд
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("info", info))
     application.add_handler(CommandHandler("ref", ref_command))
-    application.add_handler(CommandHandler("clear", clear_context))
+    application.add_handler(CommandHandler("clear", per_user_ordered(clear_context)))
     application.add_handler(CommandHandler("stat", stat))
     
     # Скрытая команда для разработчика
@@ -626,21 +1675,241 @@ def main():
     
     # Основной обработчик сообщений
     application.add_handler(
-        MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message)
+        MessageHandler(filters.TEXT & ~filters.COMMAND & addressed_to_bot, per_user_ordered(handle_message))
     )
-    
+    return application
+
+# Запуск получения обновлений через polling
+async def start_polling(application: Application) -> None:
     logger.info("Запуск бота в режиме polling...")
+    await application.updater.start_polling(
+        drop_pending_updates=DROP_PENDING_UPDATES,
+        connect_timeout=60,
+        read_timeout=60,
+        pool_timeout=60
+    )
+
+# Запуск получения обновлений через вебхук, при ошибке - переход на polling
+async def start_webhook(application: Application, server: HTTPServer) -> bool:
+    server.route("POST", WEBHOOK_PATH, webhook_handler(application))
+    if not WEBHOOK_URL:
+        # Локальный режим: обновления присылаются на эндпоинт вручную
+        logger.info(f"Webhook endpoint {WEBHOOK_PATH} enabled without registration")
+        return True
+    try:
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=DROP_PENDING_UPDATES
+        )
+        logger.info(f"Запуск бота в режиме webhook: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+        return True
+    except Exception as e:
+        logger.error(f"Failed to set webhook, falling back to polling: {e}")
+        return False
+
+# Ключ шардирования: чат обновления, для обновлений без чата - пользователь
+def shard_key(update: Update) -> int:
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return 0
+
+# Процесс-приемник: обновления из polling или вебхука уходят воркерам вместо обработчиков
+async def forward_updates(application: Application, ingress: ShardIngress) -> None:
+    while True:
+        update = await application.update_queue.get()
+        try:
+            if isinstance(update, Update):
+                await ingress.send(shard_key(update), update.to_dict())
+        except Exception as e:
+            logger.error(f"Failed to forward update: {e}")
+        finally:
+            application.update_queue.task_done()
+
+# Запуск воркеров и раздачи обновлений
+async def start_sharding(application: Application) -> tuple:
+    ingress = ShardIngress(SHARD_SOCKET, WORKERS, shared_state)
+    await ingress.start()
+    pool = WorkerPool(run_worker_process, WORKERS, SHARD_SOCKET)
+    pool.start()
+
+    SHARD_WORKERS_CONNECTED.set_function(ingress.connected)
+    SHARD_WORKER_RESTARTS.set_function(lambda: pool.restarts)
+    for index in range(WORKERS):
+        SHARD_FORWARDED.set_function(lambda index=index: ingress.forwarded[index], worker=str(index))
+
+    tasks = [
+        asyncio.create_task(forward_updates(application, ingress)),
+        asyncio.create_task(pool.monitor())
+    ]
+    return ingress, pool, tasks
+
+# Остановка: принятые обновления дораздаются, воркеры получают сигнал остановки и
+# дообрабатывают принятое; общее состояние обслуживается, пока они не завершатся
+async def stop_sharding(application: Application, ingress: ShardIngress, pool: WorkerPool, tasks: list) -> None:
+    try:
+        await asyncio.wait_for(application.update_queue.join(), SHARD_STOP_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"{application.update_queue.qsize()} updates were not forwarded before shutdown")
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await ingress.stop_intake()
+    await pool.stop(SHUTDOWN_DRAIN_TIMEOUT + SHARD_STOP_TIMEOUT)
+    await ingress.stop()
+
+# Остановка приложения: stop() дожидается очереди обновлений и обрабатываемых сообщений.
+# По истечении срока незавершенная обработка отменяется и дожидается, чтобы она не
+# обращалась к клиенту LLM и хранилищу после их закрытия в post_shutdown
+async def stop_application(application: Application, timeout: float) -> None:
+    if active_messages:
+        logger.info(f"Waiting for {len(active_messages)} in-flight messages (up to {timeout:.0f}s)")
+    try:
+        await asyncio.wait_for(application.stop(), timeout)
+    except asyncio.TimeoutError:
+        pending = {
+            task for task in (*active_messages, *handler_tasks, *user_queues.tasks, *group_bursts.tasks)
+            if not task.done()
+        }
+        logger.warning(f"{len(pending)} handler tasks did not finish in {timeout:.0f}s, cancelling")
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+# Перезагрузка настроек по SIGHUP; приемник пересылает сигнал воркерам
+def request_reload(pool: WorkerPool = None) -> None:
+    async def reload():
+        with contextlib.suppress(OSError, ValueError):
+            await reload_settings()
     
-    poll_params = {
-        "drop_pending_updates": True,
-        "close_loop": False,
-        "stop_signals": [],
-        "connect_timeout": 60,
-        "read_timeout": 60,
-        "pool_timeout": 60
-    }
+    task = asyncio.get_running_loop().create_task(reload())
+    reload_tasks.add(task)
+    task.add_done_callback(reload_tasks.discard)
+    if pool is not None:
+        pool.send_signal(signal.SIGHUP)
+
+async def run_bot(application: Application) -> None:
+    global is_ready, loop_watchdog, shard_ingress
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    pool = None
+    loop.add_signal_handler(signal.SIGHUP, lambda: request_reload(pool))
+    
+    # HTTP-сервер: health-check и вебхук на одном порту
+    port = int(os.getenv('PORT', 8080))
+    server = HTTPServer("", port)
+    server.route("GET", "/", health)
+    server.route("GET", "/health", health)
+    server.route("GET", "/healthz", health)
+    server.route("GET", "/readyz", readiness)
+    server.route("GET", "/metrics", metrics_endpoint)
+    await server.start()
+    
+    sharded = WORKERS > 1
+    await startup(application, llm=not sharded)
+    
+    if LOOP_WATCHDOG:
+        loop_watchdog = LoopWatchdog(
+            LOOP_LAG_THRESHOLD,
+            LOOP_LAG_INTERVAL,
+            on_lag=LOOP_LAG.observe,
+            on_stall=LOOP_STALLS.inc
+        )
+        loop_watchdog.start()
+    
+    # Воркеры запускаются до приема обновлений: пока они подключаются, обновления буферизуются
+    if sharded:
+        shard_ingress, pool, shard_tasks = await start_sharding(application)
+        logger.info(f"Sharding updates across {WORKERS} worker processes")
     
-    application.run_polling(**poll_params)
+    polling = BOT_MODE != "webhook" or not await start_webhook(application, server)
+    if polling:
+        await start_polling(application)
+    if not sharded:
+        await application.start()
+    
+    is_ready = True
+    logger.info("Бот готов к работе")
+    
+    try:
+        await stop_event.wait()
+    finally:
+        is_ready = False
+        logger.info("Остановка бота...")
+        if loop_watchdog is not None:
+            await loop_watchdog.stop()
+        if polling:
+            await application.updater.stop()
+        if sharded:
+            await stop_sharding(application, shard_ingress, pool, shard_tasks)
+            shard_ingress = None
+        else:
+            await stop_application(application, SHUTDOWN_DRAIN_TIMEOUT)
+        await post_shutdown(application)
+        await application.shutdown()
+        await server.stop()
+
+# Воркер: обрабатывает обновления своих чатов, лимиты и рефералы запрашивает у приемника.
+# Метрики воркера доступны на порту PORT + 1 + index
+async def run_worker(index: int, socket_path: str) -> None:
+    global is_ready, shared_state, shard_worker_index
+    shard_worker_index = index
+    application = build_application()
+    connection = await ShardConnection.connect(socket_path, index)
+    shared_state = RemoteState(connection.call)
+
+    # SIGTERM завершает воркер так же, как сигнал остановки от приемника
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, connection.updates.put_nowait, None)
+    loop.add_signal_handler(signal.SIGHUP, request_reload)
+
+    server = HTTPServer("", int(os.getenv('PORT', 8080)) + 1 + index)
+    server.route("GET", "/healthz", health)
+    server.route("GET", "/readyz", readiness)
+    server.route("GET", "/metrics", metrics_endpoint)
+    await server.start()
+
+    await startup(application, commands=False)
+    await application.start()
+    is_ready = True
+    logger.info(f"Shard worker {index} ready")
+
+    try:
+        while True:
+            update = await connection.updates.get()
+            if update is None:
+                break
+            await application.update_queue.put(Update.de_json(update, application.bot))
+    finally:
+        is_ready = False
+        logger.info(f"Shard worker {index} stopping")
+        await stop_application(application, SHUTDOWN_DRAIN_TIMEOUT)
+        await post_shutdown(application)
+        await application.shutdown()
+        await connection.close()
+        await server.stop()
+
+# Точка входа процесса-воркера; Ctrl+C получает вся группа процессов,
+# поэтому воркер его игнорирует и ждет остановки от приемника
+def run_worker_process(index: int, socket_path: str) -> None:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(run_worker(index, socket_path))
+
+def main():
+    if not TOKEN:
+        logger.error("TG_TOKEN environment variable is missing!")
+        return
+    if not NOVITA_API_KEY:
+        logger.error("NOVITA_API_KEY environment variable is missing!")
+        return
+
+    application = build_application()
+    asyncio.run(run_bot(application))
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,219 @@
+import time
+import asyncio
+import logging
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд Telegram показывает индикатор набора после sendChatAction
+CHAT_ACTION_TTL = 4.5
+
+# Число корзин, после которого удаляются корзины давно молчащих чатов
+MAX_IDLE_BUCKETS = 10000
+
+
+# Промежуточное сообщение (например, правка потокового ответа) не отправлено из-за лимита
+class SendDropped(Exception):
+    pass
+
+
+# Корзина токенов: rate токенов в секунду, не больше capacity про запас.
+# reserve() может уводить баланс в минус, тогда ожидающие отправки выстраиваются по порядку
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated", "clock")
+
+    def __init__(self, rate: float, capacity: float, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.clock = clock
+        self.updated = clock()
+
+    def _refill(self) -> None:
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Занять токен; возвращает, сколько секунд нужно подождать до отправки
+    def reserve(self) -> float:
+        self._refill()
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    # Занять токен, только если он доступен прямо сейчас
+    def try_take(self) -> bool:
+        self._refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+# Ограничитель исходящих запросов к Bot API: общая корзина и корзины по чатам,
+# ожидание после 429 (Retry-After) и склейка повторных sendChatAction.
+# Подключается через ApplicationBuilder.rate_limiter, поэтому через него проходят
+# все отправки, включая обработчики команд. rate_limit_args={"droppable": True}
+# помечает необязательные отправки: при исчерпанном лимите они не ждут, а
+# отбрасываются с SendDropped
+class OutboundLimiter(BaseRateLimiter):
+    def __init__(self, global_rate: float, private_rate: float, group_rate: float,
+                 burst: float = 3, max_retries: int = 2, clock=time.monotonic,
+                 on_wait=None, on_retry_after=None, on_merged=None, on_dropped=None):
+        self.global_rate = global_rate
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.clock = clock
+        self.on_wait = on_wait
+        self.on_retry_after = on_retry_after
+        self.on_merged = on_merged
+        self.on_dropped = on_dropped
+        self.global_bucket = TokenBucket(global_rate, global_rate, clock)
+        self.buckets = {}         # chat_id -> TokenBucket
+        self.paused_until = {}    # chat_id -> время окончания паузы Retry-After
+        self.chat_actions = {}    # (chat_id, action) -> время отправки или Future запроса в полете
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        self.buckets.clear()
+        self.paused_until.clear()
+        self.chat_actions.clear()
+
+    @staticmethod
+    def is_group(chat_id) -> bool:
+        if isinstance(chat_id, str):
+            return chat_id.startswith("@") or chat_id.startswith("-")
+        return chat_id < 0
+
+    def _bucket(self, chat_id) -> TokenBucket:
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            if len(self.buckets) >= MAX_IDLE_BUCKETS:
+                self.buckets = {key: b for key, b in self.buckets.items() if not b.full}
+            rate = self.group_rate if self.is_group(chat_id) else self.private_rate
+            bucket = self.buckets[chat_id] = TokenBucket(rate, self.burst, self.clock)
+        return bucket
+
+    def _pause_left(self, chat_id) -> float:
+        until = self.paused_until.get(chat_id)
+        if until is None:
+            return 0.0
+        left = until - self.clock()
+        if left <= 0:
+            del self.paused_until[chat_id]
+            return 0.0
+        return left
+
+    # Ожидание своей очереди: пауза после 429, лимит чата, общий лимит
+    async def _wait_turn(self, chat_id, endpoint: str) -> None:
+        delay = max(self._pause_left(chat_id), self._bucket(chat_id).reserve(), self.global_bucket.reserve())
+        if delay > 0:
+            if self.on_wait is not None:
+                self.on_wait(endpoint, delay)
+            await asyncio.sleep(delay)
+
+    # Необязательная отправка проходит, только если лимиты позволяют отправить сразу
+    def _can_send_now(self, chat_id) -> bool:
+        if self._pause_left(chat_id) > 0:
+            return False
+        bucket = self._bucket(chat_id)
+        if not bucket.try_take():
+            return False
+        if not self.global_bucket.try_take():
+            bucket.tokens += 1
+            return False
+        return True
+
+    def _drop(self, endpoint: str) -> None:
+        if self.on_dropped is not None:
+            self.on_dropped(endpoint)
+
+    async def _send_chat_action(self, callback, args, kwargs, chat_id, data):
+        key = (chat_id, data.get("action"))
+        previous = self.chat_actions.get(key)
+        if isinstance(previous, asyncio.Future):
+            # Такое же действие для этого чата уже отправляется
+            if self.on_merged is not None:
+                self.on_merged()
+            return await asyncio.shield(previous)
+        if previous is not None and self.clock() - previous < CHAT_ACTION_TTL:
+            # Индикатор еще виден, повторять запрос не нужно
+            if self.on_merged is not None:
+                self.on_merged()
+            return True
+        if not self._can_send_now(chat_id):
+            # Индикатор набора не стоит ожидания в очереди
+            self._drop("sendChatAction")
+            return True
+
+        future = asyncio.get_running_loop().create_future()
+        self.chat_actions[key] = future
+        try:
+            result = await callback(*args, **kwargs)
+        except RetryAfter as e:
+            self._pause(chat_id, e.retry_after, "sendChatAction")
+            self.chat_actions.pop(key, None)
+            future.set_result(True)
+            return True
+        except BaseException as e:
+            self.chat_actions.pop(key, None)
+            if isinstance(e, Exception):
+                future.set_exception(e)
+                future.exception()  # ошибку получат ожидающие, не логируем ее повторно
+            else:
+                future.cancel()
+            raise
+        if len(self.chat_actions) > MAX_IDLE_BUCKETS:
+            now = self.clock()
+            self.chat_actions = {
+                k: v for k, v in self.chat_actions.items()
+                if isinstance(v, asyncio.Future) or now - v < CHAT_ACTION_TTL
+            }
+        self.chat_actions[key] = self.clock()
+        future.set_result(result)
+        return result
+
+    def _pause(self, chat_id, retry_after: float, endpoint: str) -> None:
+        until = self.clock() + float(retry_after)
+        self.paused_until[chat_id] = max(self.paused_until.get(chat_id, 0.0), until)
+        logger.warning(f"Telegram flood limit on {endpoint} for chat {chat_id}, retry after {retry_after}s")
+        if self.on_retry_after is not None:
+            self.on_retry_after(endpoint, float(retry_after))
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            # getUpdates, getMe, setMyCommands и т.п. не попадают под лимиты отправки
+            return await callback(*args, **kwargs)
+
+        if endpoint == "sendChatAction":
+            return await self._send_chat_action(callback, args, kwargs, chat_id, data)
+
+        droppable = bool(rate_limit_args and rate_limit_args.get("droppable"))
+        attempt = 0
+        while True:
+            if droppable:
+                if not self._can_send_now(chat_id):
+                    self._drop(endpoint)
+                    raise SendDropped(f"{endpoint} to {chat_id} dropped by rate limit")
+            else:
+                await self._wait_turn(chat_id, endpoint)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self._pause(chat_id, e.retry_after, endpoint)
+                if droppable:
+                    raise SendDropped(f"{endpoint} to {chat_id} hit flood limit") from e
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
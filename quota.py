@@ -0,0 +1,193 @@
+import time
+import logging
+from collections import namedtuple
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+SECONDS_PER_DAY = 86400
+
+# Режимы лимита: по числу сообщений или по токенам запросов к LLM
+MODE_MESSAGES = "messages"
+MODE_TOKENS = "tokens"
+
+QuotaStatus = namedtuple(
+    "QuotaStatus",
+    ["base", "referrals", "referral_bonus", "bonus", "total", "used", "remaining",
+     "tokens_total", "tokens_used", "tokens_remaining", "tokens_per_message"]
+)
+
+
+# Дневные лимиты сообщений: счетчики хранятся только за текущие сутки (UTC),
+# смена суток - это замена словарей, без обхода и разбора ключей.
+# В режиме tokens лимит - бюджет токенов: каждое доступное сообщение (базовое,
+# реферальное, бонусное) дает tokens_per_message токенов, сообщения только считаются
+class QuotaEngine:
+    def __init__(self, base_limit: int, per_referral: int, referral_count, backend=None, clock=time.time,
+                 mode: str = MODE_MESSAGES, tokens_per_message: int = 1500):
+        if mode not in (MODE_MESSAGES, MODE_TOKENS):
+            raise ValueError(f"Unknown quota mode: {mode}")
+        self.base_limit = base_limit
+        self.per_referral = per_referral
+        self.mode = mode
+        self.tokens_per_message = tokens_per_message
+        # Функция user_id -> число приглашенных пользователей
+        self.referral_count = referral_count
+        self.backend = backend
+        self.clock = clock
+
+        self.day_number = None
+        self.day = None
+        self.daily_message_counters = {}  # Формат: {user_id: count} за текущие сутки
+        self.user_bonus_messages = {}     # Формат: {user_id: bonus_count} за текущие сутки
+        self.daily_token_counters = {}    # Формат: {user_id: tokens} за текущие сутки
+        self._loaded = set()
+        self._roll()
+
+    # Переход на новые сутки за O(1)
+    def _roll(self) -> None:
+        day_number = int(self.clock()) // SECONDS_PER_DAY
+        if day_number == self.day_number:
+            return
+
+        previous_day = self.day
+        self.day_number = day_number
+        self.day = datetime.fromtimestamp(day_number * SECONDS_PER_DAY, timezone.utc).strftime("%Y-%m-%d")
+        self.daily_message_counters = {}
+        self.user_bonus_messages = {}
+        self.daily_token_counters = {}
+        self._loaded = set()
+
+        if previous_day is not None:
+            logger.info(f"Quota day rolled over: {previous_day} -> {self.day}")
+            if self.backend is not None:
+                self.backend.prune_days(self.day)
+
+    # Ленивая подгрузка счетчиков пользователя за текущие сутки
+    def _ensure(self, user_id: int) -> None:
+        self._roll()
+        if user_id in self._loaded:
+            return
+        self._loaded.add(user_id)
+        if self.backend is None:
+            return
+        state = self.backend.load_user(user_id, self.day)
+        if state["messages"]:
+            self.daily_message_counters.setdefault(user_id, state["messages"])
+        if state["bonus"]:
+            self.user_bonus_messages.setdefault(user_id, state["bonus"])
+        if state.get("tokens"):
+            self.daily_token_counters.setdefault(user_id, state["tokens"])
+
+    def limit(self, user_id: int) -> int:
+        self._ensure(user_id)
+        return (
+            self.base_limit
+            + self.referral_count(user_id) * self.per_referral
+            + self.user_bonus_messages.get(user_id, 0)
+        )
+
+    def token_limit(self, user_id: int) -> int:
+        return self.limit(user_id) * self.tokens_per_message
+
+    def used(self, user_id: int) -> int:
+        self._ensure(user_id)
+        return self.daily_message_counters.get(user_id, 0)
+
+    def status(self, user_id: int) -> QuotaStatus:
+        self._ensure(user_id)
+        referrals = self.referral_count(user_id)
+        referral_bonus = referrals * self.per_referral
+        bonus = self.user_bonus_messages.get(user_id, 0)
+        total = self.base_limit + referral_bonus + bonus
+        used = self.daily_message_counters.get(user_id, 0)
+        tokens_total = total * self.tokens_per_message
+        tokens_used = self.daily_token_counters.get(user_id, 0)
+        return QuotaStatus(
+            self.base_limit, referrals, referral_bonus, bonus, total, used, max(0, total - used),
+            tokens_total, tokens_used, max(0, tokens_total - tokens_used), self.tokens_per_message
+        )
+
+    # Атомарная проверка и списание одного сообщения. В режиме tokens сообщение
+    # допускается, пока бюджет токенов не исчерпан; сами токены списывает charge_tokens
+    def check_and_consume(self, user_id: int) -> bool:
+        total = self.limit(user_id)
+        used = self.daily_message_counters.get(user_id, 0)
+        if self.mode == MODE_TOKENS:
+            if self.daily_token_counters.get(user_id, 0) >= total * self.tokens_per_message:
+                return False
+        elif used >= total:
+            return False
+        self.daily_message_counters[user_id] = used + 1
+        if self.backend is not None:
+            self.backend.save_messages(user_id, self.day, used + 1)
+        return True
+
+    # Возврат списанного сообщения (запрос не был выполнен)
+    def refund(self, user_id: int) -> None:
+        self._ensure(user_id)
+        used = self.daily_message_counters.get(user_id, 0)
+        if used <= 0:
+            return
+        self.daily_message_counters[user_id] = used - 1
+        if self.backend is not None:
+            self.backend.save_messages(user_id, self.day, used - 1)
+
+    # Списание токенов выполненного запроса (prompt + completion из usage);
+    # вызывается после каждого ответа, поэтому только обновляет счетчик
+    def charge_tokens(self, user_id: int, tokens: int) -> int:
+        self._ensure(user_id)
+        used = self.daily_token_counters.get(user_id, 0) + max(0, tokens)
+        self.daily_token_counters[user_id] = used
+        if self.backend is not None:
+            self.backend.save_tokens(user_id, self.day, used)
+        return used
+
+    # Изменение бонусных сообщений на сегодня, не ниже нуля
+    def add_bonus(self, user_id: int, delta: int) -> int:
+        self._ensure(user_id)
+        bonus = max(0, self.user_bonus_messages.get(user_id, 0) + delta)
+        self.user_bonus_messages[user_id] = bonus
+        if self.backend is not None:
+            self.backend.save_bonus(user_id, self.day, bonus)
+        return bonus
+
+
+# Реферальные связи: сколько пользователей пригласил каждый и кем приглашен пользователь.
+# Данные пользователя подгружаются из хранилища при первом обращении
+class ReferralBook:
+    def __init__(self, backend=None, day=lambda: None):
+        self.backend = backend
+        # Функция, возвращающая текущие сутки для load_user
+        self.day = day
+        self.user_referrals = {}   # Формат: {referrer_id: count}
+        self.user_invited_by = {}  # Формат: {invited_user_id: referrer_id}
+        self._loaded = set()
+
+    def _ensure(self, user_id: int) -> None:
+        if user_id in self._loaded:
+            return
+        self._loaded.add(user_id)
+        if self.backend is None:
+            return
+        state = self.backend.load_user(user_id, self.day())
+        if state["referrals"]:
+            self.user_referrals.setdefault(user_id, state["referrals"])
+        if state["invited_by"] is not None:
+            self.user_invited_by.setdefault(user_id, state["invited_by"])
+
+    def count(self, user_id: int) -> int:
+        self._ensure(user_id)
+        return self.user_referrals.get(user_id, 0)
+
+    # Регистрация приглашения; False, если пользователь уже был приглашен или пригласил сам себя
+    def register(self, user_id: int, referrer_id: int) -> bool:
+        self._ensure(user_id)
+        self._ensure(referrer_id)
+        if referrer_id == user_id or user_id in self.user_invited_by:
+            return False
+        self.user_invited_by[user_id] = referrer_id
+        self.user_referrals[referrer_id] = self.user_referrals.get(referrer_id, 0) + 1
+        if self.backend is not None:
+            self.backend.save_referral(user_id, referrer_id, self.user_referrals[referrer_id])
+        return True
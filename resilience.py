@@ -0,0 +1,188 @@
+import time
+import random
+import asyncio
+import logging
+
+import openai
+
+logger = logging.getLogger(__name__)
+
+# HTTP-статусы, при которых повтор запроса безопасен
+RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+
+# Запрос к LLM не выполнен: ошибки провайдера исчерпали повторы или цепь разомкнута
+class LLMUnavailable(Exception):
+    pass
+
+
+# Повторять можно только сетевые ошибки, таймауты, 429 и 5xx
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUSES or error.status_code >= 500
+    return False
+
+
+# Задержка перед повтором: экспоненциальная с полным джиттером
+def backoff_delay(attempt: int, base_delay: float, max_delay: float) -> float:
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+# Автоматический выключатель: после серии ошибок запросы сразу отклоняются,
+# через recovery_time пропускается одна пробная попытка
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int, recovery_time: float, clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started = 0.0
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        now = self.clock()
+        if self.state == self.OPEN:
+            if now - self.opened_at < self.recovery_time:
+                return False
+            self.state = self.HALF_OPEN
+            self.probe_started = now
+            logger.info(f"Circuit {self.name} half-open, probing")
+            return True
+        # Половинное состояние: одна пробная попытка за recovery_time
+        if now - self.probe_started >= self.recovery_time:
+            self.probe_started = now
+            return True
+        return False
+
+    def record_success(self) -> None:
+        if self.state != self.CLOSED:
+            logger.info(f"Circuit {self.name} closed")
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(f"Circuit {self.name} opened after {self.failures} failures")
+            self.state = self.OPEN
+            self.opened_at = self.clock()
+
+
+async def _discard_results(tasks, discard) -> None:
+    for task in tasks:
+        if task.done() and not task.cancelled() and task.exception() is None:
+            try:
+                await discard(task.result())
+            except Exception as e:
+                logger.debug(f"Discarding hedged result failed: {e}")
+
+
+# Хеджированный запрос: если первая попытка не завершилась за hedge_delay,
+# запускается вторая, используется первый успешный результат
+async def run_hedged(attempt, hedge_delay, discard=None, on_hedge=None):
+    tasks = [asyncio.ensure_future(attempt())]
+    try:
+        if hedge_delay is not None:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+            if not done:
+                if on_hedge is not None:
+                    on_hedge()
+                tasks.append(asyncio.ensure_future(attempt()))
+
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    losers = [t for t in tasks if t is not task]
+                    for loser in losers:
+                        loser.cancel()
+                    if discard is not None and losers:
+                        await asyncio.gather(*losers, return_exceptions=True)
+                        await _discard_results(losers, discard)
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+# Устойчивый вызов LLM: повторы с джиттером, хеджирование и выключатели по моделям
+class ResilientCaller:
+    def __init__(self, retries: int, base_delay: float, max_delay: float,
+                 failure_threshold: int, recovery_time: float, fallback_model: str = "",
+                 on_retry=None, on_hedge=None, on_fallback=None):
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.fallback_model = fallback_model
+        self.on_retry = on_retry
+        self.on_hedge = on_hedge
+        self.on_fallback = on_fallback
+        self.breakers = {}
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        breaker = self.breakers.get(model)
+        if breaker is None:
+            breaker = self.breakers[model] = CircuitBreaker(model, self.failure_threshold, self.recovery_time)
+        return breaker
+
+    # Модель для запроса: основная, а при разомкнутой цепи - запасная
+    def _select_model(self, model: str) -> str:
+        if self.breaker(model).allow():
+            return model
+        if self.fallback_model and self.fallback_model != model and self.breaker(self.fallback_model).allow():
+            if self.on_fallback is not None:
+                self.on_fallback(model, self.fallback_model)
+            return self.fallback_model
+        raise LLMUnavailable(f"circuit open for {model}")
+
+    # make_attempt(model) - корутина одной попытки запроса,
+    # hedge_delay - задержка запуска второй попытки (None - без хеджирования),
+    # discard(result) - освобождение результата проигравшей попытки
+    async def call(self, model: str, make_attempt, discard=None, hedge_delay=None):
+        last_error = None
+        for attempt in range(self.retries + 1):
+            selected = self._select_model(model)
+            breaker = self.breaker(selected)
+            try:
+                result = await run_hedged(
+                    lambda: make_attempt(selected),
+                    hedge_delay,
+                    discard=discard,
+                    on_hedge=self.on_hedge
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                last_error = e
+                retryable = is_retryable(e)
+                if retryable:
+                    breaker.record_failure()
+                if not retryable or attempt == self.retries:
+                    break
+                delay = backoff_delay(attempt, self.base_delay, self.max_delay)
+                logger.warning(f"LLM attempt {attempt + 1} on {selected} failed ({e}), retrying in {delay:.2f}s")
+                if self.on_retry is not None:
+                    self.on_retry(selected, e)
+                await asyncio.sleep(delay)
+                continue
+            breaker.record_success()
+            return result
+        raise LLMUnavailable(str(last_error)) from last_error
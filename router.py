@@ -0,0 +1,49 @@
+import re
+import logging
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+# Маршрут запроса: модель и параметры генерации
+Route = namedtuple("Route", ["name", "model", "max_tokens", "temperature"])
+
+# Признаки сложного запроса, которому нужна модель с рассуждениями
+DEFAULT_COMPLEX_KEYWORDS = (
+    "почему", "зачем", "объясни", "расскажи", "докажи", "сравни", "реши", "посчитай",
+    "напиши", "придумай", "проанализируй", "как сделать", "в чем разница", "что будет если",
+    "why", "explain", "how to", "write", "solve",
+)
+
+CODE_OR_MATH = re.compile(r"```|[=+*/^]\s*\d|\d\s*[=+*/^]|def |class |import ")
+
+
+# Выбор модели для сообщения: короткие и простые реплики - быстрой модели,
+# длинные и сложные - модели с рассуждениями
+class ModelRouter:
+    def __init__(self, reasoning: Route, fast: Route = None, fast_max_chars: int = 80,
+                 fast_max_questions: int = 1, complex_keywords=DEFAULT_COMPLEX_KEYWORDS):
+        self.reasoning = reasoning
+        self.fast = fast
+        self.fast_max_chars = fast_max_chars
+        self.fast_max_questions = fast_max_questions
+        self.complex_keywords = tuple(k.lower() for k in complex_keywords)
+
+    def choose(self, text: str) -> Route:
+        if self.fast is None:
+            return self.reasoning
+        if len(text) > self.fast_max_chars:
+            return self.reasoning
+        if text.count("?") > self.fast_max_questions:
+            return self.reasoning
+        lowered = text.lower()
+        if any(keyword in lowered for keyword in self.complex_keywords):
+            return self.reasoning
+        if CODE_OR_MATH.search(text):
+            return self.reasoning
+        return self.fast
+
+
+def parse_keywords(value: str):
+    if not value:
+        return DEFAULT_COMPLEX_KEYWORDS
+    return tuple(filter(None, (k.strip() for k in value.split(","))))
@@ -0,0 +1,46 @@
+import os
+import json
+
+# Параметры, которые можно менять без перезапуска: имя -> тип значения
+RELOADABLE = {
+    "base_daily_limit": int,
+    "referral_bonus": int,
+    "tokens_per_message": int,
+    "llm_model": str,
+    "llm_temperature": float,
+    "llm_max_tokens": int,
+    "fast_model": str,
+    "fast_max_tokens": int,
+}
+
+
+def _check(name: str, value):
+    kind = RELOADABLE.get(name)
+    if kind is None:
+        raise ValueError(f"Unknown setting: {name}")
+    if isinstance(value, bool):
+        raise ValueError(f"Setting {name} must be {kind.__name__}")
+    if kind is float and isinstance(value, int):
+        value = float(value)
+    if not isinstance(value, kind):
+        raise ValueError(f"Setting {name} must be {kind.__name__}")
+    if kind in (int, float) and value < 0:
+        raise ValueError(f"Setting {name} must not be negative")
+    return value
+
+
+# Настройки из JSON-файла поверх значений по умолчанию (отсутствующий файл - только они).
+# Ошибка формата или неизвестный параметр - ValueError: частично примененных настроек не бывает
+def load_settings(path: str, defaults: dict) -> dict:
+    settings = dict(defaults)
+    if not path or not os.path.exists(path):
+        return settings
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if not isinstance(data, dict):
+        raise ValueError(f"{path} must contain a JSON object")
+    for name, value in data.items():
+        settings[name] = _check(name, value)
+    if not settings["llm_model"]:
+        raise ValueError("Setting llm_model must not be empty")
+    return settings
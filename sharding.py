@@ -0,0 +1,255 @@
+import os
+import json
+import asyncio
+import logging
+import itertools
+import multiprocessing
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Максимальная длина строки протокола (одно обновление Telegram или ответ)
+LINE_LIMIT = 16 * 1024 * 1024
+
+
+# Ошибка операции над общим состоянием на стороне ingress
+class SharedStateError(Exception):
+    pass
+
+
+# Номер воркера для чата: все обновления одного чата попадают в один процесс по порядку
+def worker_for(chat_id: int, workers: int) -> int:
+    return chat_id % workers
+
+
+def _encode(message: dict) -> bytes:
+    return (json.dumps(message, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+# Процесс-приемник: раздает обновления воркерам через Unix-сокет и выполняет их запросы
+# к общему состоянию (state.handle). Пока воркер не подключен (запуск, перезапуск),
+# его обновления копятся в буфере ограниченного размера
+class ShardIngress:
+    def __init__(self, path: str, workers: int, state, max_buffer: int = 10000):
+        self.path = path
+        self.workers = workers
+        self.state = state
+        self.max_buffer = max_buffer
+        self.writers = [None] * workers
+        self.buffers = [deque() for _ in range(workers)]
+        self.forwarded = [0] * workers
+        self.dropped = 0
+        self.stopping = False
+        self._server = None
+
+    async def start(self) -> None:
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._handle_worker, self.path, limit=LINE_LIMIT)
+        logger.info(f"Shard ingress listening on {self.path} for {self.workers} workers")
+
+    # Сигнал воркерам прекратить прием обновлений и завершиться; запросы к общему
+    # состоянию обслуживаются до stop(), чтобы воркеры дообработали принятое
+    async def stop_intake(self) -> None:
+        self.stopping = True
+        for writer in self.writers:
+            if writer is None:
+                continue
+            try:
+                writer.write(_encode({"stop": True}))
+                await writer.drain()
+            except ConnectionError as e:
+                logger.warning(f"Failed to send stop to shard worker: {e}")
+
+    async def stop(self) -> None:
+        for writer in self.writers:
+            if writer is not None:
+                writer.close()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def connected(self) -> int:
+        return sum(1 for writer in self.writers if writer is not None)
+
+    async def send(self, chat_id: int, update: dict) -> None:
+        index = worker_for(chat_id, self.workers)
+        writer = self.writers[index]
+        line = _encode({"update": update})
+        if writer is None:
+            buffer = self.buffers[index]
+            if len(buffer) >= self.max_buffer:
+                buffer.popleft()
+                self.dropped += 1
+            buffer.append(line)
+            return
+        writer.write(line)
+        self.forwarded[index] += 1
+        await writer.drain()
+
+    async def _handle_worker(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        index = None
+        try:
+            hello = json.loads(await reader.readline())
+            index = int(hello["worker"])
+            self.writers[index] = writer
+            buffer = self.buffers[index]
+            logger.info(f"Shard worker {index} connected (pid {hello.get('pid')}), {len(buffer)} buffered updates")
+            while buffer:
+                writer.write(buffer.popleft())
+                self.forwarded[index] += 1
+            # Воркер, подключившийся во время остановки, сразу получает сигнал остановки
+            if self.stopping:
+                writer.write(_encode({"stop": True}))
+            await writer.drain()
+
+            # Запросы воркера выполняются по одному, поэтому операции над состоянием атомарны
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = json.loads(line)
+                try:
+                    response = {"id": request["id"], "result": await self.state.handle(request["op"], request["args"])}
+                except Exception as e:
+                    logger.error(f"Shared state operation {request.get('op')} failed: {e}")
+                    response = {"id": request["id"], "error": f"{type(e).__name__}: {e}"}
+                writer.write(_encode(response))
+                await writer.drain()
+        except (ConnectionError, ValueError, KeyError) as e:
+            logger.warning(f"Shard worker {index} connection error: {e}")
+        finally:
+            if index is not None and self.writers[index] is writer:
+                self.writers[index] = None
+                logger.warning(f"Shard worker {index} disconnected")
+            writer.close()
+
+
+# Соединение воркера с ingress: очередь входящих обновлений (None - сигнал остановки
+# или соединение закрыто) и запросы к общему состоянию
+class ShardConnection:
+    def __init__(self, index: int, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.index = index
+        self.updates = asyncio.Queue()
+        self._reader = reader
+        self._writer = writer
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._task = asyncio.get_running_loop().create_task(self._read_loop())
+
+    @classmethod
+    async def connect(cls, path: str, index: int, timeout: float = 30) -> "ShardConnection":
+        deadline = asyncio.get_running_loop().time() + timeout
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(path, limit=LINE_LIMIT)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if asyncio.get_running_loop().time() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+        writer.write(_encode({"worker": index, "pid": os.getpid()}))
+        await writer.drain()
+        return cls(index, reader, writer)
+
+    async def call(self, op: str, *args):
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            self._writer.write(_encode({"id": request_id, "op": op, "args": args}))
+            await self._writer.drain()
+            return await future
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def _read_loop(self) -> None:
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                if "update" in message:
+                    self.updates.put_nowait(message["update"])
+                    continue
+                if message.get("stop"):
+                    self.updates.put_nowait(None)
+                    continue
+                future = self._pending.get(message["id"])
+                if future is None or future.done():
+                    continue
+                if "error" in message:
+                    future.set_exception(SharedStateError(message["error"]))
+                else:
+                    future.set_result(message["result"])
+        except (ConnectionError, ValueError) as e:
+            logger.warning(f"Shard connection error: {e}")
+        finally:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(SharedStateError("ingress connection closed"))
+            self.updates.put_nowait(None)
+
+    async def close(self) -> None:
+        self._writer.close()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+# Процессы-воркеры: target(index, socket_path) запускается в новом интерпретаторе (spawn),
+# упавший воркер перезапускается
+class WorkerPool:
+    def __init__(self, target, workers: int, path: str):
+        self.target = target
+        self.workers = workers
+        self.path = path
+        self.processes = [None] * workers
+        self.restarts = 0
+        self._context = multiprocessing.get_context("spawn")
+        self._stopping = False
+
+    def _spawn(self, index: int) -> None:
+        process = self._context.Process(
+            target=self.target, args=(index, self.path), name=f"shard-worker-{index}", daemon=False
+        )
+        process.start()
+        self.processes[index] = process
+        logger.info(f"Shard worker {index} started (pid {process.pid})")
+
+    def start(self) -> None:
+        for index in range(self.workers):
+            self._spawn(index)
+
+    async def monitor(self, interval: float = 1.0) -> None:
+        while not self._stopping:
+            await asyncio.sleep(interval)
+            for index, process in enumerate(self.processes):
+                if self._stopping or process is None or process.is_alive():
+                    continue
+                logger.error(f"Shard worker {index} exited with code {process.exitcode}, restarting")
+                self.restarts += 1
+                self._spawn(index)
+
+    def send_signal(self, signum: int) -> None:
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                os.kill(process.pid, signum)
+
+    # Остановка: воркеры завершаются сами после сигнала остановки, зависшие - принудительно
+    async def stop(self, timeout: float) -> None:
+        self._stopping = True
+        for index, process in enumerate(self.processes):
+            if process is None:
+                continue
+            await asyncio.to_thread(process.join, timeout)
+            if process.is_alive():
+                logger.warning(f"Shard worker {index} did not stop in {timeout}s, terminating")
+                process.terminate()
+                await asyncio.to_thread(process.join, 5)
@@ -0,0 +1,70 @@
+import logging
+
+from quota import QuotaEngine, QuotaStatus, ReferralBook
+
+logger = logging.getLogger(__name__)
+
+# Операции над общим состоянием, доступные воркерам
+SHARED_OPS = ("check_and_consume", "refund", "charge_tokens", "limit", "status", "add_bonus", "register_referral")
+
+
+# Общее состояние пользователей - дневные лимиты и рефералы - в этом процессе.
+# Методы асинхронные, чтобы обработчики одинаково работали с ним и с RemoteState
+class LocalState:
+    def __init__(self, quota: QuotaEngine, referrals: ReferralBook):
+        self.quota = quota
+        self.referrals = referrals
+
+    async def check_and_consume(self, user_id: int) -> bool:
+        return self.quota.check_and_consume(user_id)
+
+    async def refund(self, user_id: int) -> None:
+        self.quota.refund(user_id)
+
+    async def charge_tokens(self, user_id: int, tokens: int) -> int:
+        return self.quota.charge_tokens(user_id, tokens)
+
+    async def limit(self, user_id: int) -> int:
+        return self.quota.limit(user_id)
+
+    async def status(self, user_id: int) -> QuotaStatus:
+        return self.quota.status(user_id)
+
+    async def add_bonus(self, user_id: int, delta: int) -> int:
+        return self.quota.add_bonus(user_id, delta)
+
+    async def register_referral(self, user_id: int, referrer_id: int) -> bool:
+        return self.referrals.register(user_id, referrer_id)
+
+    # Выполнение операции, присланной воркером
+    async def handle(self, op: str, args: list):
+        if op not in SHARED_OPS:
+            raise ValueError(f"Unknown shared state operation: {op}")
+        return await getattr(self, op)(*args)
+
+
+# Общее состояние в другом процессе: каждая операция - запрос через call(op, *args)
+class RemoteState:
+    def __init__(self, call):
+        self.call = call
+
+    async def check_and_consume(self, user_id: int) -> bool:
+        return await self.call("check_and_consume", user_id)
+
+    async def refund(self, user_id: int) -> None:
+        await self.call("refund", user_id)
+
+    async def charge_tokens(self, user_id: int, tokens: int) -> int:
+        return await self.call("charge_tokens", user_id, tokens)
+
+    async def limit(self, user_id: int) -> int:
+        return await self.call("limit", user_id)
+
+    async def status(self, user_id: int) -> QuotaStatus:
+        return QuotaStatus(*await self.call("status", user_id))
+
+    async def add_bonus(self, user_id: int, delta: int) -> int:
+        return await self.call("add_bonus", user_id, delta)
+
+    async def register_referral(self, user_id: int, referrer_id: int) -> bool:
+        return await self.call("register_referral", user_id, referrer_id)
@@ -0,0 +1,333 @@
+import os
+import json
+import time
+import queue
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Сколько операций записи объединяется в одну транзакцию
+WRITE_BATCH_SIZE = 500
+# Максимальная задержка записи, секунды
+WRITE_FLUSH_INTERVAL = 0.2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS referral_counts (
+    user_id INTEGER PRIMARY KEY,
+    count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS invited_by (
+    user_id INTEGER PRIMARY KEY,
+    referrer_id INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS daily_counters (
+    user_id INTEGER NOT NULL,
+    day TEXT NOT NULL,
+    messages INTEGER NOT NULL DEFAULT 0,
+    bonus INTEGER NOT NULL DEFAULT 0,
+    tokens INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, day)
+);
+CREATE INDEX IF NOT EXISTS daily_counters_day ON daily_counters (day);
+CREATE TABLE IF NOT EXISTS contexts (
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (chat_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS contexts_user ON contexts (user_id);
+CREATE TABLE IF NOT EXISTS group_members (
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS group_members_user ON group_members (user_id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+# Хранилище состояния в памяти процесса: ничего не сохраняет между перезапусками
+class StateBackend:
+    def load_user(self, user_id: int, day: str) -> dict:
+        return {"referrals": 0, "invited_by": None, "messages": 0, "bonus": 0, "tokens": 0}
+
+    def load_context(self, key):
+        return None
+
+    def has_context(self, user_id: int) -> bool:
+        return False
+
+    def save_referral(self, user_id: int, referrer_id: int, referrer_count: int) -> None:
+        pass
+
+    def save_messages(self, user_id: int, day: str, count: int) -> None:
+        pass
+
+    def save_bonus(self, user_id: int, day: str, bonus: int) -> None:
+        pass
+
+    def save_tokens(self, user_id: int, day: str, tokens: int) -> None:
+        pass
+
+    def save_context(self, key, data: dict) -> None:
+        pass
+
+    def delete_context(self, key) -> None:
+        pass
+
+    def save_group_member(self, chat_id: int, user_id: int) -> None:
+        pass
+
+    def delete_group_member(self, chat_id: int, user_id: int) -> None:
+        pass
+
+    def prune_days(self, before_day: str) -> None:
+        pass
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+# Хранилище состояния в SQLite (WAL): чтение по требованию, запись пачками в фоновом потоке
+class SQLiteBackend(StateBackend):
+    def __init__(self, path: str, ref_data_file: str = None):
+        self.path = path
+        self._read_lock = threading.Lock()
+        self._reader = self._connect()
+        with self._read_lock:
+            self._reader.executescript(SCHEMA)
+            self._add_missing_columns()
+        if ref_data_file:
+            self._migrate_ref_data(ref_data_file)
+
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name="state-writer", daemon=True)
+        self._writer.start()
+        logger.info(f"SQLite state store opened: {path}")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    # Колонки, добавленные после создания таблиц в существующих базах
+    def _add_missing_columns(self) -> None:
+        columns = {row[1] for row in self._reader.execute("PRAGMA table_info(daily_counters)")}
+        if "tokens" not in columns:
+            self._reader.execute("ALTER TABLE daily_counters ADD COLUMN tokens INTEGER NOT NULL DEFAULT 0")
+            logger.info("Added tokens column to daily_counters")
+
+    # Однократный перенос данных из ref_data.json
+    def _migrate_ref_data(self, ref_data_file: str) -> None:
+        with self._read_lock:
+            row = self._reader.execute(
+                "SELECT value FROM meta WHERE key = 'ref_data_migrated'"
+            ).fetchone()
+            if row or not os.path.exists(ref_data_file):
+                return
+            try:
+                with open(ref_data_file, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                referrals = data.get("user_referrals", {})
+                invited = data.get("user_invited_by", {})
+                self._reader.execute("BEGIN")
+                self._reader.executemany(
+                    "INSERT OR REPLACE INTO referral_counts (user_id, count) VALUES (?, ?)",
+                    [(int(k), int(v)) for k, v in referrals.items()]
+                )
+                self._reader.executemany(
+                    "INSERT OR REPLACE INTO invited_by (user_id, referrer_id) VALUES (?, ?)",
+                    [(int(k), int(v)) for k, v in invited.items()]
+                )
+                self._reader.execute(
+                    "INSERT INTO meta (key, value) VALUES ('ref_data_migrated', ?)",
+                    (ref_data_file,)
+                )
+                self._reader.execute("COMMIT")
+                logger.info(
+                    f"Migrated {len(referrals)} referrers and {len(invited)} invited users "
+                    f"from {ref_data_file}"
+                )
+            except Exception as e:
+                if self._reader.in_transaction:
+                    self._reader.execute("ROLLBACK")
+                logger.error(f"Error migrating ref data: {e}")
+
+    def load_user(self, user_id: int, day: str) -> dict:
+        with self._read_lock:
+            referrals = self._reader.execute(
+                "SELECT count FROM referral_counts WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            invited = self._reader.execute(
+                "SELECT referrer_id FROM invited_by WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            counters = self._reader.execute(
+                "SELECT messages, bonus, tokens FROM daily_counters WHERE user_id = ? AND day = ?",
+                (user_id, day)
+            ).fetchone()
+        return {
+            "referrals": referrals[0] if referrals else 0,
+            "invited_by": invited[0] if invited else None,
+            "messages": counters[0] if counters else 0,
+            "bonus": counters[1] if counters else 0,
+            "tokens": counters[2] if counters else 0,
+        }
+
+    def load_context(self, key):
+        with self._read_lock:
+            row = self._reader.execute(
+                "SELECT data FROM contexts WHERE chat_id = ? AND user_id = ?", key
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    # Личная история в любом чате или хвост переписки в общей истории группы
+    def has_context(self, user_id: int) -> bool:
+        with self._read_lock:
+            row = self._reader.execute(
+                "SELECT 1 FROM contexts WHERE user_id = ? "
+                "UNION ALL SELECT 1 FROM group_members WHERE user_id = ? LIMIT 1",
+                (user_id, user_id)
+            ).fetchone()
+        return row is not None
+
+    # Операции записи; повторные записи одного ключа внутри пачки схлопываются
+    def _enqueue(self, merge_key, sql: str, params: tuple) -> None:
+        self._queue.put((merge_key, sql, params))
+
+    def save_referral(self, user_id: int, referrer_id: int, referrer_count: int) -> None:
+        self._enqueue(
+            ("invited_by", user_id),
+            "INSERT OR REPLACE INTO invited_by (user_id, referrer_id) VALUES (?, ?)",
+            (user_id, referrer_id)
+        )
+        self._enqueue(
+            ("referral_counts", referrer_id),
+            "INSERT OR REPLACE INTO referral_counts (user_id, count) VALUES (?, ?)",
+            (referrer_id, referrer_count)
+        )
+
+    def save_messages(self, user_id: int, day: str, count: int) -> None:
+        self._enqueue(
+            ("messages", user_id, day),
+            "INSERT INTO daily_counters (user_id, day, messages) VALUES (?, ?, ?) "
+            "ON CONFLICT (user_id, day) DO UPDATE SET messages = excluded.messages",
+            (user_id, day, count)
+        )
+
+    def save_bonus(self, user_id: int, day: str, bonus: int) -> None:
+        self._enqueue(
+            ("bonus", user_id, day),
+            "INSERT INTO daily_counters (user_id, day, bonus) VALUES (?, ?, ?) "
+            "ON CONFLICT (user_id, day) DO UPDATE SET bonus = excluded.bonus",
+            (user_id, day, bonus)
+        )
+
+    def save_tokens(self, user_id: int, day: str, tokens: int) -> None:
+        self._enqueue(
+            ("tokens", user_id, day),
+            "INSERT INTO daily_counters (user_id, day, tokens) VALUES (?, ?, ?) "
+            "ON CONFLICT (user_id, day) DO UPDATE SET tokens = excluded.tokens",
+            (user_id, day, tokens)
+        )
+
+    def save_context(self, key, data: dict) -> None:
+        self._enqueue(
+            ("context", key),
+            "INSERT OR REPLACE INTO contexts (chat_id, user_id, data) VALUES (?, ?, ?)",
+            (key[0], key[1], json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+        )
+
+    def delete_context(self, key) -> None:
+        self._enqueue(
+            ("context", key),
+            "DELETE FROM contexts WHERE chat_id = ? AND user_id = ?",
+            tuple(key)
+        )
+
+    def save_group_member(self, chat_id: int, user_id: int) -> None:
+        self._enqueue(
+            ("group_member", chat_id, user_id),
+            "INSERT OR IGNORE INTO group_members (chat_id, user_id) VALUES (?, ?)",
+            (chat_id, user_id)
+        )
+
+    def delete_group_member(self, chat_id: int, user_id: int) -> None:
+        self._enqueue(
+            ("group_member", chat_id, user_id),
+            "DELETE FROM group_members WHERE chat_id = ? AND user_id = ?",
+            (chat_id, user_id)
+        )
+
+    def prune_days(self, before_day: str) -> None:
+        self._enqueue(
+            ("prune",),
+            "DELETE FROM daily_counters WHERE day < ?",
+            (before_day,)
+        )
+
+    def _write_loop(self) -> None:
+        conn = self._connect()
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            items = [item]
+            # Набираем пачку не дольше WRITE_FLUSH_INTERVAL от первой записи в ней
+            deadline = time.monotonic() + WRITE_FLUSH_INTERVAL
+            while len(items) < WRITE_BATCH_SIZE:
+                try:
+                    items.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            batch = {}
+            for entry in items:
+                if entry is None:
+                    stop = True
+                    continue
+                merge_key, sql, params = entry
+                batch.pop(merge_key, None)
+                batch[merge_key] = (sql, params)
+
+            if batch:
+                try:
+                    conn.execute("BEGIN")
+                    for sql, params in batch.values():
+                        conn.execute(sql, params)
+                    conn.execute("COMMIT")
+                except Exception as e:
+                    if conn.in_transaction:
+                        conn.execute("ROLLBACK")
+                    logger.error(f"Error writing state batch ({len(batch)} ops): {e}")
+
+            for _ in items:
+                self._queue.task_done()
+        conn.close()
+
+    # Ожидание записи всех поставленных в очередь изменений
+    def flush(self) -> None:
+        self._queue.join()
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._writer.join()
+        with self._read_lock:
+            self._reader.close()
+        logger.info("SQLite state store closed")
+
+
+def create_backend(kind: str, path: str, ref_data_file: str = None) -> StateBackend:
+    if kind == "sqlite":
+        return SQLiteBackend(path, ref_data_file)
+    if kind == "memory":
+        return StateBackend()
+    raise ValueError(f"Unknown state backend: {kind}")
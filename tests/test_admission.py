@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+
+from admission import AdmissionController, Overloaded, parse_class_waits
+
+WAITS = {"developer": 5.0, "private": 5.0, "group": 5.0}
+
+
+def test_parse_class_waits():
+    assert parse_class_waits("private=1.5, group=0", WAITS) == {"developer": 5.0, "private": 1.5, "group": 0.0}
+    with pytest.raises(ValueError):
+        parse_class_waits("channel=1", WAITS)
+
+
+def test_queue_full_sheds_same_priority():
+    async def scenario():
+        controller = AdmissionController(1, 1, WAITS)
+        await controller.acquire("private")
+        waiter = asyncio.ensure_future(controller.acquire("private"))
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded) as error:
+            await controller.acquire("private")
+        assert error.value.reason == "queue full"
+
+        controller.release()
+        await waiter
+        assert controller.in_flight == 1
+        assert controller.shed["private"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_higher_priority_evicts_lowest_waiter():
+    async def scenario():
+        controller = AdmissionController(1, 1, WAITS)
+        await controller.acquire("group")
+        low = asyncio.ensure_future(controller.acquire("group"))
+        await asyncio.sleep(0)
+        high = asyncio.ensure_future(controller.acquire("developer"))
+        await asyncio.sleep(0)
+
+        with pytest.raises(Overloaded) as error:
+            await low
+        assert error.value.reason == "evicted by higher priority"
+        controller.release()
+        await high
+        assert controller.shed == {"developer": 0, "private": 0, "group": 1}
+
+    asyncio.run(scenario())
+
+
+def test_wait_timeout_sheds_and_keeps_slot_count():
+    async def scenario():
+        controller = AdmissionController(1, 4, {"developer": 5.0, "group": 0.05})
+        await controller.acquire("developer")
+        with pytest.raises(Overloaded) as error:
+            await controller.acquire("group")
+        assert error.value.reason == "max wait exceeded"
+        assert controller.depth == 0
+
+        controller.release()
+        assert controller.in_flight == 0
+        await controller.acquire("group")
+        assert controller.in_flight == 1
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_does_not_take_slot():
+    async def scenario():
+        controller = AdmissionController(1, 4, WAITS)
+        await controller.acquire("private")
+        waiter = asyncio.ensure_future(controller.acquire("private"))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        controller.release()
+        assert controller.in_flight == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,108 @@
+from quota import MODE_MESSAGES, MODE_TOKENS, QuotaEngine, SECONDS_PER_DAY
+
+START = 1_700_000_000.0
+
+
+def make_engine(mode=MODE_MESSAGES, referrals=None, **kwargs):
+    now = [START]
+    referrals = referrals or {}
+    engine = QuotaEngine(3, 2, lambda user_id: referrals.get(user_id, 0), clock=lambda: now[0],
+                         mode=mode, tokens_per_message=100, **kwargs)
+    return engine, now
+
+
+def test_messages_mode_consumes_up_to_limit():
+    engine, _ = make_engine()
+    assert [engine.check_and_consume(1) for _ in range(4)] == [True, True, True, False]
+    assert engine.used(1) == 3
+    assert engine.status(1).remaining == 0
+
+
+def test_messages_mode_counts_referrals_and_bonus():
+    engine, _ = make_engine(referrals={1: 1})
+    engine.add_bonus(1, 1)
+    assert engine.limit(1) == 3 + 2 + 1
+    assert sum(engine.check_and_consume(1) for _ in range(10)) == 6
+
+
+def test_refund_returns_message_and_stops_at_zero():
+    engine, _ = make_engine()
+    for _ in range(3):
+        engine.check_and_consume(1)
+    engine.refund(1)
+    assert engine.check_and_consume(1)
+    assert not engine.check_and_consume(1)
+
+    engine.refund(2)
+    assert engine.used(2) == 0
+
+
+def test_messages_mode_rolls_over_at_midnight():
+    engine, now = make_engine()
+    engine.add_bonus(1, 5)
+    while engine.check_and_consume(1):
+        pass
+    now[0] += SECONDS_PER_DAY
+    assert engine.check_and_consume(1)
+    assert engine.used(1) == 1
+    assert engine.status(1).bonus == 0
+
+
+def test_tokens_mode_gates_on_token_budget():
+    engine, _ = make_engine(mode=MODE_TOKENS)
+    # 3 сообщения по 100 токенов: бюджет 300, число сообщений не ограничивает
+    for _ in range(5):
+        assert engine.check_and_consume(1)
+    engine.charge_tokens(1, 250)
+    assert engine.check_and_consume(1)
+    engine.charge_tokens(1, 50)
+    assert not engine.check_and_consume(1)
+
+    status = engine.status(1)
+    assert (status.tokens_total, status.tokens_used, status.tokens_remaining) == (300, 300, 0)
+    assert status.tokens_per_message == 100
+
+
+def test_tokens_mode_ignores_negative_charge():
+    engine, _ = make_engine(mode=MODE_TOKENS)
+    engine.charge_tokens(1, 120)
+    assert engine.charge_tokens(1, -50) == 120
+
+
+def test_tokens_mode_refund_returns_message_not_tokens():
+    engine, _ = make_engine(mode=MODE_TOKENS)
+    engine.check_and_consume(1)
+    engine.charge_tokens(1, 300)
+    engine.refund(1)
+    assert engine.used(1) == 0
+    assert not engine.check_and_consume(1)
+
+
+def test_tokens_mode_rolls_over_at_midnight():
+    engine, now = make_engine(mode=MODE_TOKENS)
+    engine.charge_tokens(1, 1000)
+    assert not engine.check_and_consume(1)
+    now[0] += SECONDS_PER_DAY
+    assert engine.check_and_consume(1)
+    assert engine.status(1).tokens_used == 0
+
+
+def test_rollover_prunes_backend_days():
+    pruned = []
+
+    class Backend:
+        def load_user(self, user_id, day):
+            return {"referrals": 0, "invited_by": None, "messages": 2, "bonus": 0, "tokens": 40}
+
+        def save_messages(self, user_id, day, count):
+            pass
+
+        def prune_days(self, before_day):
+            pruned.append(before_day)
+
+    engine, now = make_engine(mode=MODE_TOKENS, backend=Backend())
+    assert engine.used(1) == 2
+    assert engine.status(1).tokens_used == 40
+    now[0] += SECONDS_PER_DAY
+    engine.check_and_consume(1)
+    assert pruned == [engine.day]
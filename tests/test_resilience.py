@@ -0,0 +1,60 @@
+import pytest
+
+pytest.importorskip("openai")
+
+from resilience import CircuitBreaker
+
+
+def make_breaker():
+    now = [0.0]
+    return CircuitBreaker("test", failure_threshold=3, recovery_time=10, clock=lambda: now[0]), now
+
+
+def test_opens_after_threshold_failures():
+    breaker, _ = make_breaker()
+    for _ in range(2):
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.CLOSED
+        assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+
+def test_success_resets_failure_count():
+    breaker, _ = make_breaker()
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_allows_one_probe_per_recovery_time():
+    breaker, now = make_breaker()
+    for _ in range(3):
+        breaker.record_failure()
+    now[0] = 10
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+    now[0] = 20
+    assert breaker.allow()
+
+
+def test_failed_probe_reopens_and_successful_probe_closes():
+    breaker, now = make_breaker()
+    for _ in range(3):
+        breaker.record_failure()
+    now[0] = 10
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+    now[0] = 20
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.failures == 0
+    assert breaker.allow()
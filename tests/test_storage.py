@@ -0,0 +1,139 @@
+import json
+import sqlite3
+import time
+
+import pytest
+
+import storage
+from storage import SQLiteBackend
+
+DAY = "2024-01-01"
+
+
+@pytest.fixture
+def open_backend(tmp_path):
+    backends = []
+
+    def open_(**kwargs):
+        backend = SQLiteBackend(str(tmp_path / "state.db"), **kwargs)
+        backends.append(backend)
+        return backend
+
+    yield open_
+    for backend in backends:
+        backend.close()
+
+
+def test_repeated_writes_of_one_key_keep_the_last(open_backend):
+    backend = open_backend()
+    for count in range(1, 51):
+        backend.save_messages(1, DAY, count)
+    backend.save_bonus(1, DAY, 4)
+    backend.save_tokens(1, DAY, 900)
+    backend.flush()
+
+    state = backend.load_user(1, DAY)
+    assert (state["messages"], state["bonus"], state["tokens"]) == (50, 4, 900)
+
+
+def test_batch_is_merged_into_one_transaction(open_backend, monkeypatch):
+    statements = []
+    connect = SQLiteBackend._connect
+
+    def traced_connect(self):
+        conn = connect(self)
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    monkeypatch.setattr(SQLiteBackend, "_connect", traced_connect)
+    # Все записи теста успевают попасть в одну пачку
+    monkeypatch.setattr(storage, "WRITE_FLUSH_INTERVAL", 0.5)
+    backend = open_backend()
+    statements.clear()
+    for count in range(1, 11):
+        backend.save_messages(1, DAY, count)
+    backend.save_context((5, 1), {"texts": ["a"]})
+    backend.delete_context((5, 1))
+    backend.flush()
+
+    writes = [s for s in statements if s.startswith(("INSERT", "DELETE"))]
+    assert len(writes) == 2
+    assert statements.count("BEGIN") == 1
+    assert backend.load_user(1, DAY)["messages"] == 10
+    assert backend.load_context((5, 1)) is None
+
+
+def test_batch_is_committed_within_flush_interval_under_steady_writes(open_backend, monkeypatch):
+    monkeypatch.setattr(storage, "WRITE_FLUSH_INTERVAL", 0.2)
+    backend = open_backend()
+    backend.save_messages(1, DAY, 1)
+    # Непрерывный поток записей не должен откладывать фиксацию пачки
+    deadline = time.monotonic() + 1.5
+    count = 0
+    while backend.load_user(1, DAY)["messages"] != 1:
+        assert time.monotonic() < deadline
+        count += 1
+        backend.save_messages(2, DAY, count)
+        time.sleep(0.05)
+
+
+def test_context_round_trip_and_has_context(open_backend):
+    backend = open_backend()
+    backend.save_context((5, 1), {"texts": ["привет", "здравствуй"]})
+    backend.save_group_member(-7, 2)
+    backend.flush()
+
+    assert backend.load_context((5, 1)) == {"texts": ["привет", "здравствуй"]}
+    assert backend.has_context(1)
+    assert backend.has_context(2)
+    assert not backend.has_context(3)
+
+    backend.delete_context((5, 1))
+    backend.delete_group_member(-7, 2)
+    backend.flush()
+    assert backend.load_context((5, 1)) is None
+    assert not backend.has_context(1)
+    assert not backend.has_context(2)
+
+
+def test_ref_data_is_migrated_once(open_backend, tmp_path):
+    ref_data = tmp_path / "ref_data.json"
+    ref_data.write_text(json.dumps({"user_referrals": {"10": 2}, "user_invited_by": {"11": 10, "12": 10}}))
+    backend = open_backend(ref_data_file=str(ref_data))
+    assert backend.load_user(10, DAY)["referrals"] == 2
+    assert backend.load_user(11, DAY)["invited_by"] == 10
+    backend.close()
+
+    ref_data.write_text(json.dumps({"user_referrals": {"10": 99}, "user_invited_by": {}}))
+    backend = open_backend(ref_data_file=str(ref_data))
+    assert backend.load_user(10, DAY)["referrals"] == 2
+
+
+def test_broken_ref_data_is_rolled_back(open_backend, tmp_path):
+    ref_data = tmp_path / "ref_data.json"
+    ref_data.write_text(json.dumps({"user_referrals": {"10": "many"}}))
+    backend = open_backend(ref_data_file=str(ref_data))
+    assert backend.load_user(10, DAY)["referrals"] == 0
+    backend.close()
+
+    ref_data.write_text(json.dumps({"user_referrals": {"10": 3}}))
+    backend = open_backend(ref_data_file=str(ref_data))
+    assert backend.load_user(10, DAY)["referrals"] == 3
+
+
+def test_tokens_column_is_added_to_old_database(open_backend, tmp_path):
+    conn = sqlite3.connect(tmp_path / "state.db")
+    conn.execute(
+        "CREATE TABLE daily_counters (user_id INTEGER NOT NULL, day TEXT NOT NULL, "
+        "messages INTEGER NOT NULL DEFAULT 0, bonus INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (user_id, day))"
+    )
+    conn.execute("INSERT INTO daily_counters (user_id, day, messages) VALUES (1, ?, 7)", (DAY,))
+    conn.commit()
+    conn.close()
+
+    backend = open_backend()
+    assert backend.load_user(1, DAY)["tokens"] == 0
+    backend.save_tokens(1, DAY, 300)
+    backend.flush()
+    state = backend.load_user(1, DAY)
+    assert (state["messages"], state["tokens"]) == (7, 300)
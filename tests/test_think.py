@@ -0,0 +1,34 @@
+from think import ThinkStripper
+
+TEXT = "Привет, <think>нужно ответить</think>как дела?</think> Все <b>хорошо</b>."
+EXPECTED = "Привет, как дела? Все <b>хорошо</b>."
+
+
+def strip(chunks) -> str:
+    stripper = ThinkStripper()
+    return "".join(stripper.feed(chunk) for chunk in chunks) + stripper.flush()
+
+
+def test_whole_text():
+    assert strip([TEXT]) == EXPECTED
+
+
+def test_tags_split_across_two_chunks():
+    for i in range(len(TEXT) + 1):
+        assert strip([TEXT[:i], TEXT[i:]]) == EXPECTED, i
+
+
+def test_one_character_chunks():
+    assert strip(list(TEXT)) == EXPECTED
+
+
+def test_partial_tag_is_held_back_until_resolved():
+    stripper = ThinkStripper()
+    assert stripper.feed("ответ <thi") == "ответ "
+    assert stripper.feed("s is not a tag") == "<this is not a tag"
+    assert stripper.feed(" <") == " "
+    assert stripper.flush() == "<"
+
+
+def test_unclosed_think_block_is_dropped():
+    assert strip(["ответ<think>рассуж", "дение без конца"]) == "ответ"
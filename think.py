@@ -0,0 +1,52 @@
+# Потоковое удаление блоков <think>...</think>, в том числе разорванных между чанками
+class ThinkStripper:
+    OPEN_TAG = "<think>"
+    CLOSE_TAG = "</think>"
+
+    def __init__(self):
+        self._buffer = ""
+        self._in_think = False
+
+    # Длина хвоста буфера, который может оказаться началом тега
+    @staticmethod
+    def _partial_tag_length(text: str, tags: tuple) -> int:
+        for size in range(min(len(text), max(len(t) for t in tags) - 1), 0, -1):
+            tail = text[-size:]
+            if any(t.startswith(tail) for t in tags):
+                return size
+        return 0
+
+    def feed(self, chunk: str) -> str:
+        self._buffer += chunk
+        visible = []
+        while True:
+            if self._in_think:
+                idx = self._buffer.find(self.CLOSE_TAG)
+                if idx == -1:
+                    keep = self._partial_tag_length(self._buffer, (self.CLOSE_TAG,))
+                    self._buffer = self._buffer[len(self._buffer) - keep:]
+                    break
+                self._buffer = self._buffer[idx + len(self.CLOSE_TAG):]
+                self._in_think = False
+            else:
+                open_idx = self._buffer.find(self.OPEN_TAG)
+                close_idx = self._buffer.find(self.CLOSE_TAG)
+                # Одиночный закрывающий тег просто выбрасываем
+                if close_idx != -1 and (open_idx == -1 or close_idx < open_idx):
+                    visible.append(self._buffer[:close_idx])
+                    self._buffer = self._buffer[close_idx + len(self.CLOSE_TAG):]
+                    continue
+                if open_idx == -1:
+                    keep = self._partial_tag_length(self._buffer, (self.OPEN_TAG, self.CLOSE_TAG))
+                    visible.append(self._buffer[:len(self._buffer) - keep])
+                    self._buffer = self._buffer[len(self._buffer) - keep:]
+                    break
+                visible.append(self._buffer[:open_idx])
+                self._buffer = self._buffer[open_idx + len(self.OPEN_TAG):]
+                self._in_think = True
+        return "".join(visible)
+
+    def flush(self) -> str:
+        rest = "" if self._in_think else self._buffer
+        self._buffer = ""
+        return rest
@@ -0,0 +1,189 @@
+import json
+import asyncio
+import logging
+from urllib.parse import urlsplit, parse_qs
+
+logger = logging.getLogger(__name__)
+
+# Ограничения на входящие запросы
+MAX_HEADER_LINES = 100
+MAX_BODY_SIZE = 1024 * 1024
+KEEPALIVE_TIMEOUT = 75
+
+REASONS = {
+    200: "OK",
+    204: "No Content",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    429: "Too Many Requests",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+
+class Request:
+    __slots__ = ("method", "path", "query", "headers", "body")
+
+    def __init__(self, method: str, path: str, query: dict, headers: dict, body: bytes):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body.decode("utf-8"))
+
+
+class Response:
+    __slots__ = ("status", "body", "content_type", "headers")
+
+    def __init__(self, status: int = 200, body=b"", content_type: str = "text/plain; charset=utf-8", headers: dict = None):
+        self.status = status
+        self.body = body.encode("utf-8") if isinstance(body, str) else body
+        self.content_type = content_type
+        self.headers = headers or {}
+
+
+# Ответ, тело которого отдается частями по мере готовности (Transfer-Encoding: chunked),
+# например поток server-sent events
+class StreamingResponse:
+    __slots__ = ("status", "chunks", "content_type", "headers")
+
+    def __init__(self, chunks, status: int = 200, content_type: str = "text/event-stream", headers: dict = None):
+        self.status = status
+        self.chunks = chunks
+        self.content_type = content_type
+        self.headers = headers or {}
+
+
+# Минимальный HTTP/1.1 сервер на asyncio: health-check, вебхук Telegram и служебные эндпоинты
+class HTTPServer:
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._routes = {}
+        self._server = None
+
+    def route(self, method: str, path: str, handler) -> None:
+        self._routes[(method, path)] = handler
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        logger.info(f"HTTP server listening on {self.host or '0.0.0.0'}:{self.port}")
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+            logger.info("HTTP server stopped")
+
+    async def _dispatch(self, request: Request) -> Response:
+        method = "GET" if request.method == "HEAD" else request.method
+        handler = self._routes.get((method, request.path))
+        if handler is None:
+            if any(path == request.path for _, path in self._routes):
+                return Response(405, "Method Not Allowed")
+            return Response(404, "Not Found")
+        try:
+            return await handler(request)
+        except Exception as e:
+            logger.error(f"HTTP handler error for {request.method} {request.path}: {e}")
+            return Response(500, "Internal Server Error")
+
+    async def _read_request(self, reader: asyncio.StreamReader):
+        request_line = await asyncio.wait_for(reader.readline(), KEEPALIVE_TIMEOUT)
+        if not request_line:
+            return None
+        parts = request_line.decode("latin-1").split()
+        if len(parts) != 3:
+            raise ValueError("malformed request line")
+        method, target, version = parts
+
+        headers = {}
+        for _ in range(MAX_HEADER_LINES):
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        else:
+            raise ValueError("too many headers")
+
+        length = int(headers.get("content-length", 0))
+        if length > MAX_BODY_SIZE:
+            raise OverflowError("body too large")
+        body = await reader.readexactly(length) if length else b""
+
+        url = urlsplit(target)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        request = Request(method.upper(), url.path, query, headers, body)
+        keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+        return request, keep_alive
+
+    @staticmethod
+    async def _write_stream(writer: asyncio.StreamWriter, response: StreamingResponse, head_only: bool, keep_alive: bool) -> None:
+        lines = [
+            f"HTTP/1.1 {response.status} {REASONS.get(response.status, 'Unknown')}",
+            f"Content-Type: {response.content_type}",
+            "Transfer-Encoding: chunked",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        ]
+        lines.extend(f"{name}: {value}" for name, value in response.headers.items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        if not head_only:
+            async for chunk in response.chunks:
+                data = chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+                if data:
+                    writer.write(f"{len(data):x}\r\n".encode("latin-1") + data + b"\r\n")
+                    await writer.drain()
+            writer.write(b"0\r\n\r\n")
+
+    @staticmethod
+    def _write_response(writer: asyncio.StreamWriter, response: Response, head_only: bool, keep_alive: bool) -> None:
+        lines = [
+            f"HTTP/1.1 {response.status} {REASONS.get(response.status, 'Unknown')}",
+            f"Content-Type: {response.content_type}",
+            f"Content-Length: {len(response.body)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        ]
+        lines.extend(f"{name}: {value}" for name, value in response.headers.items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        if not head_only:
+            writer.write(response.body)
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                try:
+                    parsed = await self._read_request(reader)
+                except OverflowError:
+                    self._write_response(writer, Response(413, "Payload Too Large"), False, False)
+                    break
+                except (ValueError, asyncio.IncompleteReadError):
+                    self._write_response(writer, Response(400, "Bad Request"), False, False)
+                    break
+                if parsed is None:
+                    break
+
+                request, keep_alive = parsed
+                response = await self._dispatch(request)
+                if isinstance(response, StreamingResponse):
+                    await self._write_stream(writer, response, request.method == "HEAD", keep_alive)
+                else:
+                    self._write_response(writer, response, request.method == "HEAD", keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass